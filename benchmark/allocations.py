@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import io
+import logging
+import os
+import sys
+import tracemalloc
+import typing
+
+import PIL.Image
+
+import corpus
+import run
+
+logger = logging.getLogger(__name__)
+
+IMAGE_OUTPUT_TYPES = ['photo', 'sticker']
+VIDEO_OUTPUT_TYPES = ['video', 'video_note']
+AUDIO_OUTPUT_TYPES = ['audio', 'file']
+
+
+def trace(function: typing.Callable[[], typing.Any]) -> int:
+    tracemalloc.start()
+
+    try:
+        function()
+
+        (_size, peak_size) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak_size
+
+
+class EncodingTracer:
+    # Some decoders return the pixels as Python objects, like the frames of WebP and the pages read from poppler, so the
+    # allocations are only measured from the start of each encoding, on top of what is already held then.
+    def __init__(self) -> None:
+        self.held_size = 0
+        self.peak_size: typing.Optional[int] = None
+        self.save_handlers: typing.Dict[str, typing.Callable[..., typing.Any]] = {}
+
+    def wrap_save_handlers(self) -> None:
+        self.save_handlers = dict(PIL.Image.SAVE)
+
+        for (image_format, save_handler) in self.save_handlers.items():
+            PIL.Image.SAVE[image_format] = self.wrap(save_handler)
+
+    def wrap(self, save_handler: typing.Callable[..., typing.Any]) -> typing.Callable[..., typing.Any]:
+        def save(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            self.update()
+
+            (self.held_size, _peak_size) = tracemalloc.get_traced_memory()
+
+            tracemalloc.reset_peak()
+
+            return save_handler(*args, **kwargs)
+
+        return save
+
+    def update(self) -> None:
+        if self.peak_size is None:
+            self.peak_size = 0
+
+            return
+
+        (_size, peak_size) = tracemalloc.get_traced_memory()
+
+        self.peak_size = max(self.peak_size, peak_size - self.held_size)
+
+    def trace(self, function: typing.Callable[[], typing.Any]) -> int:
+        self.held_size = 0
+        self.peak_size = None
+
+        tracemalloc.start()
+
+        try:
+            function()
+
+            self.update()
+        finally:
+            tracemalloc.stop()
+
+        return self.peak_size or 0
+
+    def close(self) -> None:
+        PIL.Image.SAVE.update(self.save_handlers)
+
+
+def measure_images(corpus_path: str, items: typing.List[corpus.CorpusItem], cli_args: argparse.Namespace) -> bool:
+    import constants
+    import converters
+    import staging
+
+    encoding_tracer = EncodingTracer()
+
+    print(f'{"input":<32} {"output type":<12} {"output KB":>10} {"peak KB":>10} {"ratio":>6}')
+
+    is_within_limit = True
+
+    try:
+        for item in items:
+            if item.output_type not in IMAGE_OUTPUT_TYPES:
+                continue
+
+            path = os.path.join(corpus_path, item.name)
+
+            with staging.StagedInput(path, local_path=path) as staged_input, io.BytesIO() as output_bytes:
+                converter: typing.Optional[converters.Converter]
+
+                if item.message_type == 'sticker':
+                    converter = converters.convert_sticker
+                else:
+                    converter = converters.get_document_converter(staged_input.read_header(constants.SNIFF_HEADER_SIZE), item.mime_type, True)
+
+                if converter is None:
+                    logger.error(f'No converter for {item.name}')
+
+                    is_within_limit = False
+
+                    continue
+
+                # The first conversion imports the PIL plugins, which would be counted too, and registers their encoders.
+                if converter(staged_input, io.BytesIO(), item.name, None).output_file is None:
+                    logger.error(f'Failed to convert {item.name}')
+
+                    is_within_limit = False
+
+                    continue
+
+                if not encoding_tracer.save_handlers:
+                    encoding_tracer.wrap_save_handlers()
+
+                result = converters.ConversionResult()
+
+                def convert() -> None:
+                    nonlocal result
+
+                    result = converter(staged_input, output_bytes, item.name, None)
+
+                # Only the Python allocations are traced, so the decoded pixels, which PIL keeps in its own memory, are
+                # left out, and the copies of the encoded output are what is measured.
+                peak_size = encoding_tracer.trace(convert)
+                output_size = output_bytes.tell()
+
+            if result.output_file is None or output_size == 0:
+                logger.error(f'Failed to convert {item.name}')
+
+                is_within_limit = False
+
+                continue
+
+            ratio = peak_size / output_size
+
+            if ratio > cli_args.max_ratio:
+                is_within_limit = False
+
+            print(f'{item.name:<32} {result.output_type:<12} {output_size / 1024:>10.1f} {peak_size / 1024:>10.1f} {ratio:>6.2f}')
+    finally:
+        encoding_tracer.close()
+
+    return is_within_limit
+
+
+def measure_streams(corpus_path: str, items: typing.List[corpus.CorpusItem], cli_args: argparse.Namespace) -> bool:
+    import uploading
+    import utils
+
+    stream_items = [item for item in items if item.output_type in VIDEO_OUTPUT_TYPES + AUDIO_OUTPUT_TYPES]
+    max_peak_size = cli_args.max_chunks * uploading.CHUNK_SIZE
+
+    print(f'{"input":<32} {"output type":<12} {"output KB":>10} {"peak KB":>10} {"allowed KB":>10}')
+
+    is_within_limit = True
+
+    for index, item in enumerate(stream_items):
+        path = os.path.join(corpus_path, item.name)
+        probe_result = utils.prober.probe(path, item.name)
+        output_size = 0
+
+        def convert() -> None:
+            nonlocal output_size
+
+            if item.output_type in VIDEO_OUTPUT_TYPES:
+                output_stream = utils.convert_stream(item.output_type, utils.upload_size_limit, input_video_url=path, probe_result=probe_result, name=item.name)
+            else:
+                output_stream = utils.convert_stream(item.output_type, utils.upload_size_limit, input_audio_url=path, probe_result=probe_result, name=item.name)
+
+            if output_stream is None:
+                return
+
+            # The output is read the same way as when it is uploaded, and the chunks are dropped instead of being sent.
+            try:
+                for chunk in uploading.StreamedInputFile(output_stream, item.name).iter_chunks():
+                    output_size += len(chunk)
+            finally:
+                output_stream.close()
+
+        # The first conversion imports the ffmpeg modules and starts the watchdog, which would be counted too.
+        if index == 0:
+            convert()
+
+            output_size = 0
+
+        peak_size = trace(convert)
+
+        if output_size == 0:
+            logger.error(f'Failed to convert {item.name}')
+
+            is_within_limit = False
+
+            continue
+
+        # Only a few chunks of the output are ever in memory, however big it is.
+        if peak_size > max_peak_size:
+            is_within_limit = False
+
+        print(f'{item.name:<32} {item.output_type:<12} {output_size / 1024:>10.1f} {peak_size / 1024:>10.1f} {max_peak_size / 1024:>10.1f}')
+
+    return is_within_limit
+
+
+def measure(cli_args: argparse.Namespace) -> bool:
+    (corpus_path, items) = run.load_corpus(cli_args)
+
+    sys.path.insert(0, run.SOURCE_PATH)
+
+    are_images_within_limit = measure_images(corpus_path, items, cli_args)
+
+    print()
+
+    are_streams_within_limit = measure_streams(corpus_path, items, cli_args)
+
+    return are_images_within_limit and are_streams_within_limit
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the peak Python allocations of the image conversions and of the streamed ffmpeg outputs.')
+
+    parser.add_argument('-c', '--corpus', default=run.DEFAULT_CORPUS_PATH, help='The directory of the generated inputs')
+    parser.add_argument('-g', '--generate', action='store_true', help='Generate the inputs again')
+    parser.add_argument('-d', '--duration', type=int, default=10, help='The duration of the generated media, in seconds')
+    parser.add_argument('-m', '--max-ratio', type=float, default=2.5, help='The highest allowed ratio of the peak allocation, from the start of the encoding, to the output size')
+    parser.add_argument('-k', '--max-chunks', type=int, default=4, help='The highest allowed peak allocation of a streamed output, in upload chunks')
+
+    if not measure(parser.parse_args()):
+        sys.exit(1)
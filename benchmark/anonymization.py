@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import sys
+import time
+import typing
+
+import telegram
+
+import run
+
+logger = logging.getLogger(__name__)
+
+# The raw ids are big and distinct, so that they can't be confused with the other numbers of the updates.
+USER_ID = 7100000001
+OTHER_USER_ID = 7100000002
+BOT_USER_ID = 7100000003
+FORWARDED_USER_ID = 7100000004
+GROUP_ID = -7100000005
+SUPERGROUP_ID = -1007100000006
+CHANNEL_ID = -1007100000007
+
+RAW_IDS = [USER_ID, OTHER_USER_ID, BOT_USER_ID, FORWARDED_USER_ID, GROUP_ID, SUPERGROUP_ID, CHANNEL_ID]
+
+
+def create_user(user_id: int, is_bot: bool = False) -> typing.Dict[str, typing.Any]:
+    return {
+        'id': user_id,
+        'is_bot': is_bot,
+        'first_name': 'First',
+        'last_name': 'Last',
+        'username': f'user{user_id}',
+        'language_code': 'en'
+    }
+
+
+def create_chat(chat_id: int, chat_type: str) -> typing.Dict[str, typing.Any]:
+    return {
+        'id': chat_id,
+        'type': chat_type,
+        'title': 'Chat'
+    }
+
+
+def create_message(message_id: int, chat: typing.Dict[str, typing.Any], **fields: typing.Any) -> typing.Dict[str, typing.Any]:
+    return dict({
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': chat,
+        'from': create_user(USER_ID)
+    }, **fields)
+
+
+def create_chat_member(user_id: int, status: str) -> typing.Dict[str, typing.Any]:
+    return {
+        'user': create_user(user_id),
+        'status': status
+    }
+
+
+def create_updates() -> typing.List[typing.Dict[str, typing.Any]]:
+    private_chat = create_chat(USER_ID, telegram.Chat.PRIVATE)
+    group_chat = create_chat(GROUP_ID, telegram.Chat.GROUP)
+    supergroup_chat = create_chat(SUPERGROUP_ID, telegram.Chat.SUPERGROUP)
+    channel_chat = create_chat(CHANNEL_ID, telegram.Chat.CHANNEL)
+
+    # The group service messages are always sent to the bots, even with the privacy mode on.
+    messages = [
+        create_message(1, private_chat, text='Hello', forward_from=create_user(FORWARDED_USER_ID), forward_date=int(time.time())),
+        create_message(2, private_chat, forward_from_chat=channel_chat, forward_from_message_id=1, forward_date=int(time.time()), text='-'),
+        create_message(3, private_chat, via_bot=create_user(BOT_USER_ID, is_bot=True), text='-'),
+        create_message(4, group_chat, new_chat_members=[create_user(OTHER_USER_ID), create_user(BOT_USER_ID, is_bot=True)]),
+        create_message(5, group_chat, left_chat_member=create_user(OTHER_USER_ID)),
+        create_message(6, supergroup_chat, pinned_message=create_message(7, supergroup_chat, **{'from': create_user(OTHER_USER_ID), 'text': '-'})),
+        create_message(8, group_chat, migrate_to_chat_id=SUPERGROUP_ID),
+        create_message(9, supergroup_chat, migrate_from_chat_id=GROUP_ID),
+        create_message(10, supergroup_chat, sender_chat=channel_chat, text='-'),
+        create_message(11, group_chat, reply_to_message=create_message(12, group_chat, **{'from': create_user(OTHER_USER_ID), 'text': '-'}), text='-'),
+        create_message(13, group_chat, text='Hi Other', entities=[{'type': telegram.MessageEntity.TEXT_MENTION, 'offset': 3, 'length': 5, 'user': create_user(OTHER_USER_ID)}]),
+        create_message(14, private_chat, contact={'phone_number': '+1000', 'first_name': 'Other', 'user_id': OTHER_USER_ID})
+    ]
+
+    updates: typing.List[typing.Dict[str, typing.Any]] = [{'message': message} for message in messages]
+
+    updates.append({
+        'channel_post': create_message(15, channel_chat, text='-')
+    })
+    updates.append({
+        'callback_query': {
+            'id': '1',
+            'from': create_user(USER_ID),
+            'chat_instance': '1',
+            'data': '{}',
+            'message': create_message(16, private_chat, **{'from': create_user(BOT_USER_ID, is_bot=True), 'text': '-'})
+        }
+    })
+
+    for update_key, user_id in [('my_chat_member', BOT_USER_ID), ('chat_member', OTHER_USER_ID)]:
+        updates.append({
+            update_key: {
+                'chat': supergroup_chat,
+                'from': create_user(USER_ID),
+                'date': int(time.time()),
+                'old_chat_member': create_chat_member(user_id, telegram.ChatMember.LEFT),
+                'new_chat_member': create_chat_member(user_id, telegram.ChatMember.MEMBER)
+            }
+        })
+
+    updates.append({
+        'poll_answer': {
+            'poll_id': '1',
+            'user': create_user(USER_ID),
+            'option_ids': [0]
+        }
+    })
+
+    for update_id, update in enumerate(updates, start=1):
+        update['update_id'] = update_id
+
+    return updates
+
+
+def find_raw_ids(data: typing.Any, path: str = '') -> typing.Iterator[str]:
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from find_raw_ids(value, f'{path}.{key}')
+    elif isinstance(data, list):
+        for index, item in enumerate(data):
+            yield from find_raw_ids(item, f'{path}[{index}]')
+    elif any(str(abs(raw_id)) in str(data) for raw_id in RAW_IDS):
+        # The ids are also searched in the texts, as the negative chat ids contain the positive ones.
+        yield f'{path} = {data}'
+
+
+def check(cli_args: argparse.Namespace) -> bool:
+    sys.path.insert(0, run.SOURCE_PATH)
+
+    import recording
+
+    bot = telegram.Bot(run.BOT_TOKEN)
+    recorder = recording.UpdateRecorder('', cli_args.salt)
+    is_anonymized = True
+
+    for update_data in create_updates():
+        # The updates are recorded after being parsed, like in the bot.
+        update = telegram.Update.de_json(update_data, bot)
+
+        if update is None:
+            continue
+
+        anonymized_update = recorder.anonymize(update.to_dict())
+
+        for raw_id_path in find_raw_ids(anonymized_update):
+            logger.error(f'Update {update.update_id} kept a raw id at {raw_id_path}')
+
+            is_anonymized = False
+
+    return is_anonymized
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the recorded updates keep no user or chat id.')
+
+    parser.add_argument('-s', '--salt', default='anonymization-check', help='The salt of the hashed ids')
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+    if not check(parser.parse_args()):
+        sys.exit(1)
+
+    logger.info('No raw id was recorded')
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import typing
+
+import ffmpeg
+import PIL.Image
+import PIL.ImageDraw
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'manifest.json'
+
+VIDEO_SOURCE = 'testsrc2=size={width}x{height}:rate=30'
+AUDIO_SOURCE = 'sine=frequency=440:sample_rate=48000'
+
+# Keyed by the codec names from `constants.VIDEO_CODEC_NAMES`. ffmpeg can decode VP6, but it has no encoder for it.
+VIDEO_ENCODINGS: typing.Dict[str, typing.Tuple[str, str, str, typing.Dict[str, typing.Any]]] = {
+    'h264': ('mp4', 'video/mp4', 'libx264', {'pix_fmt': 'yuv420p', 'acodec': 'aac'}),
+    'hevc': ('mp4', 'video/mp4', 'libx265', {'pix_fmt': 'yuv420p', 'tag:v': 'hvc1', 'acodec': 'aac'}),
+    'mpeg4': ('avi', 'video/x-msvideo', 'mpeg4', {'acodec': 'libmp3lame'}),
+    'vp8': ('webm', 'video/webm', 'libvpx', {'acodec': 'libopus'})
+}
+
+# Keyed by the codec names from `constants.AUDIO_CODEC_NAMES`.
+AUDIO_ENCODINGS: typing.Dict[str, typing.Tuple[str, str, str]] = {
+    'aac': ('m4a', 'audio/mp4', 'aac'),
+    'mp3': ('mp3', 'audio/mpeg', 'libmp3lame')
+}
+
+
+class CorpusItem:
+    def __init__(self, name: str, message_type: str, mime_type: str, output_type: str, duration: int = 0, width: int = 0, height: int = 0) -> None:
+        self.name = name
+        self.message_type = message_type
+        self.mime_type = mime_type
+        self.output_type = output_type
+        self.duration = duration
+        self.width = width
+        self.height = height
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, data: typing.Dict[str, typing.Any]) -> 'CorpusItem':
+        return cls(**data)
+
+
+def generate_video(path: str, codec_name: str, duration: int, width: int, height: int) -> str:
+    (extension, _mime_type, encoder, arguments) = VIDEO_ENCODINGS[codec_name]
+    name = f'video_{codec_name}_{width}x{height}.{extension}'
+
+    video = ffmpeg.input(VIDEO_SOURCE.format(width=width, height=height), f='lavfi', t=duration)
+    audio = ffmpeg.input(AUDIO_SOURCE, f='lavfi', t=duration)
+
+    (
+        ffmpeg
+            .output(video, audio, os.path.join(path, name), vcodec=encoder, **arguments)
+            .overwrite_output()
+            .run(quiet=True)
+    )
+
+    return name
+
+
+def generate_audio(path: str, codec_name: str, duration: int) -> str:
+    (extension, _mime_type, encoder) = AUDIO_ENCODINGS[codec_name]
+    name = f'audio_{codec_name}.{extension}'
+
+    (
+        ffmpeg
+            .input(AUDIO_SOURCE, f='lavfi', t=duration)
+            .output(os.path.join(path, name), acodec=encoder)
+            .overwrite_output()
+            .run(quiet=True)
+    )
+
+    return name
+
+
+def generate_voice(path: str, duration: int) -> str:
+    name = 'voice.ogg'
+
+    (
+        ffmpeg
+            .input(AUDIO_SOURCE, f='lavfi', t=duration)
+            .output(os.path.join(path, name), acodec='libopus', ac=1, audio_bitrate='32k')
+            .overwrite_output()
+            .run(quiet=True)
+    )
+
+    return name
+
+
+def create_image(width: int, height: int, text: str) -> PIL.Image.Image:
+    image = PIL.Image.new('RGB', (width, height), 'white')
+    draw = PIL.ImageDraw.Draw(image)
+
+    for offset in range(0, max(width, height), 32):
+        draw.line([(offset, 0), (0, offset)], fill='steelblue', width=4)
+
+    draw.text((width // 10, height // 10), text, fill='black')
+
+    return image
+
+
+def generate_pdf(path: str, pages_count: int) -> str:
+    name = f'document_{pages_count}_pages.pdf'
+    pages = [create_image(1240, 1754, f'Page {index + 1}') for index in range(pages_count)]
+
+    pages[0].save(os.path.join(path, name), format='PDF', save_all=True, append_images=pages[1:], resolution=150)
+
+    return name
+
+
+def generate_image(path: str, image_format: str, width: int, height: int) -> str:
+    name = f'image_{width}x{height}.{image_format.lower()}'
+
+    create_image(width, height, name).save(os.path.join(path, name), format=image_format)
+
+    return name
+
+
+def generate_sticker(path: str) -> str:
+    name = 'sticker.webp'
+
+    create_image(512, 512, 'Sticker').save(os.path.join(path, name), format='WEBP')
+
+    return name
+
+
+def generate(path: str, duration: int) -> typing.List[CorpusItem]:
+    os.makedirs(path, exist_ok=True)
+
+    items: typing.List[CorpusItem] = []
+
+    for codec_name, (_extension, mime_type, _encoder, _arguments) in VIDEO_ENCODINGS.items():
+        for (width, height) in [(1280, 720), (640, 480)]:
+            logger.info(f'Generating {codec_name} video of {width}x{height}')
+
+            name = generate_video(path, codec_name, duration, width, height)
+
+            items.append(CorpusItem(name, 'document', mime_type, 'video', duration, width, height))
+
+            if codec_name == 'h264':
+                items.append(CorpusItem(name, 'video', mime_type, 'video_note', duration, width, height))
+
+    for codec_name, (_extension, mime_type, _encoder) in AUDIO_ENCODINGS.items():
+        logger.info(f'Generating {codec_name} audio')
+
+        items.append(CorpusItem(generate_audio(path, codec_name, duration), 'audio', mime_type, 'audio', duration))
+
+    logger.info('Generating the voice, images and documents')
+
+    items.append(CorpusItem(generate_voice(path, duration), 'voice', 'audio/ogg', 'file', duration))
+    items.append(CorpusItem(generate_pdf(path, 1), 'document', 'application/pdf', 'photo'))
+    items.append(CorpusItem(generate_pdf(path, 10), 'document', 'application/pdf', 'photo'))
+    items.append(CorpusItem(generate_image(path, 'PNG', 1920, 1080), 'document', 'image/png', 'sticker'))
+    items.append(CorpusItem(generate_image(path, 'JPEG', 4000, 3000), 'document', 'image/jpeg', 'sticker'))
+    items.append(CorpusItem(generate_sticker(path), 'sticker', 'image/webp', 'photo', width=512, height=512))
+
+    with open(os.path.join(path, MANIFEST_FILENAME), 'w') as manifest_file:
+        json.dump([item.to_dict() for item in items], manifest_file, indent=4)
+
+    return items
+
+
+def load(path: str) -> typing.List[CorpusItem]:
+    with open(os.path.join(path, MANIFEST_FILENAME)) as manifest_file:
+        return [CorpusItem.from_dict(data) for data in json.load(manifest_file)]
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+import peewee
+
+import run
+
+logger = logging.getLogger(__name__)
+
+# The settings the database had before the write-ahead log, which are compared with the current ones.
+BASELINE_PRAGMAS: typing.Dict[str, typing.Any] = {}
+BASELINE_BUSY_TIMEOUT = 5
+
+
+def write_user(database_module: typing.Any, id: int, username: str) -> None:
+    # The write path before the known users cache, which wrote every update of a user right away.
+    user_model = database_module.User
+    current_date_time = database_module.get_current_datetime()
+
+    try:
+        defaults = {
+            'telegram_username': username,
+
+            'updated_at': current_date_time
+        }
+
+        (db_user, _is_created) = user_model.get_or_create(telegram_id=id, defaults=defaults)
+
+        db_user.telegram_username = username
+        db_user.updated_at = current_date_time
+
+        db_user.save()
+    except peewee.PeeweeException as error:
+        logger.error(f'Database error: "{error}" for id: {id} and username: {username}')
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__(logging.ERROR)
+
+        self.count = 0
+        self.count_lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        with self.count_lock:
+            self.count += 1
+
+
+def stress(database_module: typing.Any, path: str, pragmas: typing.Dict[str, typing.Any], busy_timeout: float, is_batched: bool, cli_args: argparse.Namespace) -> typing.Tuple[float, int]:
+    database = database_module.database
+    user_model = database_module.User
+    conversion_model = database_module.Conversion
+
+    database.close()
+    database.init(path, pragmas=pragmas, timeout=busy_timeout)
+
+    with database.connection_context():
+        database.create_tables([user_model, conversion_model])
+
+    # Every repeated user is written again, so the flushes contend with the new users.
+    user_model.known_users.clear()
+    user_model.pending_updates = {}
+    user_model.update_granularity = 0
+
+    error_counter = ErrorCounter()
+    stop_event = threading.Event()
+
+    logging.getLogger(database_module.__name__).addHandler(error_counter)
+    logger.addHandler(error_counter)
+
+    def create_users(thread_index: int) -> None:
+        with database_module.connection():
+            for index in range(cli_args.users):
+                user_id = thread_index * cli_args.users + index
+
+                for _repeat in range(2):
+                    if is_batched:
+                        user_model.create_or_update_user(user_id, f'user{user_id}')
+                    else:
+                        write_user(database_module, user_id, f'user{user_id}')
+
+                conversion_model.cache_output(f'input{user_id}', 1, 'video', f'output{user_id}')
+
+    def flush_users() -> None:
+        with database_module.connection():
+            while not stop_event.wait(cli_args.flush_interval):
+                user_model.flush_pending_updates()
+
+            user_model.flush_pending_updates()
+
+    flusher = threading.Thread(target=flush_users, name='users-flusher')
+    threads = [threading.Thread(target=create_users, args=(thread_index,), name=f'stress-{thread_index}') for thread_index in range(cli_args.threads)]
+
+    start_time = time.monotonic()
+
+    if is_batched:
+        flusher.start()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    duration = time.monotonic() - start_time
+
+    stop_event.set()
+
+    if is_batched:
+        flusher.join()
+
+    logging.getLogger(database_module.__name__).removeHandler(error_counter)
+    logger.removeHandler(error_counter)
+
+    database.close()
+
+    return cli_args.threads * cli_args.users / duration, error_counter.count
+
+
+def measure(cli_args: argparse.Namespace) -> bool:
+    # The database module opens its file in the working directory as soon as it is imported.
+    working_path = tempfile.mkdtemp(prefix='file_convert_database_stress_')
+
+    os.chdir(working_path)
+
+    sys.path.insert(0, run.SOURCE_PATH)
+
+    import constants
+    import database
+
+    # The baseline writes every user update right away with the old settings, and the current code batches them.
+    modes = [
+        ('baseline', BASELINE_PRAGMAS, BASELINE_BUSY_TIMEOUT, False),
+        ('current', constants.DATABASE_PRAGMAS, constants.DATABASE_BUSY_TIMEOUT, True)
+    ]
+
+    print(f'{"mode":<10} {"users/s":>10} {"errors":>8}')
+
+    has_errors = False
+
+    try:
+        for name, pragmas, busy_timeout, is_batched in modes:
+            (users_per_second, errors_count) = stress(database, os.path.join(working_path, f'{name}.sqlite'), pragmas, busy_timeout, is_batched, cli_args)
+
+            print(f'{name:<10} {users_per_second:>10.1f} {errors_count:>8}')
+
+            # Only the current code is expected to never fail.
+            if name == 'current' and errors_count:
+                has_errors = True
+    finally:
+        shutil.rmtree(working_path, ignore_errors=True)
+
+    return not has_errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create users from many threads at once, with the old and the current write path and SQLite settings.')
+
+    parser.add_argument('-t', '--threads', type=int, default=16, help='The number of threads writing at once')
+    parser.add_argument('-u', '--users', type=int, default=300, help='The number of users created by each thread')
+    parser.add_argument('-f', '--flush-interval', type=float, default=0.05, help='How often the pending user updates are written, in seconds')
+
+    if not measure(parser.parse_args()):
+        sys.exit(1)
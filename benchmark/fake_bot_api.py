@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+import email.parser
+import email.policy
+import http.server
+import json
+import logging
+import os
+import re
+import threading
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+BOT_PATH_PATTERN = re.compile(r'^/bot(?P<token>[^/]+)/(?P<method>\w+)$')
+FILE_PATH_PATTERN = re.compile(r'^/file/bot(?P<token>[^/]+)/(?P<path>.+)$')
+RANGE_PATTERN = re.compile(r'^bytes=(?P<start>\d+)-(?P<end>\d*)$')
+
+CHUNK_SIZE = 64 * 1024
+
+SENT_MESSAGE_TYPES = {
+    'sendVoice': 'voice',
+    'sendVideo': 'video',
+    'sendVideoNote': 'video_note',
+    'sendPhoto': 'photo',
+    'sendSticker': 'sticker',
+    'sendDocument': 'document',
+    'sendAudio': 'audio',
+    'sendMessage': 'text'
+}
+
+
+class Completion:
+    def __init__(self, method: str, size: int) -> None:
+        self.method = method
+        self.size = size
+        self.time = time.monotonic()
+
+    @property
+    def is_failed(self) -> bool:
+        return self.method == 'sendMessage'
+
+
+class FakeBotApi:
+    def __init__(self, files_path: str) -> None:
+        self.files_path = os.path.abspath(files_path)
+
+        self.condition = threading.Condition()
+        self.completions: typing.Dict[int, Completion] = {}
+        self.message_ids = iter(range(1, 2 ** 31))
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.create_request_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever, name='fake-bot-api', daemon=True).start()
+
+        logger.info(f'Started the fake Bot API on {self.base_url}')
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_file_path(self, file_path: str) -> typing.Optional[str]:
+        path = os.path.abspath(os.path.join(self.files_path, file_path))
+
+        if not path.startswith(self.files_path + os.sep) or not os.path.isfile(path):
+            return None
+
+        return path
+
+    def complete(self, reply_to_message_id: int, completion: Completion) -> None:
+        with self.condition:
+            self.completions[reply_to_message_id] = completion
+
+            self.condition.notify_all()
+
+    def wait(self, message_ids: typing.Iterable[int], timeout: float) -> typing.Dict[int, Completion]:
+        message_ids = set(message_ids)
+        end_time = time.monotonic() + timeout
+
+        with self.condition:
+            while not message_ids.issubset(self.completions):
+                remaining_time = end_time - time.monotonic()
+
+                if remaining_time <= 0:
+                    break
+
+                self.condition.wait(remaining_time)
+
+            return {message_id: self.completions[message_id] for message_id in message_ids if message_id in self.completions}
+
+    def create_message(self, chat_id: int, message_type: str, text: typing.Optional[str]) -> typing.Dict[str, typing.Any]:
+        message_id = next(self.message_ids)
+        file = {
+            'file_id': f'sent-{message_id}',
+            'file_unique_id': f'sent-{message_id}',
+            'width': 512,
+            'height': 512,
+            'duration': 1,
+            'length': 512,
+            'is_animated': False
+        }
+
+        message: typing.Dict[str, typing.Any] = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {
+                'id': chat_id,
+                'type': 'private'
+            }
+        }
+
+        if message_type == 'text':
+            message['text'] = text or ''
+        elif message_type == 'photo':
+            message['photo'] = [file]
+        else:
+            message[message_type] = file
+
+        return message
+
+    def call(self, method: str, parameters: typing.Dict[str, typing.Any], upload_size: int) -> typing.Any:
+        if method == 'getMe':
+            return {
+                'id': 1,
+                'is_bot': True,
+                'first_name': 'Benchmark',
+                'username': 'BenchmarkBot'
+            }
+        elif method == 'getFile':
+            file_id = str(parameters['file_id'])
+            path = self.get_file_path(file_id)
+
+            if path is None:
+                return None
+
+            return {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_size': os.path.getsize(path),
+                'file_path': file_id
+            }
+        elif method in ['sendChatAction', 'answerCallbackQuery']:
+            return True
+
+        message_type = SENT_MESSAGE_TYPES.get(method)
+
+        if message_type is None:
+            return None
+
+        reply_to_message_id = parameters.get('reply_to_message_id')
+
+        if reply_to_message_id is not None:
+            self.complete(int(reply_to_message_id), Completion(method, upload_size))
+
+        return self.create_message(int(parameters.get('chat_id', 0)), message_type, parameters.get('text'))
+
+    def create_request_handler(self) -> typing.Type[http.server.BaseHTTPRequestHandler]:
+        fake_bot_api = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def send_json(self, status: int, data: typing.Dict[str, typing.Any]) -> None:
+                body = json.dumps(data).encode('utf-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+
+                self.wfile.write(body)
+
+            def read_body(self) -> typing.Optional[bytes]:
+                if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+                    return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+                # The streamed uploads are sent in chunks, as their size isn't known in advance.
+                body = bytearray()
+
+                while True:
+                    chunk_size_line = self.rfile.readline()
+
+                    # The bot closes the connection in the middle of the upload when the conversion fails.
+                    if not chunk_size_line:
+                        return None
+
+                    chunk_size = int(chunk_size_line.split(b';')[0], 16)
+
+                    if chunk_size == 0:
+                        break
+
+                    body.extend(self.rfile.read(chunk_size))
+
+                    self.rfile.readline()
+
+                # The empty line after the last chunk ends the body, as there are no trailers.
+                self.rfile.readline()
+
+                return bytes(body)
+
+            def read_parameters(self) -> typing.Optional[typing.Tuple[typing.Dict[str, typing.Any], int]]:
+                body = self.read_body()
+                content_type = self.headers.get('Content-Type', '')
+
+                if body is None:
+                    return None
+
+                if not body:
+                    return {}, 0
+
+                if content_type.startswith('multipart/form-data'):
+                    parameters: typing.Dict[str, typing.Any] = {}
+                    upload_size = 0
+
+                    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                        f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + body
+                    )
+
+                    for part in message.iter_parts():
+                        name = str(part.get_param('name', header='content-disposition'))
+                        payload = typing.cast(bytes, part.get_payload(decode=True) or b'')
+
+                        if part.get_filename() is not None:
+                            upload_size += len(payload)
+                        else:
+                            parameters[name] = payload.decode('utf-8')
+
+                    return parameters, upload_size
+
+                return json.loads(body), 0
+
+            def do_POST(self) -> None:
+                match = BOT_PATH_PATTERN.match(self.path)
+
+                if match is None:
+                    self.send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+                    return
+
+                request = self.read_parameters()
+
+                if request is None:
+                    self.close_connection = True
+
+                    return
+
+                (parameters, upload_size) = request
+                result = fake_bot_api.call(match.group('method'), parameters, upload_size)
+
+                if result is None:
+                    self.send_json(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request'})
+
+                    return
+
+                self.send_json(200, {'ok': True, 'result': result})
+
+            def do_GET(self) -> None:
+                match = FILE_PATH_PATTERN.match(self.path)
+                path = fake_bot_api.get_file_path(match.group('path')) if match is not None else None
+
+                if path is None:
+                    self.send_error(404)
+
+                    return
+
+                size = os.path.getsize(path)
+                start = 0
+                end = size - 1
+
+                # ffmpeg seeks with range requests in inputs that have their index at the end.
+                range_match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+
+                if range_match is not None:
+                    start = int(range_match.group('start'))
+
+                    if range_match.group('end'):
+                        end = min(int(range_match.group('end')), end)
+
+                    if start > end:
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{size}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+
+                        return
+
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                else:
+                    self.send_response(200)
+
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(end - start + 1))
+                self.end_headers()
+
+                with open(path, 'rb') as file:
+                    file.seek(start)
+
+                    remaining_size = end - start + 1
+
+                    while remaining_size > 0:
+                        chunk = file.read(min(CHUNK_SIZE, remaining_size))
+
+                        if not chunk:
+                            break
+
+                        try:
+                            self.wfile.write(chunk)
+                        except (BrokenPipeError, ConnectionResetError):
+                            return
+
+                        remaining_size -= len(chunk)
+
+            def log_message(self, format: str, *args: typing.Any) -> None:
+                pass
+
+        return RequestHandler
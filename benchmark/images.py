@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import typing
+
+import corpus
+import run
+
+logger = logging.getLogger(__name__)
+
+LARGE_IMAGES = [
+    ('JPEG', 8000, 6000),
+    ('JPEG', 4032, 3024),
+    ('PNG', 4000, 3000),
+    ('WEBP', 4000, 3000)
+]
+
+
+def generate(path: str) -> typing.List[str]:
+    os.makedirs(path, exist_ok=True)
+
+    names = []
+
+    for image_format, width, height in LARGE_IMAGES:
+        name = f'image_{width}x{height}.{image_format.lower()}'
+
+        if not os.path.isfile(os.path.join(path, name)):
+            logger.info(f'Generating {name}')
+
+            corpus.generate_image(path, image_format, width, height)
+
+        names.append(name)
+
+    return names
+
+
+def measure_image(path: str, name: str, repeat: int, settings: typing.List[str]) -> typing.Tuple[str, int, float, int]:
+    import converters
+    import staging
+
+    for setting in settings:
+        (option, _, value) = setting.partition('=')
+        (image_format, _, config_name) = option.partition('.')
+
+        converters.image_renderer.configure(image_format, config_name, value)
+
+    input_path = os.path.join(path, name)
+    durations = []
+    output_type = ''
+    output_size = 0
+
+    # The pixels are allocated by PIL outside of the Python heap, so the memory is sampled from the process.
+    base_rss = run.get_process_rss(os.getpid())
+
+    with run.RssSampler() as rss_sampler:
+        for _index in range(repeat):
+            with staging.StagedInput(input_path, local_path=input_path) as staged_input, io.BytesIO() as output_bytes:
+                start_time = time.monotonic()
+
+                result = converters.convert_image(staged_input, output_bytes, name, None)
+
+                durations.append(time.monotonic() - start_time)
+
+                output_type = result.output_type
+                output_size = output_bytes.tell()
+
+    return output_type, output_size, sum(durations) / len(durations), max(0, rss_sampler.peak_rss - base_rss)
+
+
+def measure(cli_args: argparse.Namespace) -> None:
+    path = os.path.abspath(cli_args.path)
+    names = generate(path)
+
+    sys.path.insert(0, run.SOURCE_PATH)
+
+    print(f'{"input":<24} {"output type":<12} {"output KB":>10} {"ms/image":>10} {"peak MB":>8}')
+
+    for name in names:
+        # Each image is converted in a new process, as the memory freed by the previous ones isn't always returned.
+        with multiprocessing.Pool(1) as pool:
+            (output_type, output_size, duration, peak_size) = pool.apply(measure_image, (path, name, cli_args.repeat, cli_args.setting))
+
+        print(f'{name:<24} {output_type:<12} {output_size / 1024:>10.1f} {duration * 1000:>10.1f} {peak_size / 1024 / 1024:>8.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the speed and the peak memory of the image to sticker conversions.')
+
+    parser.add_argument('-p', '--path', default=os.path.join(run.DEFAULT_CORPUS_PATH, 'images'), help='The directory of the generated large images')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='The number of conversions of each image')
+    parser.add_argument('-s', '--setting', action='append', default=[], help='An encoder setting, like "WEBP.Method=6", which can be repeated')
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+    measure(parser.parse_args())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import itertools
+import logging
+import os
+import sys
+import time
+import typing
+import zlib
+
+import corpus
+import fake_bot_api
+import run
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_KEYS = ['document', 'audio', 'voice', 'video', 'video_note', 'sticker', 'animation']
+
+
+def get_file_kind(message_type: str, mime_type: typing.Optional[str]) -> typing.Optional[str]:
+    if message_type != 'document':
+        return message_type
+
+    if mime_type is None:
+        return None
+
+    if mime_type == 'application/pdf':
+        return 'pdf'
+
+    for prefix in ['image', 'video', 'audio']:
+        if mime_type.startswith(f'{prefix}/'):
+            return prefix
+
+    return None
+
+
+def get_items_by_kind(items: typing.List[corpus.CorpusItem]) -> typing.Dict[str, typing.List[corpus.CorpusItem]]:
+    items_by_kind: typing.Dict[str, typing.List[corpus.CorpusItem]] = collections.defaultdict(list)
+
+    for item in items:
+        kind = get_file_kind(item.message_type, item.mime_type)
+
+        if kind is not None and item not in items_by_kind[kind]:
+            items_by_kind[kind].append(item)
+
+    # Recorded animations and round videos are replayed with the videos of the corpus.
+    items_by_kind['animation'] = items_by_kind['video_note'] = items_by_kind['video']
+
+    return items_by_kind
+
+
+class Replayer:
+    def __init__(self, corpus_path: str, items: typing.List[corpus.CorpusItem], are_links_replayed: bool) -> None:
+        self.corpus_path = corpus_path
+        self.items_by_kind = get_items_by_kind(items)
+        self.are_links_replayed = are_links_replayed
+
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+        self.skipped_counts: typing.Counter[str] = collections.Counter()
+
+    def replace_file(self, message: typing.Dict[str, typing.Any]) -> bool:
+        for key in ATTACHMENT_KEYS:
+            file = message.get(key)
+
+            if file is None:
+                continue
+
+            kind = get_file_kind(key, file.get('mime_type'))
+            items = self.items_by_kind.get(kind or '', [])
+
+            if not items:
+                self.skipped_counts[f'{key} {file.get("mime_type")}'] += 1
+
+                return False
+
+            # The same recorded file is always replaced with the same corpus file, so the repeats still hit the cache.
+            item = items[zlib.crc32(file['file_unique_id'].encode('utf-8')) % len(items)]
+
+            file['file_id'] = item.name
+            file['file_size'] = os.path.getsize(os.path.join(self.corpus_path, item.name))
+            file['mime_type'] = item.mime_type
+
+            if 'file_name' in file:
+                file['file_name'] = item.name
+
+        return True
+
+    def prepare(self, update_data: typing.Dict[str, typing.Any]) -> typing.Optional[typing.Tuple[int, typing.Dict[str, typing.Any]]]:
+        message = update_data.get('message')
+
+        if message is None:
+            self.skipped_counts['not a message'] += 1
+
+            return None
+
+        if not self.are_links_replayed and any(entity.get('type') == 'url' for entity in message.get('entities', [])):
+            self.skipped_counts['link'] += 1
+
+            return None
+
+        if not self.replace_file(message):
+            return None
+
+        # The recorded ids are only unique in their chat, and the jobs are keyed by the update id.
+        message_id = next(self.message_ids)
+
+        message['message_id'] = message_id
+        update_data['update_id'] = next(self.update_ids)
+
+        return message_id, update_data
+
+
+def replay(cli_args: argparse.Namespace) -> typing.List[run.Result]:
+    (corpus_path, items) = run.load_corpus(cli_args)
+
+    sys.path.insert(0, run.SOURCE_PATH)
+
+    import recording
+
+    recorded_updates = list(recording.read_updates(os.path.abspath(cli_args.log)))
+
+    server = fake_bot_api.FakeBotApi(corpus_path)
+    bot = run.Bot(server, cli_args.workers, cli_args.keep)
+    replayer = Replayer(corpus_path, items, cli_args.links)
+
+    bot.start()
+
+    start_times: typing.Dict[int, float] = {}
+
+    with run.RssSampler() as rss_sampler:
+        start_time = time.monotonic()
+        first_recorded_time = recorded_updates[0][0] if recorded_updates else 0
+
+        for recorded_time, update_data in recorded_updates:
+            prepared_update = replayer.prepare(update_data)
+
+            if prepared_update is None:
+                continue
+
+            (message_id, update_data) = prepared_update
+
+            if cli_args.speed > 0:
+                delay = start_time + (recorded_time - first_recorded_time) / cli_args.speed - time.monotonic()
+
+                if delay > 0:
+                    time.sleep(delay)
+
+            start_times[message_id] = time.monotonic()
+
+            bot.put_update(update_data)
+
+        completions = server.wait(start_times.keys(), cli_args.timeout)
+
+    bot.stop()
+
+    for reason, count in sorted(replayer.skipped_counts.items()):
+        logger.info(f'Skipped {count} updates: {reason}')
+
+    results_by_method: typing.Dict[str, run.Result] = {}
+
+    for message_id, completion in completions.items():
+        result = results_by_method.get(completion.method)
+
+        if result is None:
+            result = run.Result(completion.method, 0)
+
+            result.peak_rss = rss_sampler.peak_rss
+
+            results_by_method[completion.method] = result
+
+        result.jobs_count += 1
+        result.latencies.append(completion.time - start_times[message_id])
+        result.duration = max(result.duration, completion.time - start_time)
+
+    # Unlike in the benchmark, a reply with a message isn't a failure, as the recorded updates include unsupported files.
+    unanswered_result = run.Result('unanswered', len(start_times) - len(completions))
+
+    return sorted(results_by_method.values(), key=lambda result: result.output_type) + [unanswered_result]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded updates against a local fake Bot API.')
+
+    parser.add_argument('log', help='The recorded updates file')
+    parser.add_argument('-s', '--speed', type=float, default=1, help='The replay speed, with 0 meaning as fast as possible')
+    parser.add_argument('-l', '--links', action='store_true', help='Replay the links too, which are downloaded from the internet')
+    parser.add_argument('-c', '--corpus', default=run.DEFAULT_CORPUS_PATH, help='The directory of the generated inputs')
+    parser.add_argument('-g', '--generate', action='store_true', help='Generate the inputs again')
+    parser.add_argument('-d', '--duration', type=int, default=10, help='The duration of the generated media, in seconds')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='The number of dispatcher workers')
+    parser.add_argument('-t', '--timeout', type=float, default=600, help='How long to wait for the last replies, in seconds')
+    parser.add_argument('-k', '--keep', action='store_true', help='Keep the working directory with the database and logs')
+
+    run.print_results(replay(parser.parse_args()))
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import itertools
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+import telegram
+import telegram.ext
+
+import corpus
+import fake_bot_api
+
+BOT_TOKEN = '123456:BENCHMARK'
+ADMIN_USER_ID = 1
+
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+DEFAULT_CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+RSS_SAMPLING_INTERVAL = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+def get_process_rss(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return 0
+
+
+def get_child_pids(pid: int) -> typing.List[int]:
+    child_pids: typing.List[int] = []
+
+    try:
+        for task_id in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task_id}/children') as children_file:
+                child_pids.extend(int(child_pid) for child_pid in children_file.read().split())
+    except OSError:
+        pass
+
+    return child_pids
+
+
+def get_tree_rss(pid: int) -> int:
+    return get_process_rss(pid) + sum(get_tree_rss(child_pid) for child_pid in get_child_pids(pid))
+
+
+class RssSampler:
+    # The bot and its ffmpeg and pdftoppm children are sampled together, as the conversions happen in the children.
+    def __init__(self) -> None:
+        self.peak_rss = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.sample, name='rss-sampler', daemon=True)
+
+    def sample(self) -> None:
+        while not self.stop_event.is_set():
+            self.peak_rss = max(self.peak_rss, get_tree_rss(os.getpid()))
+
+            self.stop_event.wait(RSS_SAMPLING_INTERVAL)
+
+    def __enter__(self) -> 'RssSampler':
+        if os.path.isdir('/proc'):
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, *_args: typing.Any) -> None:
+        self.stop_event.set()
+
+        if self.thread.is_alive():
+            self.thread.join()
+        else:
+            # Without procfs only the peak of the whole run is available, so the values per output type can't be
+            # compared.
+            self.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Result:
+    def __init__(self, output_type: str, jobs_count: int) -> None:
+        self.output_type = output_type
+        self.jobs_count = jobs_count
+        self.latencies: typing.List[float] = []
+        self.failures_count = 0
+        self.duration = 0.0
+        self.peak_rss = 0
+
+    def get_percentile(self, percentile: float) -> float:
+        if not self.latencies:
+            return float('nan')
+
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, max(0, round(percentile / 100 * len(latencies)) - 1))
+
+        return latencies[index]
+
+    def get_jobs_per_second(self) -> float:
+        if self.duration <= 0:
+            return 0.0
+
+        return len(self.latencies) / self.duration
+
+
+def create_update(update_id: int, message_id: int, user_id: int, item: corpus.CorpusItem, file_size: int) -> typing.Dict[str, typing.Any]:
+    file = {
+        'file_id': item.name,
+        'file_unique_id': f'{item.name}-{message_id}',
+        'file_size': file_size,
+        'mime_type': item.mime_type
+    }
+
+    if item.message_type in ['document', 'audio']:
+        file['file_name'] = item.name
+
+    if item.message_type in ['audio', 'voice', 'video']:
+        file['duration'] = item.duration
+
+    if item.message_type in ['video', 'sticker']:
+        file['width'] = item.width
+        file['height'] = item.height
+
+    if item.message_type == 'sticker':
+        file['is_animated'] = False
+        file['emoji'] = '🙂'
+        file['set_name'] = 'Benchmark'
+
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {
+                'id': user_id,
+                'type': 'private'
+            },
+            'from': {
+                'id': user_id,
+                'is_bot': False,
+                'first_name': 'Benchmark'
+            },
+            item.message_type: file
+        }
+    }
+
+
+def load_corpus(cli_args: argparse.Namespace) -> typing.Tuple[str, typing.List[corpus.CorpusItem]]:
+    corpus_path = os.path.abspath(cli_args.corpus)
+
+    if cli_args.generate or not os.path.exists(os.path.join(corpus_path, corpus.MANIFEST_FILENAME)):
+        items = corpus.generate(corpus_path, cli_args.duration)
+    else:
+        items = corpus.load(corpus_path)
+
+    return corpus_path, items
+
+
+class Bot:
+    def __init__(self, server: fake_bot_api.FakeBotApi, workers_count: int, is_working_directory_kept: bool) -> None:
+        self.server = server
+        self.is_working_directory_kept = is_working_directory_kept
+
+        # The bot creates its database and logs in the working directory.
+        self.working_path = tempfile.mkdtemp(prefix='file_convert_benchmark_')
+
+        shutil.copytree(os.path.join(SOURCE_PATH, 'migrations'), os.path.join(self.working_path, 'migrations'))
+        os.chdir(self.working_path)
+
+        sys.path.insert(0, SOURCE_PATH)
+
+        import analytics
+        import main
+        import uploading
+        import utils
+
+        main.cli_args = argparse.Namespace(debug=False, polling=True, set_webhook=False, server=False)
+        main.BOT_NAME = 'BenchmarkBot'
+        main.BOT_TOKEN = BOT_TOKEN
+        main.ADMIN_USER_ID = ADMIN_USER_ID
+        main.analytics_handler = analytics.AnalyticsHandler()
+
+        self.updater = telegram.ext.Updater(
+            bot=uploading.create_bot(BOT_TOKEN, f'{server.base_url}/bot', f'{server.base_url}/file/bot', workers_count),
+            workers=workers_count
+        )
+
+        main.updater = self.updater
+        main.add_handlers(self.updater.dispatcher)
+
+        # The conversions are what is measured, so the synthetic users are never rate limited.
+        utils.rate_limiter.configure(user_rate=1e9, user_burst=1_000_000_000, chat_rate=1e9, chat_burst=1_000_000_000)
+
+    def start(self) -> None:
+        self.server.start()
+
+        threading.Thread(target=self.updater.dispatcher.start, name='dispatcher', daemon=True).start()
+
+        self.updater.job_queue.start()
+
+    def put_update(self, update_data: typing.Dict[str, typing.Any]) -> None:
+        self.updater.dispatcher.update_queue.put(telegram.Update.de_json(update_data, self.updater.bot))
+
+    def stop(self) -> None:
+        self.updater.job_queue.stop()
+        self.updater.dispatcher.stop()
+        self.server.stop()
+
+        if not self.is_working_directory_kept:
+            shutil.rmtree(self.working_path, ignore_errors=True)
+
+
+def run(cli_args: argparse.Namespace) -> typing.List[Result]:
+    (corpus_path, items) = load_corpus(cli_args)
+
+    if cli_args.output_types:
+        items = [item for item in items if item.output_type in cli_args.output_types]
+
+    server = fake_bot_api.FakeBotApi(corpus_path)
+    bot = Bot(server, cli_args.workers, cli_args.keep)
+
+    bot.start()
+
+    update_ids = itertools.count(1)
+    message_ids = itertools.count(1)
+    user_ids = itertools.cycle(range(ADMIN_USER_ID + 1, ADMIN_USER_ID + 1 + cli_args.users))
+
+    items_by_output_type: typing.Dict[str, typing.List[corpus.CorpusItem]] = collections.defaultdict(list)
+
+    for item in items:
+        items_by_output_type[item.output_type].append(item)
+
+    results = []
+
+    for output_type, output_type_items in sorted(items_by_output_type.items()):
+        logger.info(f'Benchmarking {output_type} outputs')
+
+        jobs = [item for item in output_type_items for _ in range(cli_args.repeat)]
+        result = Result(output_type, len(jobs))
+        start_times: typing.Dict[int, float] = {}
+
+        with RssSampler() as rss_sampler:
+            start_time = time.monotonic()
+
+            for item in jobs:
+                message_id = next(message_ids)
+                update_data = create_update(next(update_ids), message_id, next(user_ids), item, os.path.getsize(os.path.join(corpus_path, item.name)))
+
+                start_times[message_id] = time.monotonic()
+
+                bot.put_update(update_data)
+
+            completions = server.wait(start_times.keys(), cli_args.timeout)
+
+        result.peak_rss = rss_sampler.peak_rss
+
+        for message_id, completion in completions.items():
+            if completion.is_failed:
+                result.failures_count += 1
+            else:
+                result.latencies.append(completion.time - start_times[message_id])
+
+        if completions:
+            result.duration = max(completion.time for completion in completions.values()) - start_time
+
+        results.append(result)
+
+    bot.stop()
+
+    return results
+
+
+def print_results(results: typing.List[Result]) -> None:
+    header = f'{"output type":<12} {"jobs":>6} {"failed":>6} {"missing":>7} {"jobs/s":>8} {"p50 s":>8} {"p95 s":>8} {"p99 s":>8} {"peak RSS MB":>11}'
+
+    print(header)
+    print('-' * len(header))
+
+    for result in results:
+        missing_count = result.jobs_count - len(result.latencies) - result.failures_count
+
+        print(
+            f'{result.output_type:<12} {result.jobs_count:>6} {result.failures_count:>6} {missing_count:>7} '
+            f'{result.get_jobs_per_second():>8.2f} {result.get_percentile(50):>8.2f} {result.get_percentile(95):>8.2f} '
+            f'{result.get_percentile(99):>8.2f} {result.peak_rss / 1024 / 1024:>11.1f}'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the conversion throughput against a local fake Bot API.')
+
+    parser.add_argument('-c', '--corpus', default=DEFAULT_CORPUS_PATH, help='The directory of the generated inputs')
+    parser.add_argument('-g', '--generate', action='store_true', help='Generate the inputs again')
+    parser.add_argument('-d', '--duration', type=int, default=10, help='The duration of the generated media, in seconds')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='How many times each input is sent')
+    parser.add_argument('-u', '--users', type=int, default=16, help='How many users the updates are spread across')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='The number of dispatcher workers')
+    parser.add_argument('-t', '--timeout', type=float, default=600, help='How long to wait for each output type, in seconds')
+    parser.add_argument('-o', '--output-types', nargs='*', help='Only benchmark these output types')
+    parser.add_argument('-k', '--keep', action='store_true', help='Keep the working directory with the database and logs')
+
+    print_results(run(parser.parse_args()))
@@ -24,8 +24,19 @@ class GlobalConfig:
         'main.py',
         'database.py',
         'utils.py',
+        'encoding.py',
+        'streaming.py',
+        'variants.py',
+        'scheduling.py',
+        'probing.py',
+        'staging.py',
+        'sniffing.py',
+        'converters.py',
+        'rendering.py',
         'telegram_utils.py',
         'analytics.py',
+        'metrics.py',
+        'recording.py',
         'constants.py',
 
         'custom_logger.py',
@@ -154,4 +165,8 @@ def backup(connection: fabric.Connection, filename: str) -> None:
 
 @fabric.task(pre=[configure], hosts=[GlobalConfig.host])
 def backup_db(context: fabric.Connection) -> None:
+    # Move the write-ahead log into the database file, so that the backup has every committed change.
+    with context.cd(GlobalConfig.project_name):
+        execute(context, 'python3 -c "import sqlite3; sqlite3.connect(\'file_convert.sqlite\').execute(\'PRAGMA wal_checkpoint(TRUNCATE)\')"')
+
     backup(context, 'file_convert.sqlite')
@@ -2,7 +2,10 @@
 
 import enum
 import logging
+import queue
+import threading
 import typing
+import urllib.parse
 
 import requests
 import telegram.ext
@@ -21,20 +24,111 @@ class AnalyticsHandler:
     def __init__(self) -> None:
         self.googleToken: typing.Optional[str] = None
         self.userAgent: typing.Optional[str] = None
+        self.batchUrl = constants.GOOGLE_ANALYTICS_BATCH_URL
 
-    def __google_track(self, analytics_type: AnalyticsType, user: telegram.User, data: str) -> None:
-        if not self.googleToken:
+        # Events are sent from a single thread of their own, so that they never take a worker from the conversions.
+        self.events: queue.Queue[typing.Optional[str]] = queue.Queue(maxsize=constants.ANALYTICS_QUEUE_SIZE)
+        self.session = requests.Session()
+        self.sender_thread: typing.Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+        self.sent_count = 0
+        self.dropped_count = 0
+
+    def start(self) -> None:
+        with self.lock:
+            if self.sender_thread is not None:
+                return
+
+            self.sender_thread = threading.Thread(target=self.__send_events, name='analytics', daemon=True)
+
+            self.sender_thread.start()
+
+    def stop(self) -> None:
+        with self.lock:
+            sender_thread = self.sender_thread
+
+            self.sender_thread = None
+
+        if sender_thread is None:
             return
 
-        url = constants.GOOGLE_ANALYTICS_BASE_URL.format(self.googleToken, user.id, analytics_type.value, data)
+        try:
+            self.events.put(None, timeout=constants.ANALYTICS_STOP_TIMEOUT)
+        except queue.Full:
+            pass
 
-        response = requests.get(url, headers={'User-Agent': self.userAgent or 'TelegramBot'})
+        sender_thread.join(timeout=constants.ANALYTICS_STOP_TIMEOUT)
+
+    def __get_batch(self, first_event: str) -> typing.Tuple[typing.List[str], bool]:
+        batch = [first_event]
+
+        while len(batch) < constants.ANALYTICS_BATCH_SIZE:
+            try:
+                event = self.events.get(timeout=constants.ANALYTICS_BATCH_DELAY)
+            except queue.Empty:
+                break
+
+            if event is None:
+                return batch, True
+
+            batch.append(event)
+
+        return batch, False
+
+    def __send_batch(self, batch: typing.List[str]) -> None:
+        try:
+            response = self.session.post(
+                self.batchUrl,
+                data='\n'.join(batch).encode('utf-8'),
+                headers={'User-Agent': self.userAgent or 'TelegramBot'},
+                timeout=constants.ANALYTICS_REQUEST_TIMEOUT
+            )
+        except requests.RequestException as error:
+            logger.error(f'Google analytics error: {error}')
+
+            return
 
         if response.status_code != 200:
             logger.error(f'Google analytics error: {response.status_code}')
 
-    def track(self, context: telegram.ext.CallbackContext, analytics_type: AnalyticsType, user: telegram.User, data='') -> None:
+            return
+
+        self.sent_count += len(batch)
+
+    def __send_events(self) -> None:
+        is_stopped = False
+
+        while not is_stopped:
+            event = self.events.get()
+
+            if event is None:
+                break
+
+            (batch, is_stopped) = self.__get_batch(event)
+
+            self.__send_batch(batch)
+
+    def track(self, _context: telegram.ext.CallbackContext, analytics_type: AnalyticsType, user: telegram.User, data='') -> None:
+        if not self.googleToken:
+            return
+
         if data is None:
             data = ''
 
-        context.dispatcher.run_async(self.__google_track, analytics_type, user, data)
+        event = urllib.parse.urlencode({
+            'v': 1,
+            't': 'event',
+            'tid': self.googleToken,
+            'cid': user.id,
+            'ec': analytics_type.value,
+            'ea': data
+        })
+
+        self.start()
+
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            with self.lock:
+                self.dropped_count += 1
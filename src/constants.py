@@ -3,7 +3,12 @@
 import datetime
 
 # See also: https://developers.google.com/analytics/devguides/collection/protocol/v1/parameters
-GOOGLE_ANALYTICS_BASE_URL = 'https://www.google-analytics.com/collect?v=1&t=event&tid={}&cid={}&ec={}&ea={}'
+GOOGLE_ANALYTICS_BATCH_URL = 'https://www.google-analytics.com/batch'
+ANALYTICS_QUEUE_SIZE = 1000
+ANALYTICS_BATCH_SIZE = 20  # The maximum number of hits allowed in a batch request.
+ANALYTICS_BATCH_DELAY = 1
+ANALYTICS_REQUEST_TIMEOUT = 10
+ANALYTICS_STOP_TIMEOUT = 5
 
 LOGS_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
@@ -22,6 +27,55 @@ VIDEO_NOTE_CROP_OFFSET_PARAMS = 'abs(in_w - in_h) / 2'
 VIDEO_NOTE_CROP_SIZE_PARAMS = 'min(in_w, in_h)'
 VIDEO_NOTE_SCALE_SIZE_PARAMS = 'min(min(in_w, in_h), {})'.format(MAX_VIDEO_NOTE_SIZE)
 
+# The ffmpeg defaults, which the conversions cached before the profiles were added were encoded with.
+DEFAULT_ENCODING_PROFILE = 'default'
+
+DEFAULT_WORKERS_COUNT = 8
+
+BOT_API_URL = 'https://api.telegram.org/bot'
+BOT_API_FILE_URL = 'https://api.telegram.org/file/bot'
+LOCAL_SERVER_MAX_FILESIZE_DOWNLOAD = int(2000e6)
+LOCAL_SERVER_MAX_FILESIZE_UPLOAD = int(2000e6)
+
+DEFAULT_USER_RATE = 0.2
+DEFAULT_USER_BURST = 5
+DEFAULT_CHAT_RATE = 0.5
+DEFAULT_CHAT_BURST = 10
+MAX_RATE_LIMIT_BUCKETS_COUNT = 10000
+
+DATABASE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16 * 1024,  # In KiB when negative.
+    'mmap_size': 64 * 1024 * 1024
+}
+DATABASE_BUSY_TIMEOUT = 10
+
+DEFAULT_METRICS_ADDRESS = '127.0.0.1'
+
+RECORDED_UPDATE_IDS_COUNT = 10000
+RECORDER_FLUSH_INTERVAL = 100
+ANONYMIZED_ID_RANGE = 2 ** 40
+# The salt of the sample config is public, so the ids hashed with it could be matched back.
+PLACEHOLDER_RECORDER_SALT = 'change-me'
+
+DEFAULT_USERS_FLUSH_INTERVAL = 5
+DEFAULT_USERS_UPDATE_GRANULARITY = 60
+KNOWN_USERS_CACHE_SIZE = 10000
+
+# See also: https://ffmpeg.org/ffmpeg-formats.html#Format-Options
+DEFAULT_PROBE_SIZE = 1 * 1000 * 1000
+DEFAULT_PROBE_ANALYZE_DURATION = 2 * 1000 * 1000
+DEFAULT_PROBE_CACHE_TTL = 10 * 60
+DEFAULT_PROBE_CACHE_SIZE = 256
+
+SNIFF_HEADER_SIZE = 4 * 1024
+SNIFF_REQUEST_TIMEOUT = 10
+
+MAX_JOB_ATTEMPTS = 3
+FINISHED_JOBS_RETENTION = datetime.timedelta(days=7)
+FINISHED_JOBS_DELETE_INTERVAL = datetime.timedelta(hours=1)
+
 
 class OutputType:
     NONE = 'none'
@@ -31,3 +85,133 @@ class OutputType:
     PHOTO = 'photo'
     STICKER = 'sticker'
     FILE = 'file'
+    ALBUM = 'album'
+
+
+DEFAULT_CONVERSION_SLOTS_COUNT = 2
+DEFAULT_CONVERSION_SLOTS_COUNTS = {
+    OutputType.AUDIO: 4,
+    OutputType.VIDEO: 2,
+    OutputType.VIDEO_NOTE: 2,
+    OutputType.FILE: 4
+}
+ENCODING_PROFILES = {
+    DEFAULT_ENCODING_PROFILE: {},
+    'fast': {
+        OutputType.VIDEO: {'preset': 'veryfast', 'crf': 26},
+        OutputType.VIDEO_NOTE: {'preset': 'ultrafast', 'crf': 28, 'threads': 2},
+        OutputType.AUDIO: {'audio_bitrate': '48k'},
+        OutputType.FILE: {'audio_bitrate': '128k'}
+    },
+    'balanced': {
+        OutputType.VIDEO: {'preset': 'faster', 'crf': 23, 'audio_bitrate': '128k'},
+        OutputType.VIDEO_NOTE: {'preset': 'veryfast', 'crf': 24, 'audio_bitrate': '96k', 'threads': 2},
+        OutputType.AUDIO: {'audio_bitrate': '64k'},
+        OutputType.FILE: {'audio_bitrate': '160k'}
+    },
+    'small': {
+        OutputType.VIDEO: {'preset': 'slow', 'crf': 28, 'audio_bitrate': '96k'},
+        OutputType.VIDEO_NOTE: {'preset': 'medium', 'crf': 30, 'audio_bitrate': '64k'},
+        OutputType.AUDIO: {'audio_bitrate': '32k'},
+        OutputType.FILE: {'audio_bitrate': '96k'}
+    }
+}
+
+# The muxing overhead is left out of the size budget of the outputs.
+OUTPUT_SIZE_BUDGET_RATIO = 0.95
+# The rate control buffer lets the video overshoot its bitrate by this many seconds' worth.
+VBV_BUFFER_DURATION = 1
+MIN_VIDEO_BITRATE = 100_000
+MIN_AUDIO_BITRATE = 16_000
+# The ffmpeg defaults of the aac, libopus and libmp3lame encoders.
+DEFAULT_AUDIO_BITRATES = {
+    OutputType.AUDIO: 96_000,
+    OutputType.VIDEO: 128_000,
+    OutputType.VIDEO_NOTE: 128_000,
+    OutputType.FILE: 128_000
+}
+# libmp3lame rounds other bitrates to the closest one of these, which can be higher.
+MP3_BITRATES = [8_000, 16_000, 24_000, 32_000, 40_000, 48_000, 56_000, 64_000, 80_000, 96_000, 112_000, 128_000, 160_000, 192_000, 224_000, 256_000, 320_000]
+
+# Telegram plays these without re-encoding, so they are only remuxed.
+COPYABLE_VIDEO_CODEC_NAMES = ['h264']
+COPYABLE_VIDEO_PIXEL_FORMATS = ['yuv420p', 'yuvj420p']
+COPYABLE_AUDIO_CODEC_NAMES = {
+    OutputType.AUDIO: ['opus'],
+    OutputType.VIDEO: ['aac', 'mp3'],
+    OutputType.FILE: ['mp3']
+}
+
+
+class CancelReason:
+    TIMEOUT = 'timeout'
+    SIZE = 'size'
+    USER = 'user'
+    RESTART = 'restart'
+
+
+STICKER_SIZE = 512
+# With a gap of 3, the resampling after the integer reduction looks the same as resampling the full image.
+IMAGE_REDUCING_GAP = 3.0
+DEFAULT_IMAGE_ENCODER_SETTINGS = {
+    'WEBP': {
+        'method': 4,
+        'quality': 80
+    },
+    'PNG': {
+        'compress_level': 6
+    }
+}
+
+
+class PdfMode:
+    PHOTO = 'photo'
+    ALBUM = 'album'
+
+
+PDF_POINTS_PER_INCH = 72
+MAX_PDF_DPI = 300
+PDF_RENDER_TIMEOUT = 120
+# Telegram downscales the photos to this longest side.
+PDF_PHOTO_SIZE = 2560
+PDF_ALBUM_PAGE_SIZE = 1280
+# The most photos a media group can have.
+MAX_PDF_ALBUM_PAGES_COUNT = 10
+DEFAULT_PDF_THREADS_COUNT = 4
+
+
+class VariantType:
+    VIDEO_NOTE = 'video_note'
+    THUMBNAIL = 'thumbnail'
+
+
+# Telegram only accepts thumbnails up to this size, in pixels and in bytes.
+THUMBNAIL_SIZE = 320
+MAX_THUMBNAIL_FILESIZE = 200 * 1000
+THUMBNAIL_QUALITY = 5
+SIDE_OUTPUT_TIMEOUT = 5
+DEFAULT_VARIANT_CACHE_DURATION = 10 * 60
+DEFAULT_VARIANT_CACHE_SIZE = int(100e6)
+
+WATCHDOG_INTERVAL = 1
+SHARED_OUTPUT_TIMEOUT = 120
+DEFAULT_CONVERSION_TIME_LIMIT = 600
+DEFAULT_CONVERSION_TIME_LIMITS = {
+    OutputType.AUDIO: 300,
+    OutputType.VIDEO: 900,
+    OutputType.VIDEO_NOTE: 180,
+    OutputType.FILE: 300
+}
+
+
+class ConversionPath:
+    STREAM_COPY = 'stream copy'
+    VIDEO_STREAM_COPY = 'video stream copy'
+    ENCODE = 'encode'
+
+
+class JobState:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
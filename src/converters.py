@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import typing
+
+import constants
+import rendering
+import sniffing
+import staging
+import streaming
+import utils
+
+logger = logging.getLogger(__name__)
+
+
+image_renderer = rendering.ImageRenderer(constants.DEFAULT_IMAGE_ENCODER_SETTINGS, constants.STICKER_SIZE)
+pdf_renderer = rendering.PdfRenderer(constants.PdfMode.PHOTO, constants.MAX_PDF_ALBUM_PAGES_COUNT, constants.DEFAULT_PDF_THREADS_COUNT, image_renderer)
+
+
+class ConversionResult:
+    def __init__(self, output_type: str = constants.OutputType.NONE, output_file: typing.Optional[utils.OutputFile] = None, invalid_format: typing.Optional[str] = None, output_files: typing.Optional[typing.List[io.BytesIO]] = None, error_text: typing.Optional[str] = None) -> None:
+        self.output_type = output_type
+        self.output_file = output_file
+        self.invalid_format = invalid_format
+        self.output_files = output_files or []
+        self.error_text = error_text
+
+    def __enter__(self) -> 'ConversionResult':
+        return self
+
+    def __exit__(self, *_args: typing.Any) -> None:
+        # A streamed output holds a conversion slot and an ffmpeg process until it is closed.
+        if isinstance(self.output_file, streaming.ConversionStream):
+            self.output_file.close()
+
+
+Converter = typing.Callable[[staging.StagedInput, io.BytesIO, str, typing.Optional[int]], ConversionResult]
+
+
+def convert_voice(staged_input: staging.StagedInput, _output_bytes: io.BytesIO, input_file_unique_id: str, user_id: typing.Optional[int]) -> ConversionResult:
+    output_type = constants.OutputType.FILE
+
+    # The probed duration lets the bitrate be capped, as long voices don't fit once converted to MP3.
+    probe_result = utils.prober.probe(staged_input.url, input_file_unique_id)
+    output_stream = utils.convert_stream(output_type, utils.upload_size_limit, input_audio_url=staged_input.url, probe_result=probe_result, name='voice.mp3', user_id=user_id)
+
+    return ConversionResult(output_type, output_stream)
+
+
+def convert_sticker(staged_input: staging.StagedInput, output_bytes: io.BytesIO, _input_file_unique_id: str, _user_id: typing.Optional[int]) -> ConversionResult:
+    try:
+        image_renderer.render_photo(staged_input.image_source, output_bytes)
+
+        return ConversionResult(constants.OutputType.PHOTO, output_bytes)
+    except Exception as error:
+        logger.error(f'PIL error: {error}')
+
+    return ConversionResult()
+
+
+def convert_media(staged_input: staging.StagedInput, _output_bytes: io.BytesIO, input_file_unique_id: str, user_id: typing.Optional[int]) -> ConversionResult:
+    probe_result = utils.prober.probe(staged_input.url, input_file_unique_id)
+
+    if not probe_result:
+        return ConversionResult()
+
+    invalid_format = None
+
+    for stream in probe_result.streams:
+        codec_name = stream.get('codec_name')
+
+        if codec_name is not None:
+            invalid_format = codec_name
+
+        if codec_name in constants.VIDEO_CODEC_NAMES:
+            output_type = constants.OutputType.VIDEO
+            output_stream = utils.convert_stream(output_type, utils.upload_size_limit, input_video_url=staged_input.url, probe_result=probe_result, user_id=user_id)
+
+            return ConversionResult(output_type, output_stream)
+
+    for stream in probe_result.streams:
+        codec_name = stream.get('codec_name')
+
+        if codec_name is not None:
+            invalid_format = codec_name
+
+        if codec_name in constants.AUDIO_CODEC_NAMES:
+            output_type = constants.OutputType.AUDIO
+            output_stream = utils.convert_stream(output_type, utils.upload_size_limit, input_audio_url=staged_input.url, probe_result=probe_result, user_id=user_id)
+
+            return ConversionResult(output_type, output_stream)
+        elif codec_name == 'opus':
+            # The passed through input is already under the download limit.
+            return ConversionResult(constants.OutputType.AUDIO, staged_input.open())
+
+    return ConversionResult(invalid_format=invalid_format)
+
+
+def convert_pdf(staged_input: staging.StagedInput, output_bytes: io.BytesIO, _input_file_unique_id: str, _user_id: typing.Optional[int]) -> ConversionResult:
+    try:
+        if pdf_renderer.mode == constants.PdfMode.ALBUM:
+            pages_bytes = pdf_renderer.render_album(staged_input)
+
+            if len(pages_bytes) > 1:
+                return ConversionResult(constants.OutputType.ALBUM, output_files=pages_bytes)
+
+            # A single page is sent as a photo, from the buffer whose size is checked before sending it.
+            output_bytes.write(pages_bytes[0].getbuffer())
+        else:
+            pdf_renderer.render_photo(staged_input, output_bytes)
+
+        return ConversionResult(constants.OutputType.PHOTO, output_bytes)
+    except rendering.NoPagesRenderedError as error:
+        logger.warning(f'pdf2image error: {error}')
+
+        return ConversionResult(error_text='The PDF file has no pages that could be converted.')
+    except Exception as error:
+        logger.error(f'pdf2image error: {error}')
+
+    return ConversionResult(invalid_format='pdf')
+
+
+def convert_image(staged_input: staging.StagedInput, output_bytes: io.BytesIO, _input_file_unique_id: str, _user_id: typing.Optional[int]) -> ConversionResult:
+    try:
+        image_renderer.render_sticker(staged_input.image_source, output_bytes)
+
+        return ConversionResult(constants.OutputType.STICKER, output_bytes)
+    except Exception as error:
+        logger.error(f'PIL error: {error}')
+
+    return ConversionResult()
+
+
+CONVERTERS: typing.Dict[str, Converter] = {
+    sniffing.InputKind.MEDIA: convert_media,
+    sniffing.InputKind.PDF: convert_pdf,
+    sniffing.InputKind.IMAGE: convert_image
+}
+
+
+def get_document_converter(header: bytes, mime_type: typing.Optional[str], is_private_chat: bool) -> typing.Optional[Converter]:
+    input_kind = sniffing.sniff(header, mime_type)
+
+    logger.info(f'Sniffed input kind: {input_kind}')
+
+    # ffmpeg knows more containers than the sniffer, so the unknown files that aren't described by their mime type are
+    # still probed, but only in private chats, where the unsupported files are reported.
+    if input_kind == sniffing.InputKind.UNKNOWN and is_private_chat and not sniffing.is_reliable_mime_type(mime_type):
+        return convert_media
+
+    return CONVERTERS.get(input_kind)
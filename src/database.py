@@ -2,8 +2,15 @@
 
 from __future__ import annotations
 
+import collections
+import contextlib
 import datetime
+import functools
+import json
 import logging
+import operator
+import threading
+import time
 import typing
 import uuid
 
@@ -14,16 +21,29 @@ import telegram
 
 import constants
 import telegram_utils
+import utils
 
 logger = logging.getLogger(__name__)
 
-database = peewee.SqliteDatabase('file_convert.sqlite')
+# Each thread gets its own connection, and the write-ahead log lets them read while another one writes.
+database = peewee.SqliteDatabase('file_convert.sqlite', pragmas=constants.DATABASE_PRAGMAS, timeout=constants.DATABASE_BUSY_TIMEOUT)
 
 database.connect()
 
 router = peewee_migrate.Router(database, migrate_table='migration', logger=logger)
 
 
+@contextlib.contextmanager
+def connection() -> typing.Iterator[None]:
+    is_opened = database.connect(reuse_if_open=True)
+
+    try:
+        yield
+    finally:
+        if is_opened:
+            database.close()
+
+
 def get_current_datetime() -> str:
     return datetime.datetime.now().strftime(constants.GENERIC_DATE_TIME_FORMAT)
 
@@ -78,10 +98,47 @@ class User(BaseModel):
 
         return f'{time_ago} ago'
 
+    users_lock = threading.Lock()
+
+    # The usernames and write times of recently seen users, so that most updates don't need to query the database.
+    known_users: typing.OrderedDict[int, typing.Tuple[typing.Optional[str], float]] = collections.OrderedDict()
+
+    # The latest username and update time of each user, written together by `flush_pending_updates`.
+    pending_updates: typing.Dict[int, typing.Tuple[typing.Optional[str], str]] = {}
+
+    update_granularity: float = constants.DEFAULT_USERS_UPDATE_GRANULARITY
+
+    @classmethod
+    def add_known_user(cls, id: int, username: typing.Optional[str]) -> None:
+        cls.known_users[id] = (username, time.monotonic())
+        cls.known_users.move_to_end(id)
+
+        while len(cls.known_users) > constants.KNOWN_USERS_CACHE_SIZE:
+            cls.known_users.popitem(last=False)
+
+    @classmethod
+    def remember_user(cls, id: int, username: typing.Optional[str], current_date_time: str) -> None:
+        cls.add_known_user(id, username)
+
+        cls.pending_updates[id] = (username, current_date_time)
+
     @classmethod
     def create_or_update_user(cls, id: int, username: typing.Optional[str]) -> typing.Optional[User]:
         current_date_time = get_current_datetime()
 
+        with cls.users_lock:
+            known_user = cls.known_users.get(id)
+
+            if known_user is not None:
+                (known_username, written_time) = known_user
+
+                cls.known_users.move_to_end(id)
+
+                if known_username != username or time.monotonic() - written_time >= cls.update_granularity:
+                    cls.remember_user(id, username, current_date_time)
+
+                return None
+
         try:
             defaults = {
                 'telegram_username': username,
@@ -89,12 +146,14 @@ class User(BaseModel):
                 'updated_at': current_date_time
             }
 
+            # Unknown users are still looked up right away, so that new ones are always reported.
             (db_user, is_created) = cls.get_or_create(telegram_id=id, defaults=defaults)
 
-            db_user.telegram_username = username
-            db_user.updated_at = current_date_time
-
-            db_user.save()
+            with cls.users_lock:
+                if is_created:
+                    cls.add_known_user(id, username)
+                else:
+                    cls.remember_user(id, username, current_date_time)
 
             if is_created:
                 return db_user
@@ -103,10 +162,40 @@ class User(BaseModel):
 
         return None
 
+    @classmethod
+    def flush_pending_updates(cls) -> None:
+        with cls.users_lock:
+            pending_updates = cls.pending_updates
+
+            cls.pending_updates = {}
+
+        if not pending_updates:
+            return
+
+        try:
+            with database.atomic():
+                for id, (username, updated_at) in pending_updates.items():
+                    cls.update(
+                        telegram_username=username,
+                        updated_at=updated_at
+                    ).where(cls.telegram_id == id).execute()
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" while writing {len(pending_updates)} users')
+
+            with cls.users_lock:
+                for id, pending_update in pending_updates.items():
+                    cls.pending_updates.setdefault(id, pending_update)
+
+            return
+
+        logger.info(f'Wrote {len(pending_updates)} users')
+
     @classmethod
     def get_users_table(cls, sorted_by_updated_at=False) -> str:
         users_table = ''
 
+        cls.flush_pending_updates()
+
         try:
             sort_field = cls.updated_at if sorted_by_updated_at else cls.created_at
 
@@ -132,6 +221,235 @@ class User(BaseModel):
         return users_table
 
 
+class Conversion(BaseModel):
+    input_file_unique_id = peewee.TextField()
+    input_file_size = peewee.BigIntegerField(null=True)
+    output_type = peewee.TextField()
+    settings = peewee.TextField()
+    output_file_id = peewee.TextField()
+    hits = peewee.IntegerField(default=0)
+
+    lookups_lock = threading.Lock()
+    lookup_hits_count = 0
+    lookup_misses_count = 0
+
+    class Meta:
+        indexes = (
+            (('input_file_unique_id', 'output_type', 'settings'), True),
+        )
+
+    @classmethod
+    def count_lookup(cls, is_hit: bool) -> None:
+        with cls.lookups_lock:
+            if is_hit:
+                cls.lookup_hits_count += 1
+            else:
+                cls.lookup_misses_count += 1
+
+    @classmethod
+    def get_cached_output(cls, input_file_unique_id: str, output_settings: typing.Dict[str, str]) -> typing.Optional[Conversion]:
+        # Each output type is looked up with its own settings, the same ones it was cached with.
+        settings_condition = functools.reduce(operator.or_, [
+            (cls.output_type == output_type) & (cls.settings == settings)
+            for (output_type, settings) in output_settings.items()
+        ])
+
+        try:
+            conversion = cls.get_or_none(
+                (cls.input_file_unique_id == input_file_unique_id) &
+                settings_condition
+            )
+
+            cls.count_lookup(conversion is not None)
+
+            if conversion is None:
+                logger.info(f'Conversion cache miss for {input_file_unique_id}')
+
+                return None
+
+            cls.update(
+                hits=cls.hits + 1,
+                updated_at=get_current_datetime()
+            ).where(cls.rowid == conversion.rowid).execute()
+
+            logger.info(f'Conversion cache hit for {input_file_unique_id} as {conversion.output_type}')
+
+            return conversion
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" for input file unique id: {input_file_unique_id}')
+
+        return None
+
+    @classmethod
+    def cache_output(cls, input_file_unique_id: str, input_file_size: typing.Optional[int], output_type: str, output_file_id: str, settings: str = constants.DEFAULT_ENCODING_PROFILE) -> None:
+        try:
+            cls.insert(
+                input_file_unique_id=input_file_unique_id,
+                input_file_size=input_file_size,
+                output_type=output_type,
+                settings=settings,
+                output_file_id=output_file_id,
+                updated_at=get_current_datetime()
+            ).on_conflict_ignore().execute()
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" for input file unique id: {input_file_unique_id}')
+
+    @classmethod
+    def remove_cached_output(cls, conversion: Conversion) -> None:
+        try:
+            cls.delete().where(cls.rowid == conversion.rowid).execute()
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" for input file unique id: {conversion.input_file_unique_id}')
+
+    @classmethod
+    def get_statistics_table(cls) -> str:
+        statistics_table = ''
+
+        try:
+            conversions_count = cls.select().count()
+            hits_count = cls.select(peewee.fn.SUM(cls.hits)).scalar() or 0
+            saved_bytes_count = cls.select(peewee.fn.SUM(cls.hits * cls.input_file_size)).scalar() or 0
+
+            statistics_table = (
+                f'Cached conversions {telegram_utils.ESCAPED_VERTICAL_LINE} {conversions_count}\n'
+                f'Total cache hits {telegram_utils.ESCAPED_VERTICAL_LINE} {hits_count}\n'
+                f'Saved downloads {telegram_utils.ESCAPED_VERTICAL_LINE} '
+                f'{telegram_utils.escape_v2_markdown_text(utils.get_size_string_from_bytes(saved_bytes_count))}\n'
+                f'Cache hits since restart {telegram_utils.ESCAPED_VERTICAL_LINE} {cls.lookup_hits_count}\n'
+                f'Cache misses since restart {telegram_utils.ESCAPED_VERTICAL_LINE} {cls.lookup_misses_count}'
+            )
+        except peewee.PeeweeException:
+            pass
+
+        if not statistics_table:
+            statistics_table = 'No statistics'
+
+        return statistics_table
+
+
+class Job(BaseModel):
+    update_id = peewee.BigIntegerField(unique=True)
+    chat_id = peewee.BigIntegerField(null=True)
+    message_id = peewee.BigIntegerField(null=True)
+    input_file_id = peewee.TextField(null=True)
+    output_type = peewee.TextField(null=True)
+    state = peewee.TextField(default=constants.JobState.PENDING)
+    attempts = peewee.IntegerField(default=0)
+    run_id = peewee.TextField(null=True)
+    raw_update = peewee.TextField()
+
+    # Jobs left running by a previous process are requeued, while the ones running in this process are left alone.
+    current_run_id = uuid.uuid4().hex
+
+    @classmethod
+    def claim(cls, update: telegram.Update, output_type: typing.Optional[str] = None) -> typing.Optional[Job]:
+        current_date_time = get_current_datetime()
+
+        try:
+            # The write lock is taken up front, as upgrading a read transaction fails right away instead of waiting.
+            with database.atomic('IMMEDIATE'):
+                job = cls.get_or_none(cls.update_id == update.update_id)
+
+                if job is None:
+                    message = update.effective_message
+                    chat = update.effective_chat
+
+                    job = cls.create(
+                        update_id=update.update_id,
+                        chat_id=chat.id if chat is not None else None,
+                        message_id=message.message_id if message is not None else None,
+                        input_file_id=utils.get_message_file_id(message),
+                        output_type=output_type,
+                        raw_update=json.dumps(update.to_dict(), ensure_ascii=False),
+                        updated_at=current_date_time
+                    )
+                elif job.state in [constants.JobState.DONE, constants.JobState.FAILED]:
+                    return None
+                elif job.state == constants.JobState.RUNNING and job.run_id == cls.current_run_id:
+                    return None
+                elif job.attempts >= constants.MAX_JOB_ATTEMPTS:
+                    logger.warning(f'Giving up job for update {job.update_id} after {job.attempts} attempts')
+
+                    cls.update(
+                        state=constants.JobState.FAILED,
+                        updated_at=current_date_time
+                    ).where(cls.rowid == job.rowid).execute()
+
+                    return None
+
+                cls.update(
+                    state=constants.JobState.RUNNING,
+                    run_id=cls.current_run_id,
+                    attempts=cls.attempts + 1,
+                    updated_at=current_date_time
+                ).where(cls.rowid == job.rowid).execute()
+
+                return job
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" for update id: {update.update_id}')
+
+        return None
+
+    @classmethod
+    def set_output_type(cls, update_id: int, output_type: str) -> None:
+        try:
+            cls.update(output_type=output_type).where(cls.update_id == update_id).execute()
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" for update id: {update_id}')
+
+    def finish(self, state: str) -> None:
+        try:
+            type(self).update(
+                state=state,
+                updated_at=get_current_datetime()
+            ).where(type(self).rowid == self.rowid).execute()
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" for update id: {self.update_id}')
+
+    def defer(self) -> None:
+        # Waiting for the rate limit isn't a failed attempt.
+        try:
+            type(self).update(
+                state=constants.JobState.PENDING,
+                attempts=type(self).attempts - 1,
+                updated_at=get_current_datetime()
+            ).where(type(self).rowid == self.rowid).execute()
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" for update id: {self.update_id}')
+
+    @classmethod
+    def requeue_unfinished_jobs(cls) -> typing.List[Job]:
+        jobs: typing.List[Job] = []
+
+        try:
+            with database.atomic():
+                cls.update(
+                    state=constants.JobState.PENDING,
+                    updated_at=get_current_datetime()
+                ).where(
+                    (cls.state == constants.JobState.RUNNING) &
+                    (cls.run_id != cls.current_run_id)
+                ).execute()
+
+                jobs = list(cls.select().where(cls.state == constants.JobState.PENDING).order_by(cls.rowid))
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" while requeuing jobs')
+
+        return jobs
+
+    @classmethod
+    def delete_finished_jobs(cls) -> None:
+        oldest_date_time = (datetime.datetime.now() - constants.FINISHED_JOBS_RETENTION).strftime(constants.GENERIC_DATE_TIME_FORMAT)
+
+        try:
+            cls.delete().where(
+                (cls.state.in_([constants.JobState.DONE, constants.JobState.FAILED])) &
+                (cls.updated_at < oldest_date_time)
+            ).execute()
+        except peewee.PeeweeException as error:
+            logger.error(f'Database error: "{error}" while deleting finished jobs')
+
+
 migrator = router.migrator
 
 migrator.create_table(User)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import copy
+import hashlib
+import json
+import threading
+import typing
+
+import telegram
+
+import constants
+import streaming
+
+ProfileSettings = typing.Dict[str, typing.Dict[str, typing.Any]]
+
+CONFIG_SETTING_NAMES = {
+    'codec': 'codec',
+    'preset': 'preset',
+    'crf': 'crf',
+    'bitrate': 'bitrate',
+    'audiobitrate': 'audio_bitrate',
+    'threads': 'threads'
+}
+
+VIDEO_OUTPUT_TYPES = [constants.OutputType.VIDEO, constants.OutputType.VIDEO_NOTE]
+ENCODED_OUTPUT_TYPES = VIDEO_OUTPUT_TYPES + [constants.OutputType.AUDIO, constants.OutputType.FILE]
+
+
+def parse_bitrate(value: typing.Any) -> typing.Optional[int]:
+    if value is None:
+        return None
+
+    text = str(value).strip().lower()
+    multiplier = 1
+
+    if text.endswith('k'):
+        (text, multiplier) = (text[:-1], 1000)
+    elif text.endswith('m'):
+        (text, multiplier) = (text[:-1], 1000 * 1000)
+
+    try:
+        return int(float(text) * multiplier)
+    except ValueError:
+        return None
+
+
+def get_size_capped_arguments(output_type: str, conversion_path: str, arguments: typing.Dict[str, typing.Any], duration: float, size_limit: int, has_audio: bool) -> typing.Dict[str, typing.Any]:
+    # The copied streams keep their size, which is checked before choosing to copy them.
+    if conversion_path != constants.ConversionPath.ENCODE or duration <= 0:
+        return {}
+
+    budget_bits = size_limit * 8 * constants.OUTPUT_SIZE_BUDGET_RATIO
+    audio_bitrate = 0
+
+    if has_audio:
+        audio_bitrate = parse_bitrate(arguments.get('audio_bitrate')) or constants.DEFAULT_AUDIO_BITRATES[output_type]
+
+    capped_arguments: typing.Dict[str, typing.Any] = {}
+
+    if output_type in VIDEO_OUTPUT_TYPES:
+        video_duration = duration + constants.VBV_BUFFER_DURATION
+        video_bitrate = (budget_bits - audio_bitrate * duration) / video_duration
+
+        if video_bitrate < constants.MIN_VIDEO_BITRATE and audio_bitrate > constants.MIN_AUDIO_BITRATE:
+            audio_bitrate = constants.MIN_AUDIO_BITRATE
+            video_bitrate = (budget_bits - audio_bitrate * duration) / video_duration
+
+            capped_arguments['audio_bitrate'] = audio_bitrate
+
+        if video_bitrate < constants.MIN_VIDEO_BITRATE:
+            minimum_bits = constants.MIN_VIDEO_BITRATE * video_duration + audio_bitrate * duration
+
+            raise streaming.OutputSizeLimitExceededError(int(minimum_bits / 8 / constants.OUTPUT_SIZE_BUDGET_RATIO), size_limit)
+
+        maximum_video_bitrate = int(min(video_bitrate, parse_bitrate(arguments.get('video_bitrate')) or video_bitrate))
+
+        # The quality based rate control is kept, and the rate control buffer only caps the peaks that wouldn't fit. It
+        # isn't exact, so the margin makes an output over the limit unlikely, but not impossible.
+        capped_arguments['maxrate'] = maximum_video_bitrate
+        capped_arguments['bufsize'] = maximum_video_bitrate
+
+        if 'video_bitrate' in arguments:
+            capped_arguments['video_bitrate'] = maximum_video_bitrate
+    elif has_audio:
+        maximum_audio_bitrate = budget_bits / duration
+
+        if maximum_audio_bitrate < constants.MIN_AUDIO_BITRATE:
+            minimum_bits = constants.MIN_AUDIO_BITRATE * duration
+
+            raise streaming.OutputSizeLimitExceededError(int(minimum_bits / 8 / constants.OUTPUT_SIZE_BUDGET_RATIO), size_limit)
+
+        if output_type == constants.OutputType.FILE:
+            maximum_audio_bitrate = max(bitrate for bitrate in constants.MP3_BITRATES if bitrate <= max(maximum_audio_bitrate, constants.MP3_BITRATES[0]))
+
+        if audio_bitrate > maximum_audio_bitrate:
+            capped_arguments['audio_bitrate'] = int(maximum_audio_bitrate)
+
+    return capped_arguments
+
+
+class EncodingProfiles:
+    def __init__(self, profiles: typing.Dict[str, typing.Any], default_name: str) -> None:
+        self.profiles: typing.Dict[str, ProfileSettings] = copy.deepcopy(profiles)
+        self.default_name = default_name
+
+        self.local = threading.local()
+
+    def get_names(self) -> typing.List[str]:
+        return list(self.profiles)
+
+    def configure(self, name: str, output_type: str, config_name: str, value: str) -> None:
+        setting_name = CONFIG_SETTING_NAMES.get(config_name.lower())
+
+        if setting_name is None or output_type not in ENCODED_OUTPUT_TYPES:
+            raise ValueError(f'Unknown encoding setting {output_type}.{config_name} in the {name} profile')
+
+        setting_value: typing.Any = int(value) if setting_name in ['crf', 'threads'] else value
+
+        self.profiles.setdefault(name, {}).setdefault(output_type, {})[setting_name] = setting_value
+
+    def set_default_name(self, name: str) -> None:
+        if name not in self.profiles:
+            raise ValueError(f'Unknown encoding profile {name}')
+
+        self.default_name = name
+
+    def get_requested_name(self, message: typing.Optional[telegram.Message]) -> typing.Optional[str]:
+        # A profile is picked per file with a hashtag in its caption, like "#small".
+        if message is None or not message.caption:
+            return None
+
+        for word in message.caption.split():
+            name = word[1:].lower()
+
+            if word.startswith('#') and name in self.profiles:
+                return name
+
+        return None
+
+    @contextlib.contextmanager
+    def job_context(self, name: typing.Optional[str]) -> typing.Iterator[None]:
+        self.local.name = name
+
+        try:
+            yield
+        finally:
+            self.local.name = None
+
+    def get_current_name(self) -> str:
+        return getattr(self.local, 'name', None) or self.default_name
+
+    def get_settings_key(self, name: str, output_type: str) -> str:
+        # The arguments are hashed instead of using the profile name, so changing a profile doesn't serve the outputs
+        # encoded with its old settings.
+        arguments = self.get_arguments(name, output_type, constants.ConversionPath.ENCODE)
+
+        # The outputs cached before the profiles were added were encoded with the plain ffmpeg settings.
+        if not arguments:
+            return constants.DEFAULT_ENCODING_PROFILE
+
+        return hashlib.sha256(json.dumps(arguments, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def get_cache_settings(self, output_types: typing.List[str]) -> typing.Dict[str, str]:
+        # The images aren't encoded by ffmpeg, so their cached outputs are shared by all the profiles.
+        return {
+            output_type: self.get_settings_key(self.get_current_name(), output_type) if output_type in ENCODED_OUTPUT_TYPES else constants.DEFAULT_ENCODING_PROFILE
+            for output_type in output_types
+        }
+
+    def get_arguments(self, name: str, output_type: str, conversion_path: str) -> typing.Dict[str, typing.Any]:
+        if conversion_path == constants.ConversionPath.STREAM_COPY:
+            return {}
+
+        settings = self.profiles.get(name, {}).get(output_type, {})
+        arguments: typing.Dict[str, typing.Any] = {}
+
+        if output_type in VIDEO_OUTPUT_TYPES:
+            # Only the audio is encoded when the video stream is copied.
+            if conversion_path == constants.ConversionPath.ENCODE:
+                for (setting_name, argument_name) in [('codec', 'vcodec'), ('preset', 'preset'), ('crf', 'crf'), ('bitrate', 'video_bitrate')]:
+                    if setting_name in settings:
+                        arguments[argument_name] = settings[setting_name]
+        elif 'codec' in settings:
+            arguments['acodec'] = settings['codec']
+
+        if 'audio_bitrate' in settings:
+            arguments['audio_bitrate'] = settings['audio_bitrate']
+
+        if 'threads' in settings:
+            arguments['threads'] = settings['threads']
+
+        return arguments
@@ -3,16 +3,15 @@
 
 import argparse
 import configparser
+import functools
 import io
 import json
 import logging
 import os
 import sys
 import threading
+import typing
 
-import ffmpeg
-import pdf2image
-import PIL
 import telegram.ext
 import telegram.utils.helpers
 import telegram_utils
@@ -20,8 +19,15 @@ import yt_dlp as youtube_dl
 
 import analytics
 import constants
+import converters
 import custom_logger
 import database
+import metrics
+import recording
+import sniffing
+import staging
+import streaming
+import uploading
 import utils
 
 custom_logger.configure_root_logger()
@@ -35,10 +41,143 @@ ADMIN_USER_ID: int
 
 updater: telegram.ext.Updater
 analytics_handler: analytics.AnalyticsHandler
+update_recorder: typing.Optional[recording.UpdateRecorder] = None
+
+Handler = typing.Callable[[telegram.Update, telegram.ext.CallbackContext], None]
+
+filtered_documents_counter = utils.Counter()
+
+current_job = threading.local()
+
+
+def defer_if_rate_limited(update: telegram.Update, context: telegram.ext.CallbackContext, job: database.Job) -> bool:
+    user = update.effective_user
+    chat = update.effective_chat
+    job_queue = context.job_queue
+
+    if user is None or chat is None or job_queue is None:
+        return False
+
+    user_id = user.id
+    delay = utils.rate_limiter.reserve(user_id, chat.id)
+
+    if delay == 0:
+        return False
+
+    # The button press would be too old to answer by the time it is resumed.
+    if update.callback_query is not None:
+        utils.answer_callback_query(update.callback_query)
+
+    job.defer()
+
+    (delay, ahead_count, should_notify) = utils.rate_limiter.defer(user_id, delay)
+
+    logger.info(f'Deferred update {update.update_id} of user {user_id} by {delay:.2f}s')
+
+    def resume(_context: telegram.ext.CallbackContext) -> None:
+        utils.rate_limiter.resume(user_id)
+
+        context.dispatcher.update_queue.put(update)
+
+    job_queue.run_once(resume, delay)
+
+    message = update.effective_message
+
+    # A single reply for the whole burst, instead of one for each file.
+    if should_notify and message is not None and chat.type == telegram.Chat.PRIVATE:
+        queued_count = ahead_count + utils.conversion_scheduler.get_total_queue_depth()
+
+        message.reply_text(f'Too many files at once, so they are queued, {queued_count} ahead of you.')
+
+    return True
+
+
+def start_job(update: telegram.Update, context: telegram.ext.CallbackContext) -> bool:
+    # The job is only claimed right before converting, so the ignored updates and the cached outputs neither write to
+    # the database nor use up the rate limits.
+    job = database.Job.claim(update, current_job.output_type)
+
+    if job is None:
+        return False
+
+    if defer_if_rate_limited(update, context, job):
+        return False
+
+    current_job.job = job
+
+    return True
+
+
+def run_as_job(output_type: typing.Optional[str] = None) -> typing.Callable[[Handler], Handler]:
+    def decorator(handler: Handler) -> Handler:
+        @functools.wraps(handler)
+        def wrapper(update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
+            profile_name = utils.encoding_profiles.get_requested_name(update.effective_message)
+            is_private_chat = update.effective_chat is not None and update.effective_chat.type == telegram.Chat.PRIVATE
+
+            with database.connection(), metrics.handler_context(handler.__name__), utils.encoding_profiles.job_context(profile_name), utils.single_flight.job_context(), utils.variant_cache.job_context(is_private_chat):
+                current_job.output_type = output_type
+                current_job.job = None
+
+                try:
+                    handler(update, context)
+                except streaming.OutputSizeLimitExceededError as error:
+                    # The conversions that can't fit under the upload limit are refused before encoding anything.
+                    utils.ensure_size_under_limit(error.size, error.limit, update, context, file_reference_text='Converted file')
+                except streaming.ConversionCancelledError as error:
+                    logger.info(f'Leaving job for update id {update.update_id} unfinished: {error}')
+
+                    return
+                except Exception:
+                    if current_job.job is not None:
+                        current_job.job.finish(constants.JobState.FAILED)
+
+                    raise
+
+                if current_job.job is not None:
+                    current_job.job.finish(constants.JobState.DONE)
+
+        return wrapper
+
+    return decorator
+
+
+def resume_jobs() -> None:
+    database.Job.delete_finished_jobs()
+
+    for job in database.Job.requeue_unfinished_jobs():
+        try:
+            update = telegram.Update.de_json(json.loads(job.raw_update), updater.bot)
+        except (ValueError, TypeError) as error:
+            logger.error(f'Job error: "{error}" for update id: {job.update_id}')
+
+            job.finish(constants.JobState.FAILED)
+
+            continue
+
+        logger.info(f'Resuming job for update id: {job.update_id}')
+
+        updater.update_queue.put(update)
+
+
+def flush_users(_context: telegram.ext.CallbackContext) -> None:
+    database.User.flush_pending_updates()
+
+
+def delete_finished_jobs(_context: telegram.ext.CallbackContext) -> None:
+    database.Job.delete_finished_jobs()
 
 
 def stop_and_restart() -> None:
+    # The running conversions would keep the workers busy, so they are killed and resumed after the restart.
+    utils.watchdog.stop(constants.CancelReason.RESTART)
+
     updater.stop()
+    database.User.flush_pending_updates()
+    analytics_handler.stop()
+
+    if update_recorder is not None:
+        update_recorder.close()
     os.execl(sys.executable, sys.executable, *sys.argv)
 
 
@@ -59,6 +198,93 @@ def create_or_update_user(bot: telegram.Bot, user: telegram.User) -> None:
         )
 
 
+def send_cached_output(bot: telegram.Bot, chat_id: int, message_id: int, chat_type: str, input_file_unique_id: str, output_types: typing.List[str], caption: typing.Optional[str] = None) -> bool:
+    conversion = database.Conversion.get_cached_output(input_file_unique_id, utils.encoding_profiles.get_cache_settings(output_types))
+
+    if conversion is None:
+        return False
+
+    try:
+        utils.send_output(bot, conversion.output_type, chat_id, message_id, conversion.output_file_id, caption, chat_type)
+    except telegram.TelegramError as error:
+        logger.warning(f'Cached output error: {error}')
+
+        database.Conversion.remove_cached_output(conversion)
+
+        return False
+
+    return True
+
+
+def send_shared_output(bot: telegram.Bot, chat_id: int, message_id: int, chat_type: str, input_identity: str, output_types: typing.List[str], caption: typing.Optional[str] = None) -> bool:
+    flight_key = (input_identity, tuple(utils.encoding_profiles.get_cache_settings(output_types).items()))
+
+    while True:
+        flight = utils.single_flight.join(flight_key)
+
+        if flight is None:
+            return False
+
+        logger.info(f'Waiting for the conversion in progress of {input_identity}')
+
+        shared_output = utils.single_flight.follow(flight)
+
+        if shared_output is None:
+            # When the conversion takes too long, it is done again instead of holding the worker any longer.
+            if not flight.landed.is_set():
+                logger.info(f'Stopped waiting for the conversion in progress of {input_identity}')
+
+                return False
+
+            # When the conversion failed, the next request to join leads a new one.
+            continue
+
+        try:
+            if shared_output.output_type == constants.OutputType.ALBUM:
+                utils.send_album(bot, chat_id, message_id, shared_output.output_file_ids, caption or shared_output.caption)
+            else:
+                utils.send_output(bot, shared_output.output_type, chat_id, message_id, shared_output.output_file_id, caption or shared_output.caption, chat_type)
+        except telegram.TelegramError as error:
+            logger.warning(f'Shared output error: {error}')
+
+            return False
+
+        metrics.shared_outputs.inc(shared_output.output_type)
+
+        return True
+
+
+def cache_sent_output(sent_message: typing.Optional[telegram.Message], input_file_unique_id: str, input_file_size: typing.Optional[int], output_type: str) -> None:
+    output_file_id = utils.get_message_file_id(sent_message)
+
+    if output_file_id is None:
+        return
+
+    utils.single_flight.share_output(output_type, output_file_id, None)
+
+    database.Conversion.cache_output(input_file_unique_id, input_file_size, output_type, output_file_id, utils.encoding_profiles.get_cache_settings([output_type])[output_type])
+
+
+def send_unsupported_file_message(bot: telegram.Bot, chat_id: int, message_id: int, chat_type: str, input_file_url: typing.Optional[str], invalid_format: typing.Optional[str] = None, error_text: typing.Optional[str] = None) -> None:
+    if chat_type != telegram.Chat.PRIVATE:
+        return
+
+    if invalid_format is None and input_file_url is not None:
+        parts = os.path.splitext(input_file_url)
+
+        if parts is not None and len(parts) >= 2:
+            extension = parts[1]
+
+            if extension is not None:
+                invalid_format = extension[1:]
+
+    bot.send_message(
+        chat_id=chat_id,
+        text=error_text or f'File type "{invalid_format}" is not yet supported.',
+        reply_to_message_id=message_id
+    )
+
+
 def start_command_handler(update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
     message = update.message
 
@@ -96,6 +322,23 @@ def restart_command_handler(update: telegram.Update, context: telegram.ext.Callb
     threading.Thread(target=stop_and_restart).start()
 
 
+def cancel_command_handler(update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
+    message = update.message
+
+    if message is None:
+        return
+
+    user = message.from_user
+
+    if user is None:
+        return
+
+    cancelled_count = utils.watchdog.cancel(constants.CancelReason.USER, user.id)
+
+    if cancelled_count == 0:
+        context.bot.send_message(message.chat_id, 'There are no running conversions to cancel.', reply_to_message_id=message.message_id)
+
+
 def logs_command_handler(update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
     message = update.message
 
@@ -137,6 +380,32 @@ def users_command_handler(update: telegram.Update, context: telegram.ext.Callbac
     )
 
 
+def stats_command_handler(update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
+    message = update.message
+
+    if message is None:
+        return
+
+    bot = context.bot
+
+    chat_id = message.chat_id
+
+    if not utils.check_admin(bot, context, message, analytics_handler, ADMIN_USER_ID):
+        return
+
+    bot.send_message(
+        chat_id=chat_id,
+        text=(
+            f'{database.Conversion.get_statistics_table()}\n'
+            f'Filtered group documents {telegram_utils.ESCAPED_VERTICAL_LINE} {filtered_documents_counter.value}\n'
+            f'Analytics events {telegram_utils.ESCAPED_VERTICAL_LINE} {analytics_handler.sent_count} sent, {analytics_handler.dropped_count} dropped\n'
+            f'{utils.conversion_scheduler.get_statistics_table()}'
+        ),
+        parse_mode=telegram.ParseMode.MARKDOWN_V2
+    )
+
+
+@run_as_job()
 def message_file_handler(update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
     message = update.effective_message
     chat = update.effective_chat
@@ -185,12 +454,20 @@ def message_file_handler(update: telegram.Update, context: telegram.ext.Callback
     if file_size is None:
         return
 
-    if not utils.ensure_size_under_limit(file_size, telegram.constants.MAX_FILESIZE_DOWNLOAD, update, context):
+    if not utils.ensure_size_under_limit(file_size, utils.download_size_limit, update, context):
         return
 
+    # Unsupported files are silently ignored in groups, so they are dropped before doing any work.
+    if chat_type != telegram.Chat.PRIVATE and isinstance(attachment, telegram.Document):
+        if not sniffing.is_convertible_document(attachment.mime_type, attachment.file_name):
+            filtered_documents_counter.increment()
+
+            return
+
     user = message.from_user
 
     input_file_id = attachment.file_id
+    input_file_unique_id = attachment.file_unique_id
     input_file_name = None
 
     if isinstance(attachment, (telegram.Audio, telegram.Document)):
@@ -199,254 +476,139 @@ def message_file_handler(update: telegram.Update, context: telegram.ext.Callback
         if input_file_name is None and isinstance(attachment, telegram.Audio):
             input_file_name = attachment.title
 
-    if user is not None:
-        create_or_update_user(bot, user)
-
-        analytics_handler.track(context, analytics.AnalyticsType.MESSAGE, user)
-
-    if chat_type == telegram.Chat.PRIVATE:
-        bot.send_chat_action(chat_id, telegram.ChatAction.TYPING)
-
-    input_file = bot.get_file(input_file_id)
-    input_file_url = input_file.file_path
-
-    probe = None
-
-    try:
-        probe = ffmpeg.probe(input_file_url)
-    except ffmpeg.Error:
-        pass
-
-    with io.BytesIO() as output_bytes:
-        output_type = constants.OutputType.NONE
-        caption = None
-        invalid_format = None
+    caption = None
 
-        if message_type == 'voice':
-            output_type = constants.OutputType.FILE
+    if message_type == 'voice':
+        cached_output_types = [constants.OutputType.FILE]
+    elif message_type == 'sticker':
+        cached_output_types = [constants.OutputType.PHOTO]
 
-            mp3_bytes = utils.convert(output_type, input_audio_url=input_file_url)
-
-            if not utils.ensure_valid_converted_file(
-                file_bytes=mp3_bytes,
-                update=update,
-                context=context
-            ):
-                return
+        sticker = message['sticker']
+        emoji = sticker['emoji']
+        set_name = sticker['set_name']
 
-            if mp3_bytes is not None:
-                output_bytes.write(mp3_bytes)
-
-            output_bytes.name = 'voice.mp3'
-        elif message_type == 'sticker':
-            with io.BytesIO() as input_bytes:
-                input_file.download(out=input_bytes)
-
-                try:
-                    image = PIL.Image.open(input_bytes)
-
-                    with io.BytesIO() as image_bytes:
-                        image.save(image_bytes, format='PNG')
-
-                        image_bytes.seek(0)
-
-                        output_bytes.write(image_bytes.read())
-
-                        output_type = constants.OutputType.PHOTO
-
-                        sticker = message['sticker']
-                        emoji = sticker['emoji']
-                        set_name = sticker['set_name']
-
-                        caption = f'Sticker for the emoji "{emoji}" from the set "{set_name}"'
-                except Exception as error:
-                    logger.error(f'PIL error: {error}')
-        else:
-            if probe:
-                for stream in probe['streams']:
-                    codec_name = stream.get('codec_name')
-
-                    if codec_name is not None:
-                        invalid_format = codec_name
-
-                    if codec_name in constants.VIDEO_CODEC_NAMES:
-                        output_type = constants.OutputType.VIDEO
-
-                        mp4_bytes = utils.convert(output_type, input_video_url=input_file_url)
-
-                        if not utils.ensure_valid_converted_file(
-                            file_bytes=mp4_bytes,
-                            update=update,
-                            context=context
-                        ):
-                            return
-
-                        if mp4_bytes is not None:
-                            output_bytes.write(mp4_bytes)
-
-                        break
-
-                    continue
-
-                if output_type == constants.OutputType.NONE:
-                    for stream in probe['streams']:
-                        codec_name = stream.get('codec_name')
-
-                        if codec_name is not None:
-                            invalid_format = codec_name
-
-                        if codec_name in constants.AUDIO_CODEC_NAMES:
-                            output_type = constants.OutputType.AUDIO
-
-                            opus_bytes = utils.convert(output_type, input_audio_url=input_file_url)
-
-                            if not utils.ensure_valid_converted_file(
-                                file_bytes=opus_bytes,
-                                update=update,
-                                context=context
-                            ):
-                                return
-
-                            if opus_bytes is not None:
-                                output_bytes.write(opus_bytes)
-
-                            break
-                        elif codec_name == 'opus':
-                            input_file.download(out=output_bytes)
-
-                            output_type = constants.OutputType.AUDIO
+        caption = f'Sticker for the emoji "{emoji}" from the set "{set_name}"'
+    else:
+        cached_output_types = [
+            constants.OutputType.AUDIO,
+            constants.OutputType.VIDEO,
+            constants.OutputType.PHOTO,
+            constants.OutputType.STICKER
+        ]
 
-                            break
+    if caption is None and input_file_name is not None:
+        caption = input_file_name[:telegram.constants.MAX_CAPTION_LENGTH]
 
-                        continue
+    if user is not None:
+        create_or_update_user(bot, user)
 
-        if output_type == constants.OutputType.NONE:
-            with io.BytesIO() as input_bytes:
-                input_file.download(out=input_bytes)
+        analytics_handler.track(context, analytics.AnalyticsType.MESSAGE, user)
 
-                input_bytes.seek(0)
+    if send_cached_output(bot, chat_id, message_id, chat_type, input_file_unique_id, cached_output_types, caption):
+        return
 
-                try:
-                    images = pdf2image.convert_from_bytes(input_bytes.read())
-                    image = images[0]
+    if send_shared_output(bot, chat_id, message_id, chat_type, input_file_unique_id, cached_output_types, caption):
+        return
 
-                    with io.BytesIO() as image_bytes:
-                        image.save(image_bytes, format='PNG')
+    if not start_job(update, context):
+        return
 
-                        image_bytes.seek(0)
+    if chat_type == telegram.Chat.PRIVATE:
+        bot.send_chat_action(chat_id, telegram.ChatAction.TYPING)
 
-                        output_bytes.write(image_bytes.read())
+    with metrics.measure_stage('get_file'):
+        input_file = bot.get_file(input_file_id)
 
-                        output_type = constants.OutputType.PHOTO
-                except Exception as error:
-                    logger.error(f'pdf2image error: {error}')
+    input_file_url = input_file.file_path
 
-                if output_type == constants.OutputType.NONE:
-                    try:
-                        image = PIL.Image.open(input_bytes)
+    converter: typing.Optional[converters.Converter]
 
-                        with io.BytesIO() as image_bytes:
-                            image.save(image_bytes, format='WEBP')
+    if isinstance(attachment, telegram.Voice):
+        converter = converters.convert_voice
+    elif isinstance(attachment, telegram.Sticker):
+        converter = converters.convert_sticker
+    elif isinstance(attachment, telegram.Document):
+        # Only the start of the document is downloaded until it is known to be convertible.
+        header = staging.download_header(input_file, constants.SNIFF_HEADER_SIZE)
+        converter = converters.get_document_converter(header, attachment.mime_type, chat_type == telegram.Chat.PRIVATE)
+    else:
+        converter = converters.convert_media
 
-                            image_bytes.seek(0)
+    if converter is None:
+        send_unsupported_file_message(bot, chat_id, message_id, chat_type, input_file_url)
 
-                            output_bytes.write(image_bytes.read())
+        return
 
-                            output_type = constants.OutputType.STICKER
-                    except Exception as error:
-                        logger.error(f'PIL error: {error}')
+    with staging.StagedInput.download(input_file) as staged_input, io.BytesIO() as output_bytes:
+        conversion_result = converter(staged_input, output_bytes, input_file_unique_id, user.id if user is not None else None)
 
-        if output_type == constants.OutputType.NONE:
-            if chat_type == telegram.Chat.PRIVATE:
-                if invalid_format is None and input_file_url is not None:
-                    parts = os.path.splitext(input_file_url)
+        # The streamed output is closed even when sending it fails before reading it.
+        with conversion_result:
+            output_type = conversion_result.output_type
+            output_file = conversion_result.output_file
+            invalid_format = conversion_result.invalid_format
 
-                    if parts is not None and len(parts) >= 2:
-                        extension = parts[1]
+            if output_type != constants.OutputType.NONE:
+                database.Job.set_output_type(update.update_id, output_type)
 
-                        if extension is not None:
-                            invalid_format = extension[1:]
+            if output_type == constants.OutputType.NONE:
+                send_unsupported_file_message(bot, chat_id, message_id, chat_type, input_file_url, invalid_format, conversion_result.error_text)
 
-                bot.send_message(
-                    chat_id=chat_id,
-                    text=f'File type "{invalid_format}" is not yet supported.',
-                    reply_to_message_id=message_id
-                )
+                return
 
-            return
+            if output_type == constants.OutputType.ALBUM:
+                for page_bytes in conversion_result.output_files:
+                    if not utils.ensure_size_under_limit(page_bytes.getbuffer().nbytes, telegram.constants.MAX_PHOTOSIZE_UPLOAD, update, context, file_reference_text='Converted page'):
+                        return
 
-        output_bytes.seek(0)
+                # The albums aren't cached, as a cached conversion has a single output file.
+                bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_PHOTO)
 
-        output_file_size = output_bytes.getbuffer().nbytes
+                sent_messages = utils.send_album(bot, chat_id, message_id, conversion_result.output_files, caption)
+                output_file_ids = [output_file_id for output_file_id in map(utils.get_message_file_id, sent_messages) if output_file_id is not None]
 
-        if caption is None and input_file_name is not None:
-            caption = input_file_name[:telegram.constants.MAX_CAPTION_LENGTH]
+                if output_file_ids:
+                    utils.single_flight.share_output(output_type, output_file_ids[0], caption, output_file_ids)
 
-        if output_type == constants.OutputType.AUDIO:
-            if not utils.ensure_size_under_limit(output_file_size, telegram.constants.MAX_FILESIZE_UPLOAD, update, context, file_reference_text='Converted file'):
                 return
 
-            bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_VOICE)
-
-            bot.send_voice(
-                chat_id,
-                output_bytes,
-                caption=caption,
-                reply_to_message_id=message_id
-            )
-
-            return
-        elif output_type == constants.OutputType.VIDEO:
-            if not utils.ensure_size_under_limit(output_file_size, telegram.constants.MAX_FILESIZE_UPLOAD, update, context, file_reference_text='Converted file'):
+            if not utils.ensure_valid_converted_file(
+                file_bytes=output_file,
+                update=update,
+                context=context
+            ):
                 return
 
-            bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_VIDEO)
-
-            utils.send_video(bot, chat_id, message_id, output_bytes, caption, chat_type)
-
-            return
-        elif output_type == constants.OutputType.PHOTO:
-            if not utils.ensure_size_under_limit(output_file_size, telegram.constants.MAX_PHOTOSIZE_UPLOAD, update, context, file_reference_text='Converted file'):
+            if output_file is None:
                 return
 
-            bot.send_photo(
-                chat_id,
-                output_bytes,
-                caption=caption,
-                reply_to_message_id=message_id
-            )
+            # Only the in-memory outputs are checked here, the streamed ones are checked while they are being uploaded.
+            if output_file is output_bytes:
+                # The converters write the output straight into the buffer, so its size is where they stopped.
+                output_file_size = output_bytes.tell()
 
-            return
-        elif output_type == constants.OutputType.STICKER:
-            bot.send_sticker(
-                chat_id,
-                output_bytes,
-                reply_to_message_id=message_id
-            )
+                output_bytes.seek(0)
 
-            return
-        elif output_type == constants.OutputType.FILE:
-            if not utils.ensure_size_under_limit(output_file_size, telegram.constants.MAX_FILESIZE_UPLOAD, update, context, file_reference_text='Converted file'):
-                return
+                if output_type == constants.OutputType.AUDIO:
+                    if not utils.ensure_size_under_limit(output_file_size, utils.upload_size_limit, update, context, file_reference_text='Converted file'):
+                        return
+                elif output_type == constants.OutputType.PHOTO:
+                    if not utils.ensure_size_under_limit(output_file_size, telegram.constants.MAX_PHOTOSIZE_UPLOAD, update, context, file_reference_text='Converted file'):
+                        return
 
-            bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_DOCUMENT)
+            if output_type == constants.OutputType.AUDIO:
+                bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_VOICE)
+            elif output_type == constants.OutputType.VIDEO:
+                bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_VIDEO)
+            elif output_type == constants.OutputType.FILE:
+                bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_DOCUMENT)
 
-            bot.send_document(
-                chat_id,
-                output_bytes,
-                reply_to_message_id=message_id
-            )
+            sent_message = utils.send_converted_output(bot, output_type, update, context, output_file, caption, chat_type)
 
-            return
-
-    if chat_type == telegram.Chat.PRIVATE:
-        bot.send_message(
-            chat_id,
-            'File type is not yet supported.',
-            reply_to_message_id=message_id
-        )
+            cache_sent_output(sent_message, input_file_unique_id, file_size, output_type)
 
 
+@run_as_job(constants.OutputType.VIDEO_NOTE)
 def message_video_handler(update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
     message = update.effective_message
 
@@ -476,100 +638,96 @@ def message_video_handler(update: telegram.Update, context: telegram.ext.Callbac
 
     file_size = attachment.file_size
 
-    if file_size is not None and not utils.ensure_size_under_limit(file_size, telegram.constants.MAX_FILESIZE_DOWNLOAD, update, context):
+    if file_size is not None and not utils.ensure_size_under_limit(file_size, utils.download_size_limit, update, context):
         return
 
     user = update.effective_user
 
     input_file_id = attachment.file_id
+    input_file_unique_id = attachment.file_unique_id
 
     if user is not None:
         create_or_update_user(bot, user)
 
         analytics_handler.track(context, analytics.AnalyticsType.MESSAGE, user)
 
-    bot.send_chat_action(chat_id, telegram.ChatAction.TYPING)
-
-    input_file = bot.get_file(input_file_id)
-    input_file_url = input_file.file_path
+    if send_cached_output(bot, chat_id, message_id, chat_type, input_file_unique_id, [constants.OutputType.VIDEO_NOTE]):
+        return
 
-    probe = None
+    if send_shared_output(bot, chat_id, message_id, chat_type, input_file_unique_id, [constants.OutputType.VIDEO_NOTE]):
+        return
 
-    try:
-        probe = ffmpeg.probe(input_file_url)
-    except ffmpeg.Error:
-        pass
+    if not start_job(update, context):
+        return
 
-    with io.BytesIO() as output_bytes:
-        output_type = constants.OutputType.NONE
+    bot.send_chat_action(chat_id, telegram.ChatAction.TYPING)
 
-        invalid_format = None
+    with metrics.measure_stage('get_file'):
+        input_file = bot.get_file(input_file_id)
 
-        if probe:
-            for stream in probe['streams']:
-                codec_name = stream.get('codec_name')
+    input_file_url = input_file.file_path
 
-                if codec_name is not None:
-                    invalid_format = codec_name
+    # ffmpeg reads the input straight from Telegram, or from the disk of a local Bot API server.
+    metrics.count_input_bytes(file_size)
 
-                if codec_name in constants.VIDEO_CODEC_NAMES:
-                    output_type = constants.OutputType.VIDEO_NOTE
+    probe_result = utils.prober.probe(input_file_url, input_file_unique_id)
 
-                    mp4_bytes = utils.convert(output_type, input_video_url=input_file_url)
+    output_type = constants.OutputType.NONE
+    output_stream = None
 
-                    if not utils.ensure_valid_converted_file(
-                        file_bytes=mp4_bytes,
-                        update=update,
-                        context=context
-                    ):
-                        return
+    invalid_format = None
 
-                    if mp4_bytes is not None:
-                        output_bytes.write(mp4_bytes)
+    if probe_result:
+        for stream in probe_result.streams:
+            codec_name = stream.get('codec_name')
 
-                    break
+            if codec_name is not None:
+                invalid_format = codec_name
 
-                continue
+            if codec_name in constants.VIDEO_CODEC_NAMES:
+                output_type = constants.OutputType.VIDEO_NOTE
 
-        if output_type == constants.OutputType.NONE:
-            if invalid_format is None and input_file_url is not None:
-                parts = os.path.splitext(input_file_url)
+                output_stream = utils.convert_stream(output_type, utils.upload_size_limit, input_video_url=input_file_url, probe_result=probe_result, user_id=user.id if user is not None else None)
 
-                if parts is not None and len(parts) >= 2:
-                    extension = parts[1]
+                if not utils.ensure_valid_converted_file(
+                    file_bytes=output_stream,
+                    update=update,
+                    context=context
+                ):
+                    return
 
-                    if extension is not None:
-                        invalid_format = extension[1:]
+                break
 
-            bot.send_message(
-                chat_id=chat_id,
-                text=f'File type "{invalid_format}" is not yet supported.',
-                reply_to_message_id=message_id
-            )
+            continue
 
-            return
+    if output_stream is None:
+        if invalid_format is None and input_file_url is not None:
+            parts = os.path.splitext(input_file_url)
 
-        output_bytes.seek(0)
+            if parts is not None and len(parts) >= 2:
+                extension = parts[1]
 
-        output_file_size = output_bytes.getbuffer().nbytes
+                if extension is not None:
+                    invalid_format = extension[1:]
 
-        if output_type == constants.OutputType.VIDEO_NOTE:
-            if not utils.ensure_size_under_limit(output_file_size, telegram.constants.MAX_FILESIZE_UPLOAD, update, context, file_reference_text='Converted file'):
-                return
+        bot.send_message(
+            chat_id=chat_id,
+            text=f'File type "{invalid_format}" is not yet supported.',
+            reply_to_message_id=message_id
+        )
 
-            bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_VIDEO)
+        return
 
-            utils.send_video_note(bot, chat_id, message_id, output_bytes)
+    # The stream is closed even when sending it fails before reading it.
+    with output_stream:
+        bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_VIDEO)
 
-            return
+        sent_message = utils.send_converted_output(bot, output_type, update, context, output_stream, None, chat_type)
 
-    bot.send_message(
-        chat_id,
-        'File type is not yet supported.',
-        reply_to_message_id=message_id
-    )
+        cache_sent_output(sent_message, input_file_unique_id, file_size, output_type)
 
 
+@run_as_job(constants.OutputType.VIDEO)
 def message_text_handler(update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
     message = update.effective_message
 
@@ -610,88 +768,106 @@ def message_text_handler(update: telegram.Update, context: telegram.ext.Callback
     if input_link is None:
         input_link = text
 
-    with io.BytesIO() as output_bytes:
-        caption = None
-        video_url = None
-        audio_url = None
+    # Links going viral are sent by many users at once, and they are only downloaded and converted once.
+    if send_shared_output(bot, chat_id, message_id, chat_type, input_link, [constants.OutputType.VIDEO]):
+        return
 
-        try:
-            yt_dl_options = {
-                'logger': logger,
-                'no_color': True
-            }
+    if not start_job(update, context):
+        return
 
-            with youtube_dl.YoutubeDL(yt_dl_options) as yt_dl:
-                video_info = yt_dl.extract_info(input_link, download=False)
+    caption = None
+    video_url = None
+    video_probe_result = None
+    audio_url = None
 
-            if 'entries' in video_info:
-                video = video_info['entries'][0]
-            else:
-                video = video_info
+    try:
+        yt_dl_options = {
+            'logger': logger,
+            'no_color': True
+        }
 
-            if 'title' in video:
-                caption = video['title']
-            else:
-                caption = input_link
+        with youtube_dl.YoutubeDL(yt_dl_options) as yt_dl:
+            video_info = yt_dl.extract_info(input_link, download=False)
 
-            file_size = None
+        if 'entries' in video_info:
+            video = video_info['entries'][0]
+        else:
+            video = video_info
 
-            if 'requested_formats' in video:
-                requested_formats = video['requested_formats']
+        if 'title' in video:
+            caption = video['title']
+        else:
+            caption = input_link
 
-                video_data = list(filter(lambda requested_format: requested_format['vcodec'] != 'none', requested_formats))[0]
-                audio_data = list(filter(lambda requested_format: requested_format['acodec'] != 'none', requested_formats))[0]
+        file_size = None
 
-                if 'filesize' in video_data:
-                    file_size = video_data['filesize']
+        if 'requested_formats' in video:
+            requested_formats = video['requested_formats']
 
-                video_url = video_data['url']
+            video_data = list(filter(lambda requested_format: requested_format['vcodec'] != 'none', requested_formats))[0]
+            audio_data = list(filter(lambda requested_format: requested_format['acodec'] != 'none', requested_formats))[0]
 
-                if file_size is None:
-                    file_size = utils.get_file_size(video_url)
+            if 'filesize' in video_data:
+                file_size = video_data['filesize']
 
-                audio_url = audio_data['url']
-            elif 'url' in video:
-                video_url = video['url']
-                file_size = utils.get_file_size(video_url)
+            video_url = video_data['url']
 
-            if file_size is not None:
-                if not utils.ensure_size_under_limit(file_size, telegram.constants.MAX_FILESIZE_UPLOAD, update, context):
-                    return
+            if file_size is None:
+                video_probe_result = utils.prober.probe(video_url)
 
-        except Exception as error:
-            logger.error(f'youtube-dl error: {error}')
+                file_size = utils.get_file_size(video_probe_result)
 
-        if chat_type == telegram.Chat.PRIVATE and (caption is None or video_url is None):
-            bot.send_message(
-                chat_id,
-                'No video found on this link.',
-                disable_web_page_preview=True,
-                reply_to_message_id=message_id
-            )
+            audio_url = audio_data['url']
+        elif 'url' in video:
+            video_url = video['url']
+            video_probe_result = utils.prober.probe(video_url)
 
-            return
+            file_size = utils.get_file_size(video_probe_result)
 
-        mp4_bytes = utils.convert(constants.OutputType.VIDEO, input_video_url=video_url, input_audio_url=audio_url)
+        if file_size is not None:
+            if not utils.ensure_size_under_limit(file_size, utils.upload_size_limit, update, context):
+                return
 
-        if not utils.ensure_valid_converted_file(
-            file_bytes=mp4_bytes,
-            update=update,
-            context=context
-        ):
-            return
+            metrics.count_input_bytes(file_size)
+
+    except Exception as error:
+        logger.error(f'youtube-dl error: {error}')
+
+    if chat_type == telegram.Chat.PRIVATE and (caption is None or video_url is None):
+        bot.send_message(
+            chat_id,
+            'No video found on this link.',
+            disable_web_page_preview=True,
+            reply_to_message_id=message_id
+        )
+
+        return
+
+    output_stream = utils.convert_stream(constants.OutputType.VIDEO, utils.upload_size_limit, input_video_url=video_url, input_audio_url=audio_url, probe_result=video_probe_result, user_id=user.id if user is not None else None)
 
-        if mp4_bytes is not None:
-            output_bytes.write(mp4_bytes)
+    if not utils.ensure_valid_converted_file(
+        file_bytes=output_stream,
+        update=update,
+        context=context
+    ):
+        return
 
-        output_bytes.seek(0)
+    if output_stream is None:
+        return
 
+    # The stream is closed even when sending it fails before reading it.
+    with output_stream:
         if caption is not None:
             caption = caption[:telegram.constants.MAX_CAPTION_LENGTH]
 
-        utils.send_video(bot, chat_id, message_id, output_bytes, caption, chat_type)
+        sent_message = utils.send_converted_output(bot, constants.OutputType.VIDEO, update, context, output_stream, caption, chat_type)
+        output_file_id = utils.get_message_file_id(sent_message)
+
+        if output_file_id is not None:
+            utils.single_flight.share_output(constants.OutputType.VIDEO, output_file_id, caption)
 
 
+@run_as_job(constants.OutputType.VIDEO_NOTE)
 def message_answer_handler(update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
     callback_query = update.callback_query
 
@@ -701,14 +877,14 @@ def message_answer_handler(update: telegram.Update, context: telegram.ext.Callba
     raw_callback_data = callback_query.data
 
     if raw_callback_data is None:
-        callback_query.answer()
+        utils.answer_callback_query(callback_query)
 
         return
 
     callback_data = json.loads(raw_callback_data)
 
     if callback_data is None:
-        callback_query.answer()
+        utils.answer_callback_query(callback_query)
 
         return
 
@@ -735,10 +911,11 @@ def message_answer_handler(update: telegram.Update, context: telegram.ext.Callba
 
     file_size = attachment.file_size
 
-    if file_size is not None and not utils.ensure_size_under_limit(file_size, telegram.constants.MAX_FILESIZE_DOWNLOAD, update, context):
+    if file_size is not None and not utils.ensure_size_under_limit(file_size, utils.download_size_limit, update, context):
         return
 
     attachment_file_id = attachment.file_id
+    attachment_file_unique_id = attachment.file_unique_id
 
     message_id = message.message_id
     chat_id = message.chat.id
@@ -750,99 +927,110 @@ def message_answer_handler(update: telegram.Update, context: telegram.ext.Callba
 
         analytics_handler.track(context, analytics.AnalyticsType.MESSAGE, user)
 
-    if chat_type == telegram.Chat.PRIVATE:
-        bot.send_chat_action(chat_id, telegram.ChatAction.TYPING)
+    if send_cached_output(bot, chat_id, message_id, chat_type, attachment_file_unique_id, [constants.OutputType.VIDEO_NOTE]):
+        utils.answer_callback_query(callback_query)
 
-    input_file = bot.get_file(attachment_file_id)
-    input_file_url = input_file.file_path
+        return
 
-    probe = None
+    if send_shared_output(bot, chat_id, message_id, chat_type, attachment_file_unique_id, [constants.OutputType.VIDEO_NOTE]):
+        utils.answer_callback_query(callback_query)
 
-    try:
-        probe = ffmpeg.probe(input_file_url)
-    except ffmpeg.Error:
-        pass
+        return
 
-    with io.BytesIO() as output_bytes:
-        output_type = constants.OutputType.NONE
+    # The video note made along with the video is sent without downloading and converting the video again.
+    output_variants = utils.variant_cache.pop(attachment_file_unique_id)
 
-        invalid_format = None
+    if output_variants is not None:
+        bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_VIDEO)
 
-        if probe:
-            for stream in probe['streams']:
-                codec_name = stream.get('codec_name')
+        sent_variant_message = utils.send_video_note_variant(bot, chat_id, message_id, output_variants)
 
-                if codec_name is not None:
-                    invalid_format = codec_name
+        cache_sent_output(sent_variant_message, attachment_file_unique_id, file_size, constants.OutputType.VIDEO_NOTE)
 
-                if codec_name in constants.VIDEO_CODEC_NAMES:
-                    output_type = constants.OutputType.VIDEO_NOTE
+        utils.answer_callback_query(callback_query)
 
-                    mp4_bytes = utils.convert(output_type, input_video_url=input_file_url)
+        return
 
-                    if not utils.ensure_valid_converted_file(
-                        file_bytes=mp4_bytes,
-                        update=update,
-                        context=context
-                    ):
-                        callback_query.answer()
+    if not start_job(update, context):
+        return
 
-                        return
+    if chat_type == telegram.Chat.PRIVATE:
+        bot.send_chat_action(chat_id, telegram.ChatAction.TYPING)
 
-                    if mp4_bytes is not None:
-                        output_bytes.write(mp4_bytes)
+    with metrics.measure_stage('get_file'):
+        input_file = bot.get_file(attachment_file_id)
 
-                    break
+    input_file_url = input_file.file_path
 
-                continue
+    metrics.count_input_bytes(file_size)
 
-        if output_type == constants.OutputType.NONE:
-            if chat_type == telegram.Chat.PRIVATE:
-                if invalid_format is None and input_file_url is not None:
-                    parts = os.path.splitext(input_file_url)
+    probe_result = utils.prober.probe(input_file_url, attachment_file_unique_id)
 
-                    if parts is not None and len(parts) >= 2:
-                        extension = parts[1]
+    output_type = constants.OutputType.NONE
+    output_stream = None
 
-                        if extension is not None:
-                            invalid_format = extension[1:]
+    invalid_format = None
 
-                bot.send_message(
-                    chat_id=chat_id,
-                    text=f'File type "{invalid_format}" is not yet supported.',
-                    reply_to_message_id=message_id
-                )
+    if probe_result:
+        for stream in probe_result.streams:
+            codec_name = stream.get('codec_name')
 
-            callback_query.answer()
+            if codec_name is not None:
+                invalid_format = codec_name
 
-            return
+            if codec_name in constants.VIDEO_CODEC_NAMES:
+                output_type = constants.OutputType.VIDEO_NOTE
 
-        output_bytes.seek(0)
+                output_stream = utils.convert_stream(output_type, utils.upload_size_limit, input_video_url=input_file_url, probe_result=probe_result, user_id=user.id if user is not None else None)
 
-        output_file_size = output_bytes.getbuffer().nbytes
+                if not utils.ensure_valid_converted_file(
+                    file_bytes=output_stream,
+                    update=update,
+                    context=context
+                ):
+                    utils.answer_callback_query(callback_query)
 
-        if output_type == constants.OutputType.VIDEO_NOTE:
-            if not utils.ensure_size_under_limit(output_file_size, telegram.constants.MAX_FILESIZE_UPLOAD, update, context, file_reference_text='Converted file'):
-                callback_query.answer()
+                    return
 
-                return
+                break
 
-            bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_VIDEO)
+            continue
 
-            utils.send_video_note(bot, chat_id, message_id, output_bytes)
+    if output_stream is None:
+        if chat_type == telegram.Chat.PRIVATE:
+            if invalid_format is None and input_file_url is not None:
+                parts = os.path.splitext(input_file_url)
 
-            callback_query.answer()
+                if parts is not None and len(parts) >= 2:
+                    extension = parts[1]
 
-            return
+                    if extension is not None:
+                        invalid_format = extension[1:]
 
-    if chat_type == telegram.Chat.PRIVATE:
-        bot.send_message(
-            chat_id,
-            'File type is not yet supported.',
-            reply_to_message_id=message_id
-        )
+            bot.send_message(
+                chat_id=chat_id,
+                text=f'File type "{invalid_format}" is not yet supported.',
+                reply_to_message_id=message_id
+            )
 
-    callback_query.answer()
+        utils.answer_callback_query(callback_query)
+
+        return
+
+    # The stream is closed even when sending it fails before reading it.
+    with output_stream:
+        bot.send_chat_action(chat_id, telegram.ChatAction.UPLOAD_VIDEO)
+
+        sent_message = utils.send_converted_output(bot, output_type, update, context, output_stream, None, chat_type)
+
+        cache_sent_output(sent_message, attachment_file_unique_id, file_size, output_type)
+
+        utils.answer_callback_query(callback_query)
+
+
+def record_update_handler(update: object, _context: telegram.ext.CallbackContext) -> None:
+    if update_recorder is not None:
+        update_recorder.record(update)
 
 
 def error_handler(update: object, context: telegram.ext.CallbackContext) -> None:
@@ -851,7 +1039,7 @@ def error_handler(update: object, context: telegram.ext.CallbackContext) -> None
     logger.error(f'Update "{json.dumps(update_str, indent=4, ensure_ascii=False)}" caused error "{context.error}"')
 
 
-def main() -> None:
+def add_handlers(dispatcher: telegram.ext.Dispatcher) -> None:
     message_file_filters = (
         (
             telegram.ext.Filters.audio |
@@ -878,19 +1066,39 @@ def main() -> None:
 
     video_filter = telegram.ext.Filters.video
 
-    dispatcher = updater.dispatcher
-
     dispatcher.add_handler(telegram.ext.CommandHandler('start', start_command_handler))
 
     dispatcher.add_handler(telegram.ext.CommandHandler('restart', restart_command_handler))
+    dispatcher.add_handler(telegram.ext.CommandHandler('cancel', cancel_command_handler))
     dispatcher.add_handler(telegram.ext.CommandHandler('logs', logs_command_handler))
     dispatcher.add_handler(telegram.ext.CommandHandler('users', users_command_handler, pass_args=True))
+    dispatcher.add_handler(telegram.ext.CommandHandler('stats', stats_command_handler))
 
     dispatcher.add_handler(telegram.ext.MessageHandler(message_file_filters, message_file_handler, run_async=True))
     dispatcher.add_handler(telegram.ext.MessageHandler(video_filter, message_video_handler, run_async=True))
     dispatcher.add_handler(telegram.ext.MessageHandler(message_text_filters, message_text_handler, run_async=True))
     dispatcher.add_handler(telegram.ext.CallbackQueryHandler(message_answer_handler, run_async=True))
 
+
+def main() -> None:
+    dispatcher = updater.dispatcher
+
+    add_handlers(dispatcher)
+
+    if update_recorder is not None:
+        # A group that runs before the other handlers, and doesn't stop them.
+        dispatcher.add_handler(telegram.ext.TypeHandler(telegram.Update, record_update_handler), group=-1)
+
+    dispatcher.job_queue.run_repeating(flush_users, interval=users_flush_interval)
+    # The finished jobs are also deleted while running, as the bot can run for much longer than their retention.
+    dispatcher.job_queue.run_repeating(delete_finished_jobs, interval=constants.FINISHED_JOBS_DELETE_INTERVAL)
+
+    if metrics_port is not None:
+        try:
+            metrics.start_server(metrics_address, metrics_port)
+        except OSError as error:
+            logger.error(f'Metrics server error: {error}')
+
     if cli_args.debug:
         logger.info('Started polling')
 
@@ -931,11 +1139,19 @@ def main() -> None:
 
             updater.start_polling()
 
+    resume_jobs()
+
     logger.info('Bot started. Press Ctrl-C to stop.')
 
     updater.bot.send_message(ADMIN_USER_ID, 'Bot has been restarted')
     updater.idle()
 
+    database.User.flush_pending_updates()
+    analytics_handler.stop()
+
+    if update_recorder is not None:
+        update_recorder.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -970,7 +1186,138 @@ if __name__ == '__main__':
 
         sys.exit(2)
 
-    updater = telegram.ext.Updater(BOT_TOKEN)
+    workers_count = constants.DEFAULT_WORKERS_COUNT
+
+    try:
+        if config.has_section('Scheduler'):
+            workers_count = config.getint('Scheduler', 'Workers', fallback=workers_count)
+
+            for output_type in constants.DEFAULT_CONVERSION_SLOTS_COUNTS:
+                if config.has_option('Scheduler', output_type):
+                    utils.conversion_scheduler.set_slots_count(output_type, config.getint('Scheduler', output_type))
+
+            utils.rate_limiter.configure(
+                user_rate=config.getfloat('Scheduler', 'UserRate', fallback=utils.rate_limiter.user_rate),
+                user_burst=config.getint('Scheduler', 'UserBurst', fallback=utils.rate_limiter.user_burst),
+                chat_rate=config.getfloat('Scheduler', 'ChatRate', fallback=utils.rate_limiter.chat_rate),
+                chat_burst=config.getint('Scheduler', 'ChatBurst', fallback=utils.rate_limiter.chat_burst)
+            )
+    except (configparser.Error, ValueError) as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    try:
+        if config.has_section('Watchdog'):
+            for output_type in constants.DEFAULT_CONVERSION_TIME_LIMITS:
+                if config.has_option('Watchdog', output_type):
+                    utils.watchdog.set_time_limit(output_type, config.getint('Watchdog', output_type))
+    except (configparser.Error, ValueError) as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    users_flush_interval = constants.DEFAULT_USERS_FLUSH_INTERVAL
+
+    try:
+        if config.has_section('Database'):
+            users_flush_interval = config.getint('Database', 'UsersFlushInterval', fallback=users_flush_interval)
+            database.User.update_granularity = config.getint('Database', 'UsersUpdateGranularity', fallback=database.User.update_granularity)
+    except (configparser.Error, ValueError) as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    try:
+        if config.has_section('Recorder'):
+            recorder_salt = config.get('Recorder', 'Salt')
+
+            if not recorder_salt or recorder_salt == constants.PLACEHOLDER_RECORDER_SALT:
+                logger.error('The recorder salt must be changed from the sample one')
+
+                sys.exit(3)
+
+            update_recorder = recording.UpdateRecorder(config.get('Recorder', 'Path'), recorder_salt)
+    except configparser.Error as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    metrics_address = constants.DEFAULT_METRICS_ADDRESS
+    metrics_port: typing.Optional[int] = None
+
+    try:
+        if config.has_section('Metrics'):
+            metrics_address = config.get('Metrics', 'Address', fallback=metrics_address)
+            metrics_port = config.getint('Metrics', 'Port')
+    except (configparser.Error, ValueError) as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    try:
+        # Each "Profile <name>" section adds a profile or overrides a built in one, with "<output type>.<setting>" keys.
+        for section in config.sections():
+            if section.startswith('Profile '):
+                profile_name = section[len('Profile '):].strip().lower()
+
+                for (option, value) in config.items(section):
+                    (output_type, _, config_name) = option.partition('.')
+
+                    utils.encoding_profiles.configure(profile_name, output_type, config_name, value)
+
+        if config.has_section('Encoding'):
+            utils.encoding_profiles.set_default_name(config.get('Encoding', 'Profile', fallback=utils.encoding_profiles.default_name).lower())
+    except (configparser.Error, ValueError) as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    try:
+        if config.has_section('Variants'):
+            utils.variant_cache.configure(
+                is_enabled=config.getboolean('Variants', 'Enabled', fallback=utils.variant_cache.is_enabled),
+                duration=config.getint('Variants', 'Duration', fallback=int(utils.variant_cache.duration)),
+                size_limit=config.getint('Variants', 'Size', fallback=utils.variant_cache.size_limit)
+            )
+    except (configparser.Error, ValueError) as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    try:
+        # The "Image" section has "<format>.<setting>" keys, like "WEBP.Method".
+        if config.has_section('Image'):
+            for (option, value) in config.items('Image'):
+                (image_format, _, config_name) = option.partition('.')
+
+                converters.image_renderer.configure(image_format, config_name, value)
+    except (configparser.Error, ValueError) as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    try:
+        if config.has_section('PDF'):
+            converters.pdf_renderer.configure(
+                mode=config.get('PDF', 'Mode', fallback=converters.pdf_renderer.mode),
+                album_pages_count=config.getint('PDF', 'Pages', fallback=converters.pdf_renderer.album_pages_count),
+                threads_count=config.getint('PDF', 'Threads', fallback=converters.pdf_renderer.threads_count)
+            )
+    except (configparser.Error, ValueError) as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    try:
+        if config.has_section('Probe'):
+            utils.prober.probe_size = config.getint('Probe', 'Size', fallback=utils.prober.probe_size)
+            utils.prober.analyze_duration = config.getint('Probe', 'AnalyzeDuration', fallback=utils.prober.analyze_duration)
+            utils.prober.cache_ttl = config.getfloat('Probe', 'CacheTTL', fallback=utils.prober.cache_ttl)
+    except (configparser.Error, ValueError) as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+    bot_api_url = constants.BOT_API_URL
+    bot_api_file_url = constants.BOT_API_FILE_URL
+
+    try:
+        if config.has_section('LocalServer'):
+            bot_api_url = config.get('LocalServer', 'Url')
+            bot_api_file_url = config.get('LocalServer', 'FileUrl')
+
+            # The local server returns the paths of the files on its disk, which are read in place instead of being
+            # downloaded.
+            utils.download_size_limit = constants.LOCAL_SERVER_MAX_FILESIZE_DOWNLOAD
+            utils.upload_size_limit = constants.LOCAL_SERVER_MAX_FILESIZE_UPLOAD
+    except configparser.Error as config_error:
+        logger.warning(f'Config error: {config_error}')
+
+        bot_api_url = constants.BOT_API_URL
+        bot_api_file_url = constants.BOT_API_FILE_URL
+
+    updater = telegram.ext.Updater(bot=uploading.create_bot(BOT_TOKEN, bot_api_url, bot_api_file_url, workers_count), workers=workers_count)
     analytics_handler = analytics.AnalyticsHandler()
 
     try:
@@ -978,6 +1325,7 @@ if __name__ == '__main__':
 
         if not cli_args.debug:
             analytics_handler.googleToken = config.get('Google', 'Key')
+            analytics_handler.batchUrl = config.get('Google', 'BatchUrl', fallback=analytics_handler.batchUrl)
     except configparser.Error as config_error:
         logger.warning(f'Config error: {config_error}')
 
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import abc
+import bisect
+import contextlib
+import http.server
+import logging
+import threading
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+LabelValues = typing.Tuple[str, ...]
+
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+def format_labels(label_names: typing.Sequence[str], label_values: LabelValues, extra_label: str = '') -> str:
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+
+    if extra_label:
+        labels.append(extra_label)
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join(labels) + '}'
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class Metric(abc.ABC):
+    type_name = ''
+
+    def __init__(self, name: str, description: str, label_names: typing.Sequence[str] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+
+        self.lock = threading.Lock()
+
+        registry.register(self)
+
+    def get_label_values(self, label_values: typing.Sequence[typing.Any]) -> LabelValues:
+        if len(label_values) != len(self.label_names):
+            raise ValueError(f'Metric {self.name} expects the labels {self.label_names}')
+
+        return tuple(str(label_value) for label_value in label_values)
+
+    @abc.abstractmethod
+    def render_samples(self) -> typing.List[str]:
+        pass
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.description}',
+            f'# TYPE {self.name} {self.type_name}'
+        ]
+
+        lines.extend(self.render_samples())
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, description: str, label_names: typing.Sequence[str] = ()) -> None:
+        super().__init__(name, description, label_names)
+
+        self.values: typing.Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: typing.Any, amount: float = 1) -> None:
+        key = self.get_label_values(label_values)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_samples(self) -> typing.List[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+
+        return [f'{self.name}{format_labels(self.label_names, key)} {format_number(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def set(self, *label_values: typing.Any, value: float) -> None:
+        key = self.get_label_values(label_values)
+
+        with self.lock:
+            self.values[key] = value
+
+    def dec(self, *label_values: typing.Any, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: typing.Sequence[str] = (), buckets: typing.Sequence[float] = DURATION_BUCKETS) -> None:
+        super().__init__(name, description, label_names)
+
+        self.buckets = list(buckets) + [float('inf')]
+
+        # The bucket counts of each series aren't cumulative until they are rendered.
+        self.series: typing.Dict[LabelValues, typing.Tuple[typing.List[int], typing.List[float]]] = {}
+
+    def observe(self, *label_values: typing.Any, value: float) -> None:
+        key = self.get_label_values(label_values)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            series = self.series.get(key)
+
+            if series is None:
+                series = ([0] * len(self.buckets), [0.0])
+
+                self.series[key] = series
+
+            (bucket_counts, total) = series
+
+            bucket_counts[bucket_index] += 1
+            total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values: typing.Any) -> typing.Iterator[None]:
+        start_time = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.observe(*label_values, value=time.monotonic() - start_time)
+
+    def render_samples(self) -> typing.List[str]:
+        with self.lock:
+            series_items = sorted((key, (list(bucket_counts), total[0])) for key, (bucket_counts, total) in self.series.items())
+
+        lines = []
+
+        for key, (bucket_counts, total) in series_items:
+            count = 0
+
+            for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                count += bucket_count
+
+                bucket_label = 'le="{}"'.format(format_number(bucket))
+
+                lines.append(f'{self.name}_bucket{format_labels(self.label_names, key, bucket_label)} {count}')
+
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, key)} {format_number(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, key)} {count}')
+
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.metrics: typing.List[Metric] = []
+
+    def register(self, metric: Metric) -> None:
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics)
+
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+stage_duration = Histogram('file_convert_stage_duration_seconds', 'Time spent in each stage of each handler.', ['handler', 'stage'])
+conversion_duration = Histogram('file_convert_conversion_duration_seconds', 'Time spent running ffmpeg, by output type and encoding profile.', ['output_type', 'profile'])
+input_bytes = Counter('file_convert_input_bytes_total', 'Size of the downloaded inputs.', ['handler'])
+output_bytes = Counter('file_convert_output_bytes_total', 'Size of the uploaded outputs, by output type.', ['output_type'])
+running_jobs = Gauge('file_convert_running_jobs', 'Number of jobs being handled.')
+queued_conversions = Gauge('file_convert_queued_conversions', 'Number of conversions waiting for a slot, by output type.', ['output_type'])
+running_conversions = Gauge('file_convert_running_conversions', 'Number of conversions holding a slot, by output type.', ['output_type'])
+cancelled_conversions = Counter('file_convert_cancelled_conversions_total', 'Number of ffmpeg runs killed before finishing, by output type and reason.', ['output_type', 'reason'])
+shared_outputs = Counter('file_convert_shared_outputs_total', 'Number of outputs sent from the conversion of another request of the same input, by output type.', ['output_type'])
+served_variants = Counter('file_convert_served_variants_total', 'Number of outputs sent from the variants made along with another conversion, by output type.', ['output_type'])
+ffmpeg_failures = Counter('file_convert_ffmpeg_failures_total', 'Number of failed ffmpeg runs, by input codec.', ['codec'])
+
+handler_names = threading.local()
+
+
+@contextlib.contextmanager
+def handler_context(handler_name: str) -> typing.Iterator[None]:
+    previous_handler_name = getattr(handler_names, 'current', None)
+
+    handler_names.current = handler_name
+    running_jobs.inc()
+
+    try:
+        yield
+    finally:
+        running_jobs.dec()
+        handler_names.current = previous_handler_name
+
+
+def get_handler_name() -> str:
+    return getattr(handler_names, 'current', None) or 'unknown'
+
+
+@contextlib.contextmanager
+def measure_stage(stage: str) -> typing.Iterator[None]:
+    with stage_duration.time(get_handler_name(), stage):
+        yield
+
+
+def count_input_bytes(size: typing.Optional[int]) -> None:
+    if size is not None:
+        input_bytes.inc(get_handler_name(), amount=size)
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+
+            return
+
+        body = registry.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+
+def start_server(address: str, port: int) -> http.server.ThreadingHTTPServer:
+    server = http.server.ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+    logger.info(f'Started metrics server on {address}:{port}')
+
+    return server
@@ -0,0 +1,37 @@
+import datetime
+import typing
+
+import peewee
+import peewee_migrate
+import playhouse.sqlite_ext
+
+GENERIC_DATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def get_current_datetime() -> str:
+    return datetime.datetime.now().strftime(GENERIC_DATE_TIME_FORMAT)
+
+
+def migrate(migrator: peewee_migrate.Migrator, _database: peewee.Database, fake=False, **_kwargs: typing.Any) -> None:
+    if fake is True:
+        return
+
+    @migrator.create_table
+    class Conversion(peewee.Model):
+        rowid = playhouse.sqlite_ext.RowIDField()
+
+        created_at = peewee.DateTimeField(default=get_current_datetime)
+        updated_at = peewee.DateTimeField()
+
+        input_file_unique_id = peewee.TextField()
+        input_file_size = peewee.BigIntegerField(null=True)
+        output_type = peewee.TextField()
+        settings = peewee.TextField()
+        output_file_id = peewee.TextField()
+        hits = peewee.IntegerField(default=0)
+
+        class Meta:
+            table_name = 'conversion'
+            indexes = (
+                (('input_file_unique_id', 'output_type', 'settings'), True),
+            )
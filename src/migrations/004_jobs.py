@@ -0,0 +1,37 @@
+import datetime
+import typing
+
+import peewee
+import peewee_migrate
+import playhouse.sqlite_ext
+
+GENERIC_DATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def get_current_datetime() -> str:
+    return datetime.datetime.now().strftime(GENERIC_DATE_TIME_FORMAT)
+
+
+def migrate(migrator: peewee_migrate.Migrator, _database: peewee.Database, fake=False, **_kwargs: typing.Any) -> None:
+    if fake is True:
+        return
+
+    @migrator.create_table
+    class Job(peewee.Model):
+        rowid = playhouse.sqlite_ext.RowIDField()
+
+        created_at = peewee.DateTimeField(default=get_current_datetime)
+        updated_at = peewee.DateTimeField()
+
+        update_id = peewee.BigIntegerField(unique=True)
+        chat_id = peewee.BigIntegerField(null=True)
+        message_id = peewee.BigIntegerField(null=True)
+        input_file_id = peewee.TextField(null=True)
+        output_type = peewee.TextField(null=True)
+        state = peewee.TextField(default='pending')
+        attempts = peewee.IntegerField(default=0)
+        run_id = peewee.TextField(null=True)
+        raw_update = peewee.TextField()
+
+        class Meta:
+            table_name = 'job'
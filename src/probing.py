@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import time
+import typing
+
+import ffmpeg
+
+import metrics
+
+
+class ProbeResult:
+    def __init__(self, info: typing.Dict[str, typing.Any]) -> None:
+        self.info = info
+
+        self.streams: typing.List[typing.Dict[str, typing.Any]] = info.get('streams', [])
+        self.format: typing.Dict[str, typing.Any] = info.get('format', {})
+
+    def get_streams(self, codec_type: str) -> typing.List[typing.Dict[str, typing.Any]]:
+        return [stream for stream in self.streams if stream.get('codec_type') == codec_type]
+
+    def has_audio_stream(self) -> bool:
+        return any(stream.get('codec_type') == 'audio' for stream in self.streams)
+
+    def get_size(self) -> typing.Optional[int]:
+        size = self.format.get('size')
+
+        if size is None:
+            return None
+
+        return int(size)
+
+    def get_duration(self) -> typing.Optional[float]:
+        duration = self.format.get('duration')
+
+        if duration is None:
+            return None
+
+        return float(duration)
+
+
+class Prober:
+    def __init__(self, probe_size: int, analyze_duration: int, cache_ttl: float, cache_size: int) -> None:
+        self.probe_size = probe_size
+        self.analyze_duration = analyze_duration
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+
+        self.lock = threading.Lock()
+        self.cache: typing.OrderedDict[str, typing.Tuple[float, ProbeResult]] = collections.OrderedDict()
+
+    def get_cached_result(self, cache_key: str) -> typing.Optional[ProbeResult]:
+        with self.lock:
+            cached_item = self.cache.get(cache_key)
+
+            if cached_item is None:
+                return None
+
+            (expiration_time, probe_result) = cached_item
+
+            if expiration_time < time.monotonic():
+                del self.cache[cache_key]
+
+                return None
+
+            return probe_result
+
+    def cache_result(self, cache_key: str, probe_result: ProbeResult) -> None:
+        with self.lock:
+            self.cache[cache_key] = (time.monotonic() + self.cache_ttl, probe_result)
+            self.cache.move_to_end(cache_key)
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def probe(self, url: typing.Optional[str], cache_key: typing.Optional[str] = None) -> typing.Optional[ProbeResult]:
+        if not url:
+            return None
+
+        if cache_key is None:
+            cache_key = url
+
+        probe_result = self.get_cached_result(cache_key)
+
+        if probe_result is not None:
+            return probe_result
+
+        try:
+            with metrics.measure_stage('probe'):
+                info = ffmpeg.probe(url, probesize=self.probe_size, analyzeduration=self.analyze_duration)
+        except ffmpeg.Error:
+            return None
+
+        probe_result = ProbeResult(info)
+
+        self.cache_result(cache_key, probe_result)
+
+        return probe_result
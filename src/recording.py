@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+import telegram
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+IDENTITY_OBJECT_KEYS = [
+    'from', 'chat', 'user', 'sender_chat', 'forward_from', 'forward_from_chat', 'via_bot', 'new_chat_members',
+    'left_chat_member', 'new_chat_member', 'old_chat_member'
+]
+# The other objects that have an id are recognized by their required fields, wherever they are nested.
+CHAT_TYPES = [telegram.Chat.PRIVATE, telegram.Chat.GROUP, telegram.Chat.SUPERGROUP, telegram.Chat.CHANNEL, telegram.Chat.SENDER]
+ID_KEYS = ['user_id', 'migrate_to_chat_id', 'migrate_from_chat_id']
+# The titles of the chats and the audio files are removed by the same key.
+PERSONAL_KEYS = [
+    'username', 'last_name', 'title', 'phone_number', 'bio', 'description', 'invite_link', 'language_code', 'performer',
+    'contact', 'location', 'venue', 'forward_sender_name', 'forward_signature', 'author_signature', 'set_name'
+]
+TEXT_KEYS = [('text', 'entities'), ('caption', 'caption_entities')]
+
+
+def get_entity_text(text: str, entity: typing.Dict[str, typing.Any]) -> str:
+    # Entity offsets are in UTF-16 code units.
+    utf16_text = text.encode('utf-16-le')
+    start = entity['offset'] * 2
+    end = start + entity['length'] * 2
+
+    return utf16_text[start:end].decode('utf-16-le', errors='ignore')
+
+
+def get_utf16_length(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+
+def is_identity_object(data: typing.Dict[str, typing.Any]) -> bool:
+    # Users always have `is_bot`, and chats always have a `type`.
+    return 'id' in data and ('is_bot' in data or data.get('type') in CHAT_TYPES)
+
+
+class UpdateRecorder:
+    def __init__(self, path: str, salt: str) -> None:
+        self.path = path
+        self.salt = salt.encode('utf-8')
+
+        self.lock = threading.Lock()
+        self.file: typing.Optional[typing.TextIO] = None
+
+        # Deferred and resumed jobs put the same update back in the queue, and it should only be recorded once.
+        self.recorded_update_ids: typing.Deque[int] = collections.deque(maxlen=constants.RECORDED_UPDATE_IDS_COUNT)
+
+        self.recorded_count = 0
+
+    def hash(self, value: typing.Any) -> str:
+        return hmac.new(self.salt, str(value).encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+    def hash_id(self, value: typing.Any) -> int:
+        hashed_id = int(self.hash(value), 16) % constants.ANONYMIZED_ID_RANGE
+
+        # Negative ids are chats, and they must stay that way for the chat type filters.
+        return -hashed_id if isinstance(value, int) and value < 0 else hashed_id
+
+    def anonymize_text(self, data: typing.Dict[str, typing.Any], text_key: str, entities_key: str) -> None:
+        text = data.get(text_key)
+
+        if text is None:
+            return
+
+        # Only the links are kept, as they are what the bot converts.
+        urls = []
+
+        for entity in data.get(entities_key, []):
+            if entity.get('type') == telegram.MessageEntity.URL:
+                urls.append(get_entity_text(text, entity))
+            elif entity.get('type') == telegram.MessageEntity.TEXT_LINK and 'url' in entity:
+                urls.append(entity['url'])
+
+        anonymized_text = ''
+        entities = []
+
+        for url in urls:
+            if anonymized_text:
+                anonymized_text += '\n'
+
+            entities.append({
+                'type': telegram.MessageEntity.URL,
+                'offset': get_utf16_length(anonymized_text),
+                'length': get_utf16_length(url)
+            })
+
+            anonymized_text += url
+
+        if anonymized_text:
+            data[text_key] = anonymized_text
+        elif text_key == 'text':
+            data[text_key] = '-'
+        else:
+            data.pop(text_key)
+
+        if entities:
+            data[entities_key] = entities
+        else:
+            data.pop(entities_key, None)
+
+    def anonymize(self, data: typing.Any, is_identity: bool = False) -> typing.Any:
+        if isinstance(data, list):
+            return [self.anonymize(item, is_identity=is_identity) for item in data]
+
+        if not isinstance(data, dict):
+            return data
+
+        is_identity = is_identity or is_identity_object(data)
+
+        anonymized_data: typing.Dict[str, typing.Any] = {}
+
+        for key, value in data.items():
+            if key in PERSONAL_KEYS:
+                continue
+
+            if (key == 'id' and is_identity) or key in ID_KEYS:
+                anonymized_data[key] = self.hash_id(value)
+            elif key == 'first_name':
+                # It is required by the Bot API objects.
+                anonymized_data[key] = '-'
+            elif key in ['file_id', 'file_unique_id']:
+                anonymized_data[key] = self.hash(value)
+            elif key == 'file_name' and isinstance(value, str):
+                # The extension is kept, as it decides whether a document is converted in groups.
+                anonymized_data[key] = 'file' + os.path.splitext(value)[1]
+            else:
+                anonymized_data[key] = self.anonymize(value, is_identity=key in IDENTITY_OBJECT_KEYS)
+
+        for text_key, entities_key in TEXT_KEYS:
+            self.anonymize_text(anonymized_data, text_key, entities_key)
+
+        return anonymized_data
+
+    def record(self, update: object) -> None:
+        if not isinstance(update, telegram.Update):
+            return
+
+        line = json.dumps({
+            'time': time.time(),
+            'update': self.anonymize(update.to_dict())
+        }, ensure_ascii=False)
+
+        with self.lock:
+            if update.update_id in self.recorded_update_ids:
+                return
+
+            self.recorded_update_ids.append(update.update_id)
+
+            try:
+                if self.file is None:
+                    # Appending adds a new gzip member, which is read back as a continuation of the previous ones.
+                    self.file = typing.cast(typing.TextIO, gzip.open(self.path, 'at', encoding='utf-8'))
+
+                self.file.write(line + '\n')
+
+                self.recorded_count += 1
+
+                if self.recorded_count % constants.RECORDER_FLUSH_INTERVAL == 0:
+                    self.file.flush()
+            except OSError as error:
+                logger.error(f'Recorder error: {error}')
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+
+                self.file = None
+
+
+def read_updates(path: str) -> typing.Iterator[typing.Tuple[float, typing.Dict[str, typing.Any]]]:
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        try:
+            for line in file:
+                if not line.strip():
+                    continue
+
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    logger.warning('Skipped an unreadable recorded update')
+
+                    continue
+
+                yield item['time'], item['update']
+        except EOFError:
+            # The last gzip member is cut short if the bot was killed while writing it.
+            logger.warning('The recorded updates end abruptly')
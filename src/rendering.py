@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import configparser
+import copy
+import io
+import logging
+import re
+import typing
+
+import pdf2image
+import PIL.Image
+
+import constants
+import staging
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE_PATTERN = re.compile(r'(?P<width>[\d.]+) x (?P<height>[\d.]+)')
+
+IMAGE_SETTING_NAMES = {
+    'WEBP': {
+        'method': 'method',
+        'quality': 'quality',
+        'lossless': 'lossless'
+    },
+    'PNG': {
+        'compresslevel': 'compress_level',
+        'optimize': 'optimize'
+    }
+}
+BOOLEAN_SETTING_NAMES = ['lossless', 'optimize']
+
+
+class NoPagesRenderedError(Exception):
+    def __init__(self) -> None:
+        super().__init__('No PDF page was rendered')
+
+
+def scale_down(image: PIL.Image.Image, size: int) -> PIL.Image.Image:
+    ratio = size / max(image.size)
+
+    if ratio >= 1:
+        return image
+
+    scaled_size = (max(1, round(image.width * ratio)), max(1, round(image.height * ratio)))
+    gap = constants.IMAGE_REDUCING_GAP
+
+    # The JPEG decoder scales the image down by up to 8 times while decoding it, as long as both sides stay over the
+    # reducing gap. The draft of "Image.thumbnail" asks for a square, which skips the scaling for most photos.
+    image.draft(None, (int(scaled_size[0] * gap), int(scaled_size[1] * gap)))
+
+    # The other formats are reduced by an integer factor first, so the full image is never resampled.
+    return image.resize(scaled_size, reducing_gap=gap)
+
+
+class ImageRenderer:
+    def __init__(self, encoder_settings: typing.Dict[str, typing.Any], sticker_size: int) -> None:
+        self.encoder_settings: typing.Dict[str, typing.Dict[str, typing.Any]] = copy.deepcopy(encoder_settings)
+        self.sticker_size = sticker_size
+
+    def configure(self, image_format: str, config_name: str, value: str) -> None:
+        image_format = image_format.upper()
+        setting_name = IMAGE_SETTING_NAMES.get(image_format, {}).get(config_name.lower())
+
+        if setting_name is None:
+            raise ValueError(f'Unknown image setting {image_format}.{config_name}')
+
+        setting_value: typing.Any
+
+        if setting_name in BOOLEAN_SETTING_NAMES:
+            if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ValueError(f'Not a boolean: {value}')
+
+            setting_value = configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        else:
+            setting_value = int(value)
+
+        self.encoder_settings.setdefault(image_format, {})[setting_name] = setting_value
+
+    def save(self, image: PIL.Image.Image, output_bytes: io.BytesIO, image_format: str) -> None:
+        image.save(output_bytes, format=image_format, **self.encoder_settings.get(image_format, {}))
+
+    def render_sticker(self, source: typing.Union[str, typing.BinaryIO], output_bytes: io.BytesIO) -> None:
+        with PIL.Image.open(source) as image:
+            self.save(scale_down(image, self.sticker_size), output_bytes, 'WEBP')
+
+    def render_photo(self, source: typing.Union[str, typing.BinaryIO], output_bytes: io.BytesIO) -> None:
+        with PIL.Image.open(source) as image:
+            self.save(image, output_bytes, 'PNG')
+
+
+class PdfRenderer:
+    def __init__(self, mode: str, album_pages_count: int, threads_count: int, image_renderer: ImageRenderer) -> None:
+        self.mode = mode
+        self.album_pages_count = album_pages_count
+        self.threads_count = threads_count
+        self.image_renderer = image_renderer
+
+    def configure(self, mode: str, album_pages_count: int, threads_count: int) -> None:
+        if mode not in [constants.PdfMode.PHOTO, constants.PdfMode.ALBUM]:
+            raise ValueError(f'Unknown PDF mode {mode}')
+
+        self.mode = mode
+        self.album_pages_count = max(1, min(constants.MAX_PDF_ALBUM_PAGES_COUNT, album_pages_count))
+        self.threads_count = max(1, threads_count)
+
+    def get_dpi(self, staged_input: staging.StagedInput, size: int) -> typing.Optional[int]:
+        try:
+            if staged_input.path is not None:
+                info = pdf2image.pdfinfo_from_path(staged_input.path, timeout=constants.PDF_RENDER_TIMEOUT)
+            else:
+                info = pdf2image.pdfinfo_from_bytes(staged_input.open().read(), timeout=constants.PDF_RENDER_TIMEOUT)
+        except Exception as error:
+            logger.warning(f'pdfinfo error: {error}')
+
+            return None
+
+        match = PAGE_SIZE_PATTERN.search(str(info.get('Page size', '')))
+
+        if match is None:
+            return None
+
+        longest_side = max(float(match.group('width')), float(match.group('height')))
+
+        if longest_side <= 0:
+            return None
+
+        # The page size is in points, and the longest side is rendered to fit in the size of the photos.
+        dpi = size * constants.PDF_POINTS_PER_INCH / longest_side
+
+        return max(1, min(constants.MAX_PDF_DPI, int(dpi)))
+
+    def render(self, staged_input: staging.StagedInput, pages_count: int, size: int) -> typing.List[PIL.Image.Image]:
+        dpi = self.get_dpi(staged_input, size)
+        arguments: typing.Dict[str, typing.Any] = {
+            'first_page': 1,
+            'last_page': pages_count,
+            'thread_count': min(pages_count, self.threads_count),
+            'timeout': constants.PDF_RENDER_TIMEOUT
+        }
+
+        # Without the page size, poppler scales the pages to fit in the size instead.
+        if dpi is not None:
+            arguments['dpi'] = dpi
+        else:
+            arguments['size'] = size
+
+        logger.info(f'Rendering {pages_count} PDF pages at {dpi or "unknown"} DPI')
+
+        if staged_input.path is not None:
+            images = pdf2image.convert_from_path(staged_input.path, **arguments)
+        else:
+            images = pdf2image.convert_from_bytes(staged_input.open().read(), **arguments)
+
+        if not images:
+            raise NoPagesRenderedError()
+
+        return images
+
+    def render_photo(self, staged_input: staging.StagedInput, output_bytes: io.BytesIO) -> None:
+        images = self.render(staged_input, 1, constants.PDF_PHOTO_SIZE)
+
+        self.image_renderer.save(images[0], output_bytes, 'PNG')
+
+    def render_album(self, staged_input: staging.StagedInput) -> typing.List[io.BytesIO]:
+        pages_bytes = []
+
+        for image in self.render(staged_input, self.album_pages_count, constants.PDF_ALBUM_PAGE_SIZE):
+            page_bytes = io.BytesIO()
+
+            self.image_renderer.save(image, page_bytes, 'PNG')
+            image.close()
+
+            page_bytes.seek(0)
+
+            pages_bytes.append(page_bytes)
+
+        return pages_bytes
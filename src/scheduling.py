@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+import typing
+
+import metrics
+import telegram_utils
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_time = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_time) * self.rate)
+        self.updated_time = now
+
+    def get_delay(self, now: float) -> float:
+        self.refill(now)
+
+        if self.tokens >= 1:
+            return 0.0
+
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    def __init__(self, user_rate: float, user_burst: int, chat_rate: float, chat_burst: int, max_buckets_count: int) -> None:
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_buckets_count = max_buckets_count
+
+        self.lock = threading.Lock()
+        self.user_buckets: typing.Dict[int, TokenBucket] = {}
+        self.chat_buckets: typing.Dict[int, TokenBucket] = {}
+
+        self.deferred_counts: typing.Counter[int] = collections.Counter()
+        self.notified_user_ids: typing.Set[int] = set()
+
+    def configure(self, user_rate: float, user_burst: int, chat_rate: float, chat_burst: int) -> None:
+        with self.lock:
+            self.user_rate = user_rate
+            self.user_burst = user_burst
+            self.chat_rate = chat_rate
+            self.chat_burst = chat_burst
+
+            self.user_buckets.clear()
+            self.chat_buckets.clear()
+
+    def get_bucket(self, buckets: typing.Dict[int, TokenBucket], key: int, rate: float, capacity: int, now: float) -> TokenBucket:
+        bucket = buckets.get(key)
+
+        if bucket is None:
+            if len(buckets) >= self.max_buckets_count:
+                # Full buckets belong to idle users and chats, so forgetting them doesn't change any limit.
+                for idle_key in [bucket_key for bucket_key, idle_bucket in buckets.items() if idle_bucket.is_full(now)]:
+                    del buckets[idle_key]
+
+            bucket = TokenBucket(rate, capacity, now)
+
+            buckets[key] = bucket
+
+        return bucket
+
+    def reserve(self, user_id: int, chat_id: int) -> float:
+        now = time.monotonic()
+
+        with self.lock:
+            buckets = [
+                self.get_bucket(self.user_buckets, user_id, self.user_rate, self.user_burst, now),
+                self.get_bucket(self.chat_buckets, chat_id, self.chat_rate, self.chat_burst, now)
+            ]
+
+            delay = max(bucket.get_delay(now) for bucket in buckets)
+
+            if delay > 0:
+                return delay
+
+            for bucket in buckets:
+                bucket.tokens -= 1
+
+            if self.deferred_counts[user_id] == 0:
+                self.notified_user_ids.discard(user_id)
+
+            return 0.0
+
+    def defer(self, user_id: int, delay: float) -> typing.Tuple[float, int, bool]:
+        with self.lock:
+            ahead_count = self.deferred_counts[user_id]
+
+            self.deferred_counts[user_id] += 1
+
+            should_notify = user_id not in self.notified_user_ids
+
+            self.notified_user_ids.add(user_id)
+
+        # Spread the user's deferred jobs over the refill time, so that they don't all wake up for a single token.
+        return delay + ahead_count / self.user_rate, ahead_count, should_notify
+
+    def resume(self, user_id: int) -> None:
+        with self.lock:
+            self.deferred_counts[user_id] -= 1
+
+            if self.deferred_counts[user_id] <= 0:
+                del self.deferred_counts[user_id]
+
+    def get_deferred_count(self) -> int:
+        with self.lock:
+            return sum(self.deferred_counts.values())
+
+
+class ConversionSlots:
+    def __init__(self, count: int) -> None:
+        self.count = count
+        self.running_count = 0
+        self.waiting: typing.OrderedDict[typing.Optional[int], typing.Deque[object]] = collections.OrderedDict()
+        self.waiting_count = 0
+        self.condition = threading.Condition()
+
+        self.jobs_count = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def enqueue(self, user_id: typing.Optional[int], ticket: object) -> None:
+        tickets = self.waiting.get(user_id)
+
+        if tickets is None:
+            tickets = collections.deque()
+
+            self.waiting[user_id] = tickets
+
+        tickets.append(ticket)
+
+        self.waiting_count += 1
+
+    def is_next(self, ticket: object) -> bool:
+        tickets = next(iter(self.waiting.values()))
+
+        return tickets[0] is ticket
+
+    def dequeue(self) -> None:
+        user_id, tickets = next(iter(self.waiting.items()))
+
+        tickets.popleft()
+
+        self.waiting_count -= 1
+
+        # Every user with queued conversions gets a turn before the same user gets the next one.
+        if tickets:
+            self.waiting.move_to_end(user_id)
+        else:
+            del self.waiting[user_id]
+
+    def update_metrics(self, output_type: str) -> None:
+        metrics.queued_conversions.set(output_type, value=self.waiting_count)
+        metrics.running_conversions.set(output_type, value=self.running_count)
+
+    def record_wait_time(self, wait_time: float) -> None:
+        self.jobs_count += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def get_average_wait_time(self) -> float:
+        if self.jobs_count == 0:
+            return 0.0
+
+        return self.total_wait_time / self.jobs_count
+
+
+class ConversionScheduler:
+    def __init__(self, slots_counts: typing.Dict[str, int], default_slots_count: int) -> None:
+        self.default_slots_count = default_slots_count
+
+        self.lock = threading.Lock()
+        self.slots = {
+            output_type: ConversionSlots(slots_count) for output_type, slots_count in slots_counts.items()
+        }
+
+    def get_slots(self, output_type: str) -> ConversionSlots:
+        with self.lock:
+            slots = self.slots.get(output_type)
+
+            if slots is None:
+                slots = ConversionSlots(self.default_slots_count)
+
+                self.slots[output_type] = slots
+
+            return slots
+
+    def set_slots_count(self, output_type: str, count: int) -> None:
+        slots = self.get_slots(output_type)
+
+        with slots.condition:
+            slots.count = max(count, 1)
+
+            slots.condition.notify_all()
+
+    def get_queue_depth(self, output_type: str) -> int:
+        slots = self.get_slots(output_type)
+
+        with slots.condition:
+            return slots.waiting_count
+
+    def get_total_queue_depth(self) -> int:
+        with self.lock:
+            slots_list = list(self.slots.values())
+
+        return sum(slots.waiting_count for slots in slots_list)
+
+    def acquire(self, output_type: str, user_id: typing.Optional[int] = None) -> float:
+        slots = self.get_slots(output_type)
+
+        ticket = object()
+        start_time = time.monotonic()
+
+        with slots.condition:
+            slots.enqueue(user_id, ticket)
+            slots.update_metrics(output_type)
+
+            while not slots.is_next(ticket) or slots.running_count >= slots.count:
+                slots.condition.wait()
+
+            slots.dequeue()
+            slots.running_count += 1
+
+            wait_time = time.monotonic() - start_time
+
+            slots.record_wait_time(wait_time)
+            slots.update_metrics(output_type)
+
+            # The next job in the queue might fit in a slot that is still free.
+            slots.condition.notify_all()
+
+            queue_depth = slots.waiting_count
+
+        logger.info(f'Started {output_type} conversion after waiting {wait_time:.2f}s, {queue_depth} still queued')
+
+        return wait_time
+
+    def release(self, output_type: str) -> None:
+        slots = self.get_slots(output_type)
+
+        with slots.condition:
+            slots.running_count -= 1
+            slots.update_metrics(output_type)
+
+            slots.condition.notify_all()
+
+    def get_statistics_table(self) -> str:
+        statistics_table = ''
+
+        with self.lock:
+            slots_items = sorted(self.slots.items())
+
+        for output_type, slots in slots_items:
+            with slots.condition:
+                statistics = (
+                    f'{slots.running_count}/{slots.count} running, '
+                    f'{slots.waiting_count} queued, '
+                    f'{slots.get_average_wait_time():.2f}s average wait, '
+                    f'{slots.max_wait_time:.2f}s max wait'
+                )
+
+            statistics_table += (
+                f'\n{telegram_utils.escape_v2_markdown_text(output_type)} {telegram_utils.ESCAPED_VERTICAL_LINE} '
+                f'{telegram_utils.escape_v2_markdown_text(statistics)}'
+            )
+
+        if not statistics_table:
+            statistics_table = 'No conversions'
+
+        return statistics_table
+
+
+class SharedOutput:
+    def __init__(self, output_type: str, output_file_id: str, caption: typing.Optional[str], output_file_ids: typing.Optional[typing.List[str]] = None) -> None:
+        self.output_type = output_type
+        self.output_file_id = output_file_id
+        self.caption = caption
+
+        # The albums have a file for each of their photos.
+        self.output_file_ids = output_file_ids or [output_file_id]
+
+
+class Flight:
+    def __init__(self) -> None:
+        self.landed = threading.Event()
+        self.output: typing.Optional[SharedOutput] = None
+        self.followers_count = 0
+
+
+class SingleFlight:
+    def __init__(self, follow_timeout: float) -> None:
+        self.follow_timeout = follow_timeout
+
+        self.lock = threading.Lock()
+        self.flights: typing.Dict[typing.Hashable, Flight] = {}
+
+        # The flights led by each worker thread, which are landed when its job ends.
+        self.local = threading.local()
+
+    def get_led_flights(self) -> typing.Dict[typing.Hashable, Flight]:
+        if not hasattr(self.local, 'flights'):
+            self.local.flights = {}
+
+        return self.local.flights
+
+    def join(self, key: typing.Hashable) -> typing.Optional[Flight]:
+        # Returns the flight to follow, or `None` when the caller leads a new one and has to do the conversion.
+        with self.lock:
+            flight = self.flights.get(key)
+
+            if flight is None:
+                flight = Flight()
+
+                self.flights[key] = flight
+                self.get_led_flights()[key] = flight
+
+                return None
+
+            flight.followers_count += 1
+
+            return flight
+
+    def follow(self, flight: Flight) -> typing.Optional[SharedOutput]:
+        # The wait is bounded, as each follower holds a worker, and the leader might take as long as its time limit.
+        flight.landed.wait(self.follow_timeout)
+
+        return flight.output
+
+    def share_output(self, output_type: str, output_file_id: str, caption: typing.Optional[str], output_file_ids: typing.Optional[typing.List[str]] = None) -> None:
+        for flight in self.get_led_flights().values():
+            flight.output = SharedOutput(output_type, output_file_id, caption, output_file_ids)
+
+    def land(self) -> None:
+        led_flights = self.get_led_flights()
+
+        with self.lock:
+            for key, flight in led_flights.items():
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+
+                if flight.followers_count:
+                    logger.info(f'Sharing the conversion of {key} with {flight.followers_count} other requests')
+
+        for flight in led_flights.values():
+            flight.landed.set()
+
+        led_flights.clear()
+
+    @contextlib.contextmanager
+    def job_context(self) -> typing.Iterator[None]:
+        try:
+            yield
+        finally:
+            self.land()
+
+    def get_count(self) -> int:
+        with self.lock:
+            return len(self.flights)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import os
+import typing
+
+
+class InputKind:
+    UNKNOWN = 'unknown'
+    MEDIA = 'media'
+    PDF = 'pdf'
+    IMAGE = 'image'
+
+
+# See also: https://en.wikipedia.org/wiki/List_of_file_signatures
+IMAGE_SIGNATURES = [
+    b'\x89PNG\r\n\x1a\n',
+    b'\xff\xd8\xff',
+    b'GIF87a',
+    b'GIF89a',
+    b'BM',
+    b'II*\x00',
+    b'MM\x00*',
+    b'\x00\x00\x01\x00'
+]
+MEDIA_SIGNATURES = [
+    b'\x1a\x45\xdf\xa3',  # Matroska and WebM
+    b'OggS',
+    b'ID3',
+    b'fLaC',
+    b'FLV',
+    b'#!AMR',
+    b'\x30\x26\xb2\x75\x8e\x66\xcf\x11',  # ASF, WMA and WMV
+    b'\x00\x00\x01\xba'  # MPEG program stream
+]
+
+# ISO base media brands that are images, which Pillow can't open.
+ISO_IMAGE_BRANDS = [b'heic', b'heix', b'mif1', b'msf1', b'avif']
+
+# Older QuickTime files have no `ftyp` atom, and start with any of these instead.
+QUICKTIME_ATOM_TYPES = [b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot']
+
+MPEG_TRANSPORT_STREAM_PACKET_SIZE = 188
+MPEG_TRANSPORT_STREAM_SYNC_BYTE = 0x47
+
+UNRELIABLE_MIME_TYPES = ['application/octet-stream']
+
+CONVERTIBLE_FILE_EXTENSIONS = [
+    '3gp', 'aac', 'aif', 'aiff', 'amr', 'avi', 'flac', 'flv', 'm4a', 'm4v', 'mkv', 'mov', 'mp3', 'mp4', 'mpeg', 'mpg',
+    'oga', 'ogg', 'ogv', 'opus', 'ts', 'wav', 'webm', 'wma', 'wmv',
+    'pdf',
+    'bmp', 'gif', 'ico', 'jpeg', 'jpg', 'png', 'tif', 'tiff', 'webp'
+]
+
+
+def sniff_header(header: bytes) -> str:
+    if header.startswith(b'%PDF-'):
+        return InputKind.PDF
+
+    if any(header.startswith(signature) for signature in IMAGE_SIGNATURES):
+        return InputKind.IMAGE
+
+    if header[4:8] == b'ftyp':
+        if header[8:12] in ISO_IMAGE_BRANDS:
+            return InputKind.UNKNOWN
+
+        return InputKind.MEDIA
+
+    if header[4:8] in QUICKTIME_ATOM_TYPES:
+        return InputKind.MEDIA
+
+    if header.startswith(b'RIFF'):
+        if header[8:12] == b'WEBP':
+            return InputKind.IMAGE
+        elif header[8:12] in [b'WAVE', b'AVI ']:
+            return InputKind.MEDIA
+
+        return InputKind.UNKNOWN
+
+    if header.startswith(b'FORM') and header[8:12] in [b'AIFF', b'AIFC']:
+        return InputKind.MEDIA
+
+    if any(header.startswith(signature) for signature in MEDIA_SIGNATURES):
+        return InputKind.MEDIA
+
+    if (
+        len(header) > MPEG_TRANSPORT_STREAM_PACKET_SIZE and
+        header[0] == MPEG_TRANSPORT_STREAM_SYNC_BYTE and
+        header[MPEG_TRANSPORT_STREAM_PACKET_SIZE] == MPEG_TRANSPORT_STREAM_SYNC_BYTE
+    ):
+        return InputKind.MEDIA
+
+    # MP3 and ADTS AAC frames without any container.
+    if len(header) >= 2 and header[0] == 0xff and header[1] & 0xe0 == 0xe0:
+        return InputKind.MEDIA
+
+    return InputKind.UNKNOWN
+
+
+def is_reliable_mime_type(mime_type: typing.Optional[str]) -> bool:
+    return mime_type is not None and mime_type not in UNRELIABLE_MIME_TYPES
+
+
+def get_kind_from_mime_type(mime_type: typing.Optional[str]) -> str:
+    if mime_type is None or not is_reliable_mime_type(mime_type):
+        return InputKind.UNKNOWN
+
+    if mime_type == 'application/pdf':
+        return InputKind.PDF
+    elif mime_type.startswith('image/'):
+        return InputKind.IMAGE
+    elif mime_type.startswith(('audio/', 'video/')):
+        return InputKind.MEDIA
+
+    return InputKind.UNKNOWN
+
+
+def sniff(header: bytes, mime_type: typing.Optional[str] = None) -> str:
+    input_kind = sniff_header(header)
+
+    if input_kind == InputKind.UNKNOWN:
+        input_kind = get_kind_from_mime_type(mime_type)
+
+    return input_kind
+
+
+def is_convertible_document(mime_type: typing.Optional[str], file_name: typing.Optional[str]) -> bool:
+    if get_kind_from_mime_type(mime_type) != InputKind.UNKNOWN:
+        return True
+
+    if file_name is None:
+        return False
+
+    extension = os.path.splitext(file_name)[1][1:].lower()
+
+    return extension in CONVERTIBLE_FILE_EXTENSIONS
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import io
+import os
+import types
+import typing
+
+import requests
+import telegram
+import telegram.utils.helpers
+
+import constants
+import metrics
+
+
+class StagedInput:
+    def __init__(self, remote_url: str, local_path: typing.Optional[str] = None) -> None:
+        self.remote_url = remote_url
+        self.local_path = local_path
+        self.fd: typing.Optional[int] = None
+        self.file: typing.BinaryIO
+
+        if local_path is not None:
+            # A local Bot API server already has the file on the disk, so it is read in place.
+            self.file = open(local_path, 'rb')
+        elif hasattr(os, 'memfd_create'):
+            # An anonymous memory file can be opened by path from child processes (ffmpeg, ffprobe, pdftoppm), and it
+            # is never written to the disk.
+            self.fd = os.memfd_create('input')
+            self.file = os.fdopen(self.fd, 'w+b')
+        else:
+            self.file = io.BytesIO()
+
+    @classmethod
+    def download(cls, input_file: telegram.File) -> StagedInput:
+        if telegram.utils.helpers.is_local_file(input_file.file_path):
+            with metrics.measure_stage('open'):
+                staged_input = cls(input_file.file_path, local_path=input_file.file_path)
+
+            metrics.count_input_bytes(staged_input.size)
+
+            return staged_input
+
+        staged_input = cls(input_file.file_path)
+
+        try:
+            with metrics.measure_stage('download'):
+                input_file.download(out=staged_input.file)
+                staged_input.file.flush()
+        except Exception:
+            staged_input.close()
+
+            raise
+
+        metrics.count_input_bytes(staged_input.size)
+
+        return staged_input
+
+    @property
+    def path(self) -> typing.Optional[str]:
+        if self.local_path is not None:
+            return self.local_path
+
+        if self.fd is None:
+            return None
+
+        return f'/proc/{os.getpid()}/fd/{self.fd}'
+
+    @property
+    def url(self) -> str:
+        return self.path or self.remote_url
+
+    @property
+    def image_source(self) -> typing.Union[str, typing.BinaryIO]:
+        # PIL memory maps the uncompressed images that it opens by path.
+        return self.local_path or self.open()
+
+    @property
+    def size(self) -> int:
+        return self.file.seek(0, io.SEEK_END)
+
+    def read_header(self, size: int) -> bytes:
+        self.file.seek(0)
+
+        return self.file.read(size)
+
+    def open(self) -> typing.BinaryIO:
+        self.file.seek(0)
+
+        return self.file
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> StagedInput:
+        return self
+
+    def __exit__(self, exception_type: typing.Optional[typing.Type[BaseException]], exception: typing.Optional[BaseException], traceback: typing.Optional[types.TracebackType]) -> None:
+        self.close()
+
+
+def download_header(input_file: telegram.File, size: int) -> bytes:
+    if telegram.utils.helpers.is_local_file(input_file.file_path):
+        with open(input_file.file_path, 'rb') as file:
+            return file.read(size)
+
+    # Only the start of the file is requested, and the rest of the response isn't read if the range is ignored.
+    with metrics.measure_stage('sniff'):
+        with requests.get(input_file.file_path, headers={'Range': f'bytes=0-{size - 1}'}, stream=True, timeout=constants.SNIFF_REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+
+            return response.raw.read(size)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import os
+import subprocess
+import threading
+import time
+import typing
+
+import ffmpeg
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+EMPTY_CHUNK = bytes(CHUNK_SIZE)
+
+
+class OutputSizeLimitExceededError(Exception):
+    def __init__(self, size: int, limit: int) -> None:
+        super().__init__(f'Output size {size} exceeds the limit of {limit}')
+
+        self.size = size
+        self.limit = limit
+
+
+class ConversionCancelledError(Exception):
+    def __init__(self, reason: str) -> None:
+        super().__init__(f'Conversion cancelled because of {reason}')
+
+        self.reason = reason
+
+
+class SideOutput:
+    # The extra outputs of an ffmpeg run are read by their own threads, as ffmpeg stops when any of its pipes is full.
+    def __init__(self, read_fd: int, size_limit: int) -> None:
+        self.file = os.fdopen(read_fd, 'rb', buffering=0)
+        self.size_limit = size_limit
+        self.output = bytearray()
+        self.is_over_limit = False
+
+        self.thread = threading.Thread(target=self.read, name='side-output-reader', daemon=True)
+
+        self.thread.start()
+
+    def read(self) -> None:
+        with self.file:
+            while True:
+                chunk = self.file.read(CHUNK_SIZE)
+
+                if not chunk:
+                    break
+
+                # The rest of an output that is too big is still read, so that it doesn't block the other outputs.
+                if self.is_over_limit:
+                    continue
+
+                self.output.extend(chunk)
+
+                if len(self.output) > self.size_limit:
+                    self.is_over_limit = True
+                    self.output = bytearray()
+
+    def get_output(self, timeout: float) -> typing.Optional[bytes]:
+        self.thread.join(timeout)
+
+        if self.thread.is_alive() or self.is_over_limit or not self.output:
+            return None
+
+        return bytes(self.output)
+
+
+class ConversionStream(io.RawIOBase):
+    def __init__(self, process: subprocess.Popen, size_limit: typing.Optional[int] = None, name: typing.Optional[str] = None, on_close: typing.Optional[typing.Callable[[], None]] = None, time_limit: typing.Optional[float] = None, user_id: typing.Optional[int] = None, side_outputs: typing.Optional[typing.Dict[str, SideOutput]] = None) -> None:
+        super().__init__()
+
+        self.process = process
+        self.size_limit = size_limit
+        self.size = 0
+        self.is_failed = False
+        self.on_close = on_close
+        self.user_id = user_id
+
+        self.side_outputs = side_outputs or {}
+        self.variants: typing.Dict[str, bytes] = {}
+
+        self.deadline = time.monotonic() + time_limit if time_limit is not None else None
+        self.cancel_reason: typing.Optional[str] = None
+
+        # `telegram.InputFile` uses the `name` attribute as the file name, if it is present.
+        if name is not None:
+            self.name = name
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: typing.Any) -> int:
+        stdout = typing.cast(typing.Optional[io.BufferedReader], self.process.stdout)
+
+        if stdout is None:
+            return 0
+
+        read_count = stdout.readinto(buffer)
+
+        if not read_count:
+            self.finish()
+
+            return 0
+
+        self.size += read_count
+
+        if self.size_limit is not None and self.size > self.size_limit:
+            self.cancel(constants.CancelReason.SIZE)
+
+            raise OutputSizeLimitExceededError(self.size, self.size_limit)
+
+        return read_count
+
+    def readall(self) -> bytes:
+        # Only the bots without `uploading.StreamingRequest` read the whole output, into a single growing buffer that is
+        # returned without copying it again.
+        output = bytearray()
+
+        while True:
+            size = len(output)
+
+            output.extend(EMPTY_CHUNK)
+
+            with memoryview(output) as view:
+                read_count = self.readinto(view[size:])
+
+            del output[size + read_count:]
+
+            if not read_count:
+                break
+
+        # The uploads only write the content out, which works the same with the mutable buffer.
+        return typing.cast(bytes, output)
+
+    def finish(self) -> None:
+        return_code = self.process.wait()
+
+        if self.cancel_reason is not None:
+            raise ConversionCancelledError(self.cancel_reason)
+
+        if return_code != 0:
+            self.is_failed = True
+
+            raise ffmpeg.Error('ffmpeg', None, None)
+
+    def cancel(self, reason: str) -> None:
+        # The first reason is kept, as the later ones are caused by the kill itself.
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+
+        self.kill()
+
+    def kill(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        self.kill()
+
+        if self.process.stdout is not None:
+            self.process.stdout.close()
+
+        # The extra outputs are only complete when ffmpeg finished on its own.
+        if self.process.returncode == 0:
+            for (variant_type, side_output) in self.side_outputs.items():
+                output = side_output.get_output(constants.SIDE_OUTPUT_TIMEOUT)
+
+                if output is not None:
+                    self.variants[variant_type] = output
+
+        super().close()
+
+        if self.on_close is not None:
+            self.on_close()
+
+
+class Watchdog:
+    def __init__(self, time_limits: typing.Dict[str, int], default_time_limit: int, check_interval: float) -> None:
+        self.time_limits = dict(time_limits)
+        self.default_time_limit = default_time_limit
+        self.check_interval = check_interval
+
+        self.lock = threading.Lock()
+        self.streams: typing.Set[ConversionStream] = set()
+        self.thread: typing.Optional[threading.Thread] = None
+        self.stop_reason: typing.Optional[str] = None
+
+    def get_time_limit(self, output_type: str) -> int:
+        return self.time_limits.get(output_type, self.default_time_limit)
+
+    def set_time_limit(self, output_type: str, time_limit: int) -> None:
+        self.time_limits[output_type] = time_limit
+
+    def watch(self, stream: ConversionStream) -> None:
+        with self.lock:
+            self.streams.add(stream)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='conversion-watchdog', daemon=True)
+
+                self.thread.start()
+
+            stop_reason = self.stop_reason
+
+        # The conversions that were still waiting for a slot when stopping are cancelled as soon as they start.
+        if stop_reason is not None:
+            stream.cancel(stop_reason)
+
+    def unwatch(self, stream: ConversionStream) -> None:
+        with self.lock:
+            self.streams.discard(stream)
+
+    def cancel(self, reason: str, user_id: typing.Optional[int] = None) -> int:
+        with self.lock:
+            streams = [stream for stream in self.streams if user_id is None or stream.user_id == user_id]
+
+        for stream in streams:
+            stream.cancel(reason)
+
+        return len(streams)
+
+    def stop(self, reason: str) -> None:
+        with self.lock:
+            self.stop_reason = reason
+
+        self.cancel(reason)
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.check_interval)
+
+            current_time = time.monotonic()
+
+            with self.lock:
+                expired_streams = [stream for stream in self.streams if stream.deadline is not None and stream.deadline < current_time]
+
+            for stream in expired_streams:
+                logger.warning(f'Killing ffmpeg process {stream.process.pid} after it ran out of time')
+
+                stream.cancel(constants.CancelReason.TIMEOUT)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import logging
+import mimetypes
+import typing
+import uuid
+
+import telegram
+import telegram.utils.request
+import telegram.utils.types
+import telegram.vendor.ptb_urllib3.urllib3 as urllib3
+import telegram.vendor.ptb_urllib3.urllib3.fields as urllib3_fields
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MIME_TYPE = 'application/octet-stream'
+
+# `telegram.ext.Updater` adds the same number of connections for its own threads to the ones of the workers.
+EXTRA_CONNECTIONS_COUNT = 4
+
+
+class StreamedInputFile(telegram.InputFile):
+    # Unlike `telegram.InputFile`, the content is only read while it is uploaded, one chunk at a time.
+    __slots__ = ('stream',)
+
+    def __init__(self, stream: io.RawIOBase, filename: typing.Optional[str] = None) -> None:
+        self.stream = stream
+        self.attach = None
+
+        self.mimetype = DEFAULT_MIME_TYPE
+
+        if filename is not None:
+            self.mimetype = mimetypes.guess_type(filename)[0] or DEFAULT_MIME_TYPE
+
+        # Like `telegram.InputFile`, the file name is made from the mime type when the stream has no name.
+        self.filename = filename or self.mimetype.replace('/', '.')
+
+    def iter_chunks(self) -> typing.Iterator[bytes]:
+        while True:
+            chunk = self.stream.read(CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            yield chunk
+
+
+class StreamingRequest(telegram.utils.request.Request):
+    def post(self, url: str, data: telegram.utils.types.JSONDict, timeout: typing.Optional[float] = None) -> typing.Union[telegram.utils.types.JSONDict, bool]:
+        if data is None or not any(isinstance(value, StreamedInputFile) for value in data.values()):
+            return super().post(url, data, timeout=typing.cast(float, timeout))
+
+        urlopen_kwargs: typing.Dict[str, typing.Any] = {}
+
+        if timeout is not None:
+            urlopen_kwargs['timeout'] = urllib3.Timeout(read=timeout, connect=self._connect_timeout)
+
+        fields = []
+
+        for (key, value) in data.items():
+            if isinstance(value, StreamedInputFile):
+                field = urllib3_fields.RequestField(key, value, filename=value.filename)
+
+                field.make_multipart(content_type=value.mimetype)
+            else:
+                if isinstance(value, telegram.InputFile):
+                    value = value.field_tuple
+                elif isinstance(value, (float, int)):
+                    value = str(value)
+                elif isinstance(value, list):
+                    value = json.dumps(value)
+
+                field = urllib3_fields.RequestField.from_tuples(key, value)
+
+            fields.append(field)
+
+        boundary = uuid.uuid4().hex
+
+        def iter_body() -> typing.Iterator[bytes]:
+            for field in fields:
+                yield f'--{boundary}\r\n'.encode('utf-8')
+                yield field.render_headers().encode('utf-8')
+
+                if isinstance(field.data, StreamedInputFile):
+                    yield from field.data.iter_chunks()
+                elif isinstance(field.data, str):
+                    yield field.data.encode('utf-8')
+                else:
+                    yield field.data
+
+                yield b'\r\n'
+
+            yield f'--{boundary}--\r\n'.encode('utf-8')
+
+        # The size of the output is only known once ffmpeg exits, so the body is sent in chunks, and it can't be sent
+        # again on a retry.
+        result = self._request_wrapper(
+            'POST',
+            url,
+            body=iter_body(),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+            chunked=True,
+            retries=False,
+            **urlopen_kwargs
+        )
+
+        return self._parse(result)
+
+
+def create_bot(token: str, base_url: str, base_file_url: str, workers_count: int) -> telegram.Bot:
+    request = StreamingRequest(con_pool_size=workers_count + EXTRA_CONNECTIONS_COUNT)
+
+    return telegram.Bot(token, base_url=base_url, base_file_url=base_file_url, request=request)
+
+
+def get_upload_file(bot: telegram.Bot, stream: io.RawIOBase) -> typing.Union[io.RawIOBase, StreamedInputFile]:
+    # Other requests read the whole stream into a `telegram.InputFile` instead.
+    if not isinstance(bot.request, StreamingRequest):
+        return stream
+
+    return StreamedInputFile(stream, getattr(stream, 'name', None))
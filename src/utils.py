@@ -3,6 +3,10 @@
 import io
 import json
 import logging
+import os
+import subprocess
+import threading
+import time
 import typing
 
 import ffmpeg
@@ -10,9 +14,40 @@ import telegram.ext
 
 import analytics
 import constants
+import encoding
+import metrics
+import probing
+import scheduling
+import streaming
+import uploading
+import variants
 
 logger = logging.getLogger(__name__)
 
+OutputFile = typing.Union[io.IOBase, typing.BinaryIO, str, uploading.StreamedInputFile]
+
+conversion_scheduler = scheduling.ConversionScheduler(constants.DEFAULT_CONVERSION_SLOTS_COUNTS, constants.DEFAULT_CONVERSION_SLOTS_COUNT)
+rate_limiter = scheduling.RateLimiter(constants.DEFAULT_USER_RATE, constants.DEFAULT_USER_BURST, constants.DEFAULT_CHAT_RATE, constants.DEFAULT_CHAT_BURST, constants.MAX_RATE_LIMIT_BUCKETS_COUNT)
+prober = probing.Prober(constants.DEFAULT_PROBE_SIZE, constants.DEFAULT_PROBE_ANALYZE_DURATION, constants.DEFAULT_PROBE_CACHE_TTL, constants.DEFAULT_PROBE_CACHE_SIZE)
+encoding_profiles = encoding.EncodingProfiles(constants.ENCODING_PROFILES, constants.DEFAULT_ENCODING_PROFILE)
+single_flight = scheduling.SingleFlight(constants.SHARED_OUTPUT_TIMEOUT)
+watchdog = streaming.Watchdog(constants.DEFAULT_CONVERSION_TIME_LIMITS, constants.DEFAULT_CONVERSION_TIME_LIMIT, constants.WATCHDOG_INTERVAL)
+variant_cache = variants.VariantCache(False, constants.DEFAULT_VARIANT_CACHE_DURATION, constants.DEFAULT_VARIANT_CACHE_SIZE)
+
+# A local Bot API server raises both limits.
+download_size_limit = int(telegram.constants.MAX_FILESIZE_DOWNLOAD)
+upload_size_limit = int(telegram.constants.MAX_FILESIZE_UPLOAD)
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def increment(self, amount: int = 1) -> None:
+        with self.lock:
+            self.value += amount
+
 
 def check_admin(bot: telegram.Bot, context: telegram.ext.CallbackContext, message: telegram.Message, analytics_handler: analytics.AnalyticsHandler, admin_user_id: int) -> bool:
     user = message.from_user
@@ -30,6 +65,14 @@ def check_admin(bot: telegram.Bot, context: telegram.ext.CallbackContext, messag
     return True
 
 
+def answer_callback_query(callback_query: telegram.CallbackQuery) -> None:
+    # A deferred button press was already answered, and Telegram refuses to answer it twice.
+    try:
+        callback_query.answer()
+    except telegram.error.BadRequest as error:
+        logger.info(f'Callback query error: {error}')
+
+
 def ensure_size_under_limit(size: int, limit: int, update: telegram.Update, context: telegram.ext.CallbackContext, file_reference_text='File') -> bool:
     if size <= limit:
         return True
@@ -63,7 +106,27 @@ def ensure_size_under_limit(size: int, limit: int, update: telegram.Update, cont
     return False
 
 
-def ensure_valid_converted_file(file_bytes: typing.Optional[bytes], update: telegram.Update, context: telegram.ext.CallbackContext) -> bool:
+def send_cancelled_message(reason: str, output_type: str, update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
+    chat = update.effective_chat
+    message = update.effective_message
+
+    if chat is None or message is None or chat.type != telegram.Chat.PRIVATE:
+        return
+
+    if reason == constants.CancelReason.TIMEOUT:
+        time_limit = watchdog.get_time_limit(output_type)
+        text = f'Conversion took longer than {time_limit // 60} minutes, so it was stopped.'
+    else:
+        text = 'Conversion was cancelled.'
+
+    context.bot.send_message(
+        chat_id=chat.id,
+        text=text,
+        reply_to_message_id=message.message_id
+    )
+
+
+def ensure_valid_converted_file(file_bytes: typing.Optional[typing.Union[bytes, OutputFile]], update: telegram.Update, context: telegram.ext.CallbackContext) -> bool:
     if file_bytes is not None:
         return True
 
@@ -92,14 +155,14 @@ def ensure_valid_converted_file(file_bytes: typing.Optional[bytes], update: tele
     return False
 
 
-def send_video(bot: telegram.Bot, chat_id: int, message_id: int, output_bytes: io.BytesIO, caption: typing.Optional[str], chat_type: str) -> None:
+def send_video(bot: telegram.Bot, chat_id: int, message_id: int, output_bytes: OutputFile, caption: typing.Optional[str], chat_type: str) -> telegram.Message:
     reply_markup: typing.Optional[telegram.ReplyMarkup] = None
 
     if chat_type == telegram.Chat.PRIVATE:
         button = telegram.InlineKeyboardButton('Rounded', callback_data=json.dumps({}))
         reply_markup = telegram.InlineKeyboardMarkup([[button]])
 
-    bot.send_video(
+    return bot.send_video(
         chat_id,
         output_bytes,
         caption=caption,
@@ -109,101 +172,469 @@ def send_video(bot: telegram.Bot, chat_id: int, message_id: int, output_bytes: i
     )
 
 
-def send_video_note(bot: telegram.Bot, chat_id: int, message_id: int, output_bytes: io.BytesIO) -> None:
-    bot.send_video_note(
+def send_video_note(bot: telegram.Bot, chat_id: int, message_id: int, output_bytes: OutputFile, thumbnail: typing.Optional[bytes] = None) -> telegram.Message:
+    return bot.send_video_note(
         chat_id,
         output_bytes,
+        thumb=thumbnail,
         reply_to_message_id=message_id
     )
 
 
-def get_file_size(video_url: str) -> int:
-    info = ffmpeg.probe(video_url, show_entries='format=size')
-    size = info.get('format', {}).get('size')
+def send_video_note_variant(bot: telegram.Bot, chat_id: int, message_id: int, output_variants: variants.Variants) -> telegram.Message:
+    output_bytes = output_variants[constants.VariantType.VIDEO_NOTE]
+
+    with metrics.measure_stage('upload'):
+        sent_message = send_video_note(bot, chat_id, message_id, io.BytesIO(output_bytes), output_variants.get(constants.VariantType.THUMBNAIL))
+
+    metrics.output_bytes.inc(constants.OutputType.VIDEO_NOTE, amount=len(output_bytes))
+    metrics.served_variants.inc(constants.OutputType.VIDEO_NOTE)
+
+    return sent_message
+
+
+def send_output(bot: telegram.Bot, output_type: str, chat_id: int, message_id: int, output_file: OutputFile, caption: typing.Optional[str], chat_type: str) -> typing.Optional[telegram.Message]:
+    if output_type == constants.OutputType.AUDIO:
+        return bot.send_voice(
+            chat_id,
+            output_file,
+            caption=caption,
+            reply_to_message_id=message_id
+        )
+    elif output_type == constants.OutputType.VIDEO:
+        return send_video(bot, chat_id, message_id, output_file, caption, chat_type)
+    elif output_type == constants.OutputType.VIDEO_NOTE:
+        return send_video_note(bot, chat_id, message_id, output_file)
+    elif output_type == constants.OutputType.PHOTO:
+        return bot.send_photo(
+            chat_id,
+            output_file,
+            caption=caption,
+            reply_to_message_id=message_id
+        )
+    elif output_type == constants.OutputType.STICKER:
+        return bot.send_sticker(
+            chat_id,
+            output_file,
+            reply_to_message_id=message_id
+        )
+    elif output_type == constants.OutputType.FILE:
+        return bot.send_document(
+            chat_id,
+            output_file,
+            reply_to_message_id=message_id
+        )
+
+    return None
+
+
+def send_album(bot: telegram.Bot, chat_id: int, message_id: int, output_files: typing.Sequence[typing.Union[io.BytesIO, str]], caption: typing.Optional[str]) -> typing.List[telegram.Message]:
+    # The caption of the first item is shown as the caption of the whole album.
+    media = [telegram.InputMediaPhoto(output_file) for output_file in output_files]
+
+    if caption is not None:
+        media[0].caption = caption
+
+    with metrics.measure_stage('upload'):
+        sent_messages = bot.send_media_group(chat_id, media, reply_to_message_id=message_id)
+
+    for output_file in output_files:
+        if isinstance(output_file, io.BytesIO):
+            metrics.output_bytes.inc(constants.OutputType.ALBUM, amount=output_file.getbuffer().nbytes)
+
+    return sent_messages
+
+
+def get_message_file_id(message: typing.Optional[telegram.Message]) -> typing.Optional[str]:
+    if message is None:
+        return None
+
+    attachment: typing.Any = message.effective_attachment
 
-    return int(size)
+    if isinstance(attachment, list):
+        if not attachment:
+            return None
 
+        # The last photo size is the biggest one.
+        attachment = attachment[-1]
 
-def has_audio_stream(video_url: typing.Optional[str]) -> bool:
-    if not video_url:
+    if isinstance(attachment, (
+        telegram.Audio,
+        telegram.Document,
+        telegram.PhotoSize,
+        telegram.Sticker,
+        telegram.Video,
+        telegram.VideoNote,
+        telegram.Voice
+    )):
+        return attachment.file_id
+
+    return None
+
+
+def get_file_size(probe_result: typing.Optional[probing.ProbeResult]) -> typing.Optional[int]:
+    if probe_result is None:
+        return None
+
+    return probe_result.get_size()
+
+
+def has_audio_stream(probe_result: typing.Optional[probing.ProbeResult]) -> bool:
+    if probe_result is None:
         return False
 
-    info = ffmpeg.probe(video_url, select_streams='a', show_entries='format=:streams=index')
-    streams = info.get('streams', [])
+    return probe_result.has_audio_stream()
 
-    return len(streams) > 0
 
+def get_input_codec_name(probe_result: typing.Optional[probing.ProbeResult]) -> str:
+    if probe_result is None:
+        return 'unknown'
 
-def convert(output_type: str, input_video_url: typing.Optional[str] = None, input_audio_url: typing.Optional[str] = None) -> typing.Optional[bytes]:
-    try:
-        if output_type == constants.OutputType.AUDIO:
-            return (
-                ffmpeg
-                    .input(input_audio_url)
-                    .output('pipe:', format='opus', strict='-2')
-                    .run(capture_stdout=True)
-            )[0]
-        elif output_type == constants.OutputType.VIDEO:
-            if input_audio_url is None:
-                return (
-                    ffmpeg
-                        .input(input_video_url)
-                        .output('pipe:', format='mp4', movflags='frag_keyframe+empty_moov', strict='-2')
-                        .run(capture_stdout=True)
-                )[0]
-            else:
-                input_video = ffmpeg.input(input_video_url)
-                input_audio = ffmpeg.input(input_audio_url)
-
-                return (
-                    ffmpeg
-                        .output(input_video, input_audio, 'pipe:', format='mp4', movflags='frag_keyframe+empty_moov', strict='-2')
-                        .run(capture_stdout=True)
-                )[0]
-        elif output_type == constants.OutputType.VIDEO_NOTE:
-            # Copied from https://github.com/kkroening/ffmpeg-python/issues/184#issuecomment-504390452.
-
-            ffmpeg_input = (
-                ffmpeg
-                    .input(input_video_url, t=constants.MAX_VIDEO_NOTE_LENGTH)
+    for codec_type in ['video', 'audio']:
+        for stream in probe_result.get_streams(codec_type):
+            codec_name = stream.get('codec_name')
+
+            if codec_name is not None:
+                return codec_name
+
+    return 'unknown'
+
+
+def is_copyable_video_stream(stream: typing.Dict[str, typing.Any]) -> bool:
+    return (
+        stream.get('codec_name') in constants.COPYABLE_VIDEO_CODEC_NAMES and
+        stream.get('pix_fmt') in constants.COPYABLE_VIDEO_PIXEL_FORMATS
+    )
+
+
+def get_conversion_path(output_type: str, probe_result: typing.Optional[probing.ProbeResult], has_separate_audio: bool = False) -> str:
+    if probe_result is None:
+        return constants.ConversionPath.ENCODE
+
+    audio_streams = probe_result.get_streams('audio')
+    copyable_audio_codec_names = constants.COPYABLE_AUDIO_CODEC_NAMES.get(output_type, [])
+    is_audio_copyable = all(stream.get('codec_name') in copyable_audio_codec_names for stream in audio_streams)
+
+    if output_type == constants.OutputType.VIDEO:
+        video_streams = probe_result.get_streams('video')
+
+        if not video_streams or not all(is_copyable_video_stream(stream) for stream in video_streams):
+            return constants.ConversionPath.ENCODE
+
+        if has_separate_audio or not is_audio_copyable:
+            return constants.ConversionPath.VIDEO_STREAM_COPY
+
+        return constants.ConversionPath.STREAM_COPY
+    elif output_type in [constants.OutputType.AUDIO, constants.OutputType.FILE]:
+        if audio_streams and is_audio_copyable:
+            return constants.ConversionPath.STREAM_COPY
+
+    return constants.ConversionPath.ENCODE
+
+
+def get_copied_output_size(output_type: str, conversion_path: str, profile_name: str, probe_result: typing.Optional[probing.ProbeResult]) -> typing.Optional[int]:
+    input_size = get_file_size(probe_result)
+
+    if probe_result is None or input_size is None or conversion_path != constants.ConversionPath.VIDEO_STREAM_COPY:
+        return input_size
+
+    duration = get_output_duration(output_type, probe_result)
+
+    if duration is None:
+        return input_size
+
+    # Only the copied video streams are kept, so their own bitrates are used when the input has them.
+    video_streams = probe_result.get_streams('video')
+    video_size = input_size
+
+    if video_streams and all('bit_rate' in stream for stream in video_streams):
+        video_size = int(sum(int(stream['bit_rate']) for stream in video_streams) * duration / 8)
+
+    # The audio is encoded, either from a separate input or instead of the input audio.
+    audio_bitrate = encoding.parse_bitrate(encoding_profiles.get_arguments(profile_name, output_type, conversion_path).get('audio_bitrate')) or constants.DEFAULT_AUDIO_BITRATES[output_type]
+
+    return video_size + int(audio_bitrate * duration / 8)
+
+
+def get_codec_arguments(output_type: str, conversion_path: str) -> typing.Dict[str, typing.Any]:
+    # Subtitle and data streams are dropped, since they can't always be copied into the output container.
+    if conversion_path == constants.ConversionPath.STREAM_COPY:
+        if output_type in [constants.OutputType.AUDIO, constants.OutputType.FILE]:
+            return {'acodec': 'copy', 'vn': None, 'sn': None, 'dn': None}
+
+        return {'c': 'copy', 'sn': None, 'dn': None}
+    elif conversion_path == constants.ConversionPath.VIDEO_STREAM_COPY:
+        return {'vcodec': 'copy', 'sn': None, 'dn': None}
+
+    return {}
+
+
+def get_output_duration(output_type: str, probe_result: typing.Optional[probing.ProbeResult]) -> typing.Optional[float]:
+    duration = probe_result.get_duration() if probe_result is not None else None
+
+    if duration is not None and output_type == constants.OutputType.VIDEO_NOTE:
+        return min(duration, constants.MAX_VIDEO_NOTE_LENGTH)
+
+    return duration
+
+
+def crop_video_note(ffmpeg_video: ffmpeg.nodes.FilterableStream) -> ffmpeg.nodes.FilterableStream:
+    return (
+        ffmpeg_video
+            .crop(
+                constants.VIDEO_NOTE_CROP_OFFSET_PARAMS,
+                constants.VIDEO_NOTE_CROP_OFFSET_PARAMS,
+                constants.VIDEO_NOTE_CROP_SIZE_PARAMS,
+                constants.VIDEO_NOTE_CROP_SIZE_PARAMS
             )
-            ffmpeg_input_video = (
-                ffmpeg_input
-                    .video
-                    .crop(
-                        constants.VIDEO_NOTE_CROP_OFFSET_PARAMS,
-                        constants.VIDEO_NOTE_CROP_OFFSET_PARAMS,
-                        constants.VIDEO_NOTE_CROP_SIZE_PARAMS,
-                        constants.VIDEO_NOTE_CROP_SIZE_PARAMS
-                    )
-                    .filter(
-                        'scale',
-                        constants.VIDEO_NOTE_SCALE_SIZE_PARAMS,
-                        constants.VIDEO_NOTE_SCALE_SIZE_PARAMS
-                    )
+            .filter(
+                'scale',
+                constants.VIDEO_NOTE_SCALE_SIZE_PARAMS,
+                constants.VIDEO_NOTE_SCALE_SIZE_PARAMS
             )
+    )
+
+
+def get_ffmpeg_variant_outputs(ffmpeg_video: ffmpeg.nodes.FilterableStream, ffmpeg_audio: typing.Optional[ffmpeg.nodes.FilterableStream], profile_name: str, probe_result: typing.Optional[probing.ProbeResult], variant_fds: typing.Dict[str, int]) -> typing.List[ffmpeg.nodes.OutputStream]:
+    video_note_arguments = encoding_profiles.get_arguments(profile_name, constants.OutputType.VIDEO_NOTE, constants.ConversionPath.ENCODE)
+    duration = get_output_duration(constants.OutputType.VIDEO_NOTE, probe_result)
+
+    if duration is not None:
+        try:
+            video_note_arguments.update(encoding.get_size_capped_arguments(constants.OutputType.VIDEO_NOTE, constants.ConversionPath.ENCODE, video_note_arguments, duration, upload_size_limit, ffmpeg_audio is not None))
+        except streaming.OutputSizeLimitExceededError as error:
+            logger.info(f'Skipped the video note variant: {error}')
+
+            variant_fds = {variant_type: fd for (variant_type, fd) in variant_fds.items() if variant_type != constants.VariantType.VIDEO_NOTE}
+
+    # The video is decoded once, and each variant gets its own copy of the decoded frames.
+    split_video = ffmpeg_video.split()
+    variant_outputs = []
 
-            ffmpeg_output: ffmpeg.nodes.OutputStream
+    for (index, (variant_type, fd)) in enumerate(variant_fds.items()):
+        if variant_type == constants.VariantType.VIDEO_NOTE:
+            video_note_video = crop_video_note(split_video[index])
 
-            if has_audio_stream(input_video_url):
-                ffmpeg_input_audio = ffmpeg_input.audio
-                ffmpeg_joined = ffmpeg.concat(ffmpeg_input_video, ffmpeg_input_audio, v=1, a=1).node
-                ffmpeg_output = ffmpeg.output(ffmpeg_joined[0], ffmpeg_joined[1], 'pipe:', format='mp4', movflags='frag_keyframe+empty_moov', strict='-2')
+            if ffmpeg_audio is not None:
+                ffmpeg_joined = ffmpeg.concat(video_note_video, ffmpeg_audio, v=1, a=1).node
+                video_note_streams = [ffmpeg_joined[0], ffmpeg_joined[1]]
             else:
-                ffmpeg_joined = ffmpeg.concat(ffmpeg_input_video, v=1).node
-                ffmpeg_output = ffmpeg.output(ffmpeg_joined[0], 'pipe:', format='mp4', movflags='frag_keyframe+empty_moov', strict='-2')
+                video_note_streams = [ffmpeg.concat(video_note_video, v=1).node[0]]
+
+            variant_outputs.append(ffmpeg.output(*video_note_streams, f'pipe:{fd}', t=constants.MAX_VIDEO_NOTE_LENGTH, format='mp4', movflags='frag_keyframe+empty_moov', strict='-2', **video_note_arguments))
+        elif variant_type == constants.VariantType.THUMBNAIL:
+            thumbnail_video = split_video[index].filter('scale', constants.THUMBNAIL_SIZE, constants.THUMBNAIL_SIZE, force_original_aspect_ratio='decrease')
+
+            variant_outputs.append(ffmpeg.output(thumbnail_video, f'pipe:{fd}', format='image2pipe', vcodec='mjpeg', vframes=1, **{'q:v': constants.THUMBNAIL_QUALITY}))
+
+    return variant_outputs
+
+
+def get_ffmpeg_output(output_type: str, profile_name: str, input_video_url: typing.Optional[str] = None, input_audio_url: typing.Optional[str] = None, probe_result: typing.Optional[probing.ProbeResult] = None, size_limit: typing.Optional[int] = None, variant_fds: typing.Optional[typing.Dict[str, int]] = None) -> typing.Optional[ffmpeg.nodes.OutputStream]:
+    if output_type == constants.OutputType.VIDEO:
+        conversion_path = get_conversion_path(output_type, probe_result, has_separate_audio=input_audio_url is not None)
+    else:
+        conversion_path = get_conversion_path(output_type, probe_result)
+
+    if size_limit is not None and conversion_path != constants.ConversionPath.ENCODE:
+        copied_output_size = get_copied_output_size(output_type, conversion_path, profile_name, probe_result)
+
+        # The same margin is left for the muxing overhead as for the encoded outputs.
+        if copied_output_size is not None and copied_output_size > size_limit * constants.OUTPUT_SIZE_BUDGET_RATIO:
+            logger.info(f'Copied output size {copied_output_size} would not fit under the limit of {size_limit}, so it is encoded instead')
+
+            conversion_path = constants.ConversionPath.ENCODE
+
+    logger.info(f'Converting to {output_type} using {conversion_path} with the {profile_name} profile')
+
+    codec_arguments = get_codec_arguments(output_type, conversion_path)
 
-            return ffmpeg_output.run(capture_stdout=True)[0]
-        elif output_type == constants.OutputType.FILE:
-            return (
+    codec_arguments.update(encoding_profiles.get_arguments(profile_name, output_type, conversion_path))
+
+    duration = get_output_duration(output_type, probe_result)
+
+    if size_limit is not None and duration is not None:
+        has_audio = output_type in [constants.OutputType.AUDIO, constants.OutputType.FILE] or input_audio_url is not None or has_audio_stream(probe_result)
+
+        # The bitrate is capped up front, so that most outputs fit instead of being rejected after they were encoded.
+        # A single pass can still overshoot the cap, so the streamed output is also checked while it is uploaded.
+        codec_arguments.update(encoding.get_size_capped_arguments(output_type, conversion_path, codec_arguments, duration, size_limit, has_audio))
+
+    if output_type == constants.OutputType.AUDIO:
+        return (
+            ffmpeg
+                .input(input_audio_url)
+                .output('pipe:', format='opus', strict='-2', **codec_arguments)
+        )
+    elif output_type == constants.OutputType.VIDEO:
+        input_video = ffmpeg.input(input_video_url)
+
+        if input_audio_url is None:
+            ffmpeg_output = (
+                input_video
+                    .output('pipe:', format='mp4', movflags='frag_keyframe+empty_moov', strict='-2', **codec_arguments)
+            )
+            ffmpeg_audio = input_video.audio if has_audio_stream(probe_result) else None
+        else:
+            input_audio = ffmpeg.input(input_audio_url)
+
+            ffmpeg_output = (
                 ffmpeg
-                    .input(input_audio_url)
-                    .output('pipe:', format='mp3', strict='-2')
-                    .run(capture_stdout=True)
-            )[0]
+                    .output(input_video, input_audio, 'pipe:', format='mp4', movflags='frag_keyframe+empty_moov', strict='-2', **codec_arguments)
+            )
+            ffmpeg_audio = input_audio.audio
+
+        if not variant_fds:
+            return ffmpeg_output
+
+        # The variants are written to their own pipes by the same ffmpeg run, so the input is only read once.
+        return ffmpeg.merge_outputs(ffmpeg_output, *get_ffmpeg_variant_outputs(input_video.video, ffmpeg_audio, profile_name, probe_result, variant_fds))
+    elif output_type == constants.OutputType.VIDEO_NOTE:
+        # Copied from https://github.com/kkroening/ffmpeg-python/issues/184#issuecomment-504390452.
+
+        ffmpeg_input = (
+            ffmpeg
+                .input(input_video_url, t=constants.MAX_VIDEO_NOTE_LENGTH)
+        )
+        ffmpeg_input_video = crop_video_note(ffmpeg_input.video)
+
+        if probe_result is None:
+            probe_result = prober.probe(input_video_url)
+
+        if has_audio_stream(probe_result):
+            ffmpeg_input_audio = ffmpeg_input.audio
+            ffmpeg_joined = ffmpeg.concat(ffmpeg_input_video, ffmpeg_input_audio, v=1, a=1).node
+
+            return ffmpeg.output(ffmpeg_joined[0], ffmpeg_joined[1], 'pipe:', format='mp4', movflags='frag_keyframe+empty_moov', strict='-2', **codec_arguments)
+        else:
+            ffmpeg_joined = ffmpeg.concat(ffmpeg_input_video, v=1).node
+
+            return ffmpeg.output(ffmpeg_joined[0], 'pipe:', format='mp4', movflags='frag_keyframe+empty_moov', strict='-2', **codec_arguments)
+    elif output_type == constants.OutputType.FILE:
+        return (
+            ffmpeg
+                .input(input_audio_url)
+                .output('pipe:', format='mp3', strict='-2', **codec_arguments)
+        )
+
+    return None
+
+
+def log_conversion(output_type: str, profile_name: str, duration: float, size: int, probe_result: typing.Optional[probing.ProbeResult]) -> None:
+    metrics.conversion_duration.observe(output_type, profile_name, value=duration)
+
+    speed_text = ''
+    media_duration = get_output_duration(output_type, probe_result)
+
+    if media_duration is not None and duration > 0:
+        speed_text = f' ({media_duration / duration:.1f}x realtime)'
+
+    logger.info(f'Converted to {output_type} with the {profile_name} profile in {duration:.2f}s{speed_text}, {get_size_string_from_bytes(size)}')
+
+
+def convert_stream(output_type: str, size_limit: int, input_video_url: typing.Optional[str] = None, input_audio_url: typing.Optional[str] = None, probe_result: typing.Optional[probing.ProbeResult] = None, name: typing.Optional[str] = None, user_id: typing.Optional[int] = None) -> typing.Optional[streaming.ConversionStream]:
+    profile_name = encoding_profiles.get_current_name()
+
+    side_pipes = {variant_type: os.pipe() for variant_type in variant_cache.get_variant_types(output_type)}
+    side_outputs: typing.Dict[str, streaming.SideOutput] = {}
+
+    try:
+        ffmpeg_output = get_ffmpeg_output(output_type, profile_name, input_video_url, input_audio_url, probe_result, size_limit, {variant_type: write_fd for (variant_type, (_read_fd, write_fd)) in side_pipes.items()})
+
+        if ffmpeg_output is not None:
+            conversion_scheduler.acquire(output_type, user_id)
+
+            try:
+                if side_pipes:
+                    # ffmpeg-python can't pass more pipes to ffmpeg, so it is only used for the arguments.
+                    process = subprocess.Popen(ffmpeg_output.compile(), stdout=subprocess.PIPE, pass_fds=[write_fd for (_read_fd, write_fd) in side_pipes.values()])
+                else:
+                    process = ffmpeg_output.run_async(pipe_stdout=True)
+            except Exception:
+                conversion_scheduler.release(output_type)
+
+                raise
+
+            side_outputs = {variant_type: streaming.SideOutput(read_fd, variant_cache.get_size_limit(variant_type)) for (variant_type, (read_fd, _write_fd)) in side_pipes.items()}
+
+            start_time = time.monotonic()
+
+            def on_close() -> None:
+                watchdog.unwatch(output_stream)
+                conversion_scheduler.release(output_type)
+
+                if output_stream.cancel_reason is not None:
+                    metrics.cancelled_conversions.inc(output_type, output_stream.cancel_reason)
+                elif output_stream.is_failed:
+                    metrics.ffmpeg_failures.inc(get_input_codec_name(probe_result))
+                else:
+                    log_conversion(output_type, profile_name, time.monotonic() - start_time, output_stream.size, probe_result)
+
+            # The slot is held until the output is fully read, as ffmpeg keeps running until then.
+            output_stream = streaming.ConversionStream(process, size_limit, name, on_close=on_close, time_limit=watchdog.get_time_limit(output_type), user_id=user_id, side_outputs=side_outputs)
+
+            watchdog.watch(output_stream)
+
+            return output_stream
     except ffmpeg.Error as error:
         logger.error(f'ffmpeg error: {error}')
 
+        metrics.ffmpeg_failures.inc(get_input_codec_name(probe_result))
+    finally:
+        # Only ffmpeg keeps the write ends open, so the readers see the end of the outputs once it exits.
+        for (variant_type, (read_fd, write_fd)) in side_pipes.items():
+            os.close(write_fd)
+
+            if variant_type not in side_outputs:
+                os.close(read_fd)
+
+    return None
+
+
+def send_converted_output(bot: telegram.Bot, output_type: str, update: telegram.Update, context: telegram.ext.CallbackContext, output_file: OutputFile, caption: typing.Optional[str], chat_type: str) -> typing.Optional[telegram.Message]:
+    message = update.effective_message
+
+    if message is None:
+        return None
+
+    upload_file = output_file
+
+    # The output is uploaded while ffmpeg writes it, so only one chunk of it is in memory at a time.
+    if isinstance(output_file, streaming.ConversionStream):
+        upload_file = uploading.get_upload_file(bot, output_file)
+
+    try:
+        with metrics.measure_stage('upload'):
+            sent_message = send_output(bot, output_type, message.chat_id, message.message_id, upload_file, caption, chat_type)
+
+        if isinstance(output_file, streaming.ConversionStream):
+            metrics.output_bytes.inc(output_type, amount=output_file.size)
+
+            # The stream is closed first, as the variants made along with it are only complete after ffmpeg exits.
+            output_file.close()
+
+            if sent_message is not None and sent_message.video is not None and output_file.variants:
+                variant_cache.put(sent_message.video.file_unique_id, output_file.variants)
+        elif isinstance(output_file, io.BytesIO):
+            metrics.output_bytes.inc(output_type, amount=output_file.getbuffer().nbytes)
+
+        return sent_message
+    except streaming.OutputSizeLimitExceededError as error:
+        ensure_size_under_limit(error.size, error.limit, update, context, file_reference_text='Converted file')
+    except streaming.ConversionCancelledError as error:
+        # The jobs stopped by a restart are resumed afterwards, so they are left unfinished.
+        if error.reason == constants.CancelReason.RESTART:
+            raise
+
+        send_cancelled_message(error.reason, output_type, update, context)
+    except ffmpeg.Error as error:
+        logger.error(f'ffmpeg error: {error}')
+
+        ensure_valid_converted_file(file_bytes=None, update=update, context=context)
+    finally:
+        if isinstance(output_file, streaming.ConversionStream):
+            output_file.close()
+
     return None
 
 
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+import typing
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+Variants = typing.Dict[str, bytes]
+
+
+class VariantCache:
+    def __init__(self, is_enabled: bool, duration: float, size_limit: int) -> None:
+        self.is_enabled = is_enabled
+        self.duration = duration
+        self.size_limit = size_limit
+
+        self.lock = threading.Lock()
+        self.entries: typing.OrderedDict[str, typing.Tuple[float, Variants]] = collections.OrderedDict()
+        self.size = 0
+
+        self.local = threading.local()
+
+    def configure(self, is_enabled: bool, duration: float, size_limit: int) -> None:
+        with self.lock:
+            self.is_enabled = is_enabled
+            self.duration = duration
+            self.size_limit = size_limit
+
+            self.remove_old_entries(time.monotonic())
+
+    @contextlib.contextmanager
+    def job_context(self, are_variants_wanted: bool) -> typing.Iterator[None]:
+        self.local.are_variants_wanted = are_variants_wanted
+
+        try:
+            yield
+        finally:
+            self.local.are_variants_wanted = False
+
+    def get_variant_types(self, output_type: str) -> typing.List[str]:
+        # Only the videos sent in private chats have the "Rounded" button, which the variants are made for.
+        if not self.is_enabled or output_type != constants.OutputType.VIDEO or not getattr(self.local, 'are_variants_wanted', False):
+            return []
+
+        return [constants.VariantType.VIDEO_NOTE, constants.VariantType.THUMBNAIL]
+
+    def get_size_limit(self, variant_type: str) -> int:
+        if variant_type == constants.VariantType.THUMBNAIL:
+            return constants.MAX_THUMBNAIL_FILESIZE
+
+        return self.size_limit
+
+    def remove_entry(self, key: str) -> typing.Optional[Variants]:
+        entry = self.entries.pop(key, None)
+
+        if entry is None:
+            return None
+
+        variants = entry[1]
+
+        self.size -= sum(len(output) for output in variants.values())
+
+        return variants
+
+    def remove_old_entries(self, current_time: float) -> None:
+        # The entries are kept in the order they were added, so the expired and the oldest ones are first.
+        while self.entries:
+            (key, (added_time, _variants)) = next(iter(self.entries.items()))
+
+            if self.size <= self.size_limit and current_time - added_time < self.duration:
+                break
+
+            self.remove_entry(key)
+
+    def put(self, key: str, variants: Variants) -> None:
+        size = sum(len(output) for output in variants.values())
+
+        if constants.VariantType.VIDEO_NOTE not in variants or size > self.size_limit:
+            return
+
+        with self.lock:
+            self.remove_entry(key)
+
+            self.entries[key] = (time.monotonic(), variants)
+            self.size += size
+
+            self.remove_old_entries(time.monotonic())
+
+        logger.info(f'Cached {len(variants)} variants of {key}')
+
+    def pop(self, key: str) -> typing.Optional[Variants]:
+        with self.lock:
+            self.remove_old_entries(time.monotonic())
+
+            return self.remove_entry(key)